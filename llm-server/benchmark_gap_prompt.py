@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+深掘り判定（情報充足度分析）のプロンプトサイズとレイテンシのベンチマーク
+
+応答タイプごとに、参考資料を全分類分含める場合（変更前）と、
+大分類の項目だけに絞る場合（変更後）のプロンプトのトークン数を比較する。
+--live を指定すると実際にLLMを呼び出し、レイテンシも計測する（OPENAI_API_KEY が必要）。
+
+    python benchmark_gap_prompt.py
+    python benchmark_gap_prompt.py --live --repeat 3
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# レイテンシの計測がキャッシュに当たらないようにする
+os.environ.setdefault("ENABLE_LLM_CACHE", "false")
+
+import src.chat as chat
+import src.llm_client as llm
+from src.history_packer import count_tokens
+
+
+CASES = {
+    "predict_crime_type": [
+        {"role": "user", "content": "駅で口論になり、相手を殴って怪我をさせてしまいました。どんな罪になりますか？"}
+    ],
+    "predict_punishment": [
+        {"role": "user", "content": "コンビニで万引きをして窃盗で捕まりました。どのくらいの刑になりますか？"}
+    ],
+    "predict_crime_and_punishment": [
+        {"role": "user", "content": "飲酒運転で人をはねて怪我をさせてしまいました。罪名と刑の見通しを教えてください。"},
+        {"role": "assistant", "content": "【確認ステップ 第1回】\n1. 被害者の怪我の程度は？\n2. 前科はありますか？\n3. 示談は？"},
+        {"role": "user", "content": "全治2週間です。前科はありません。示談はまだです。"}
+    ],
+    "legal_process": [
+        {"role": "user", "content": "家族が逮捕されました。この後どのような手続きになりますか？"}
+    ]
+}
+
+
+def prompt_tokens(messages):
+    return sum(count_tokens(m["content"]) for m in messages)
+
+
+def measure_latency(messages, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        started = time.monotonic()
+        llm.complete_json(messages, purpose="question_generator")
+        elapsed.append(time.monotonic() - started)
+    return statistics.median(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--live", action="store_true", help="LLMを呼び出してレイテンシを計測する")
+    parser.add_argument("--repeat", type=int, default=3, help="レイテンシ計測の繰り返し回数（中央値を表示）")
+    args = parser.parse_args()
+
+    manager = chat.clarification_manager
+    header = f"{'応答タイプ':<30} {'大分類':<14} {'変更前tokens':>12} {'変更後tokens':>12} {'削減率':>7}"
+    if args.live:
+        header += f" {'変更前秒':>9} {'変更後秒':>9}"
+    print(header)
+
+    for response_type, hist in CASES.items():
+        category = manager.reference_category(hist)
+        before = manager._gap_analysis_messages(hist, response_type, 0)
+        after = manager._gap_analysis_messages(hist, response_type, 0, big_category=category)
+        before_tokens = prompt_tokens(before)
+        after_tokens = prompt_tokens(after)
+        reduction = 1 - after_tokens / before_tokens if before_tokens else 0.0
+        line = (
+            f"{response_type:<30} {category or '（未確定）':<14} "
+            f"{before_tokens:>12} {after_tokens:>12} {reduction:>7.1%}"
+        )
+        if args.live:
+            line += f" {measure_latency(before, args.repeat):>9.2f} {measure_latency(after, args.repeat):>9.2f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
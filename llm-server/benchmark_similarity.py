@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+類似検索（コサイン類似度と上位k件）のマイクロベンチマーク
+
+件数を 1k から 1M まで増やしながら、次の方式の1クエリあたりの時間を比べる（ランダムなベクトルを使うためAPIは呼ばない）。
+  loop    : 変更前の gen/chat.vector_search と同じ、1件ずつのコサイン類似度と全件の並べ替え（--loop-max 件まで）
+  single  : similarity.SimilarityIndex.search（正規化済み行列との内積1回 + argpartition）
+  batch   : similarity.SimilarityIndex.search_batch（--batch 件のクエリを行列積1回でまとめて検索）
+  tag     : single を1つの tag（全体の 1/--tags）に絞り込んだ場合
+
+    python benchmark_similarity.py
+    python benchmark_similarity.py --dim 1536 --sizes 1000,10000,100000
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.similarity import SimilarityIndex
+
+
+def loop_search(query, embeddings, k):
+    """変更前の実装（1件ずつノルムを計算し、全件を並べ替える）"""
+    distances = []
+    for i, item_embedding in enumerate(embeddings):
+        cosine = np.dot(query, item_embedding) / (np.linalg.norm(query) * np.linalg.norm(item_embedding))
+        distances.append((i, cosine))
+    distances = sorted(distances, key=lambda x: x[1], reverse=True)[:k]
+    return [d[0] for d in distances]
+
+
+def median_ms(func, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed.append((time.perf_counter() - started) * 1000)
+    return statistics.median(elapsed)
+
+
+def random_vectors(rng, n, dim, chunk=100_000):
+    """メモリを抑えるためにfloat32で少しずつ生成する"""
+    vectors = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, chunk):
+        end = min(start + chunk, n)
+        vectors[start:end] = rng.standard_normal((end - start, dim), dtype=np.float32)
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="ベクトル数（カンマ区切り）")
+    parser.add_argument("--dim", type=int, default=256, help="次元数（ada-002 は1536。1M件では約6GBになる）")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--batch", type=int, default=32, help="まとめて検索するクエリ数")
+    parser.add_argument("--tags", type=int, default=20, help="tag の種類数")
+    parser.add_argument("--loop-max", type=int, default=100000, help="loop を計測する最大件数")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((args.batch, args.dim), dtype=np.float32)
+
+    print(f"dim={args.dim} k={args.k} batch={args.batch} tags={args.tags} (ms / query, median of {args.repeat})")
+    print(f"{'vectors':>10} {'build ms':>10} {'loop':>10} {'single':>10} {'batch':>10} {'tag':>10} {'speedup':>9}")
+    for n in [int(size) for size in args.sizes.split(",")]:
+        vectors = random_vectors(rng, n, args.dim)
+        tags = [f"tag{i % args.tags}" for i in range(n)]
+
+        started = time.perf_counter()
+        index = SimilarityIndex(vectors, tags=tags)
+        build_ms = (time.perf_counter() - started) * 1000
+        index.rows_for("tag0")  # tag の行番号は初回だけ求めてキャッシュする
+
+        single = median_ms(lambda: index.search(queries[0], args.k), args.repeat)
+        batch = median_ms(lambda: index.search_batch(queries, args.k), args.repeat) / args.batch
+        tagged = median_ms(lambda: index.search(queries[0], args.k, tag="tag0"), args.repeat)
+        if n <= args.loop_max:
+            loop = median_ms(lambda: loop_search(queries[0], vectors, args.k), 1)
+            assert loop_search(queries[0], vectors, args.k) == [i for i, _ in index.search(queries[0], args.k)]
+            loop_text, speedup = f"{loop:10.2f}", f"{loop / batch:8.0f}x"
+        else:
+            loop_text, speedup = f"{'-':>10}", f"{'-':>9}"
+        print(f"{n:>10} {build_ms:10.1f} {loop_text} {single:10.3f} {batch:10.3f} {tagged:10.3f} {speedup}")
+        del vectors, index
+
+
+if __name__ == "__main__":
+    main()
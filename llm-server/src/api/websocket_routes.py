@@ -5,6 +5,7 @@ from typing import Optional
 from fastapi import WebSocket, WebSocketDisconnect, Query
 from src.database.connection import get_database
 from src.database.models import MessageModel, ConversationModel
+from src.dialogue_state import DialogueState, METADATA_KEY
 from src.auth.authentication import decode_token
 from datetime import datetime
 from bson import ObjectId
@@ -40,6 +41,7 @@ async def handle_authenticated_chat(ws: WebSocket, token: str, conversation_id:
     # Initialize conversation variables
     conv_obj_id = None
     is_new_conversation = False
+    dialogue_state = DialogueState()
 
     # Handle existing conversation
     if conversation_id:
@@ -60,6 +62,7 @@ async def handle_authenticated_chat(ws: WebSocket, token: str, conversation_id:
             await ws.close()
             return
         conv_obj_id = conversation["_id"]
+        dialogue_state = DialogueState.from_metadata(conversation.get("metadata"))
     else:
         # Mark as new conversation (will be created on first message)
         is_new_conversation = True
@@ -202,18 +205,14 @@ async def handle_authenticated_chat(ws: WebSocket, token: str, conversation_id:
 
                 # Generate response
                 use_rag = is_rag_enabled()
-                rep = c.reply(acc, genre=genre, use_rag=use_rag)
                 response_text = ""
 
                 await ws.send_json({'text': '<start>'})
 
-                if isinstance(rep, str):
-                    response_text += rep
-                    await ws.send_json({'text': rep})
-                else:
-                    for x in rep:
-                        response_text += x
-                        await ws.send_json({'text': x})
+                # LLM呼び出しは全て非同期で行い、他の接続の処理を止めない
+                async for x in c.reply_async(acc, genre=genre, use_rag=use_rag, state=dialogue_state):
+                    response_text += x
+                    await ws.send_json({'text': x})
 
                 await ws.send_json({'text': '<end>'})
 
@@ -226,10 +225,13 @@ async def handle_authenticated_chat(ws: WebSocket, token: str, conversation_id:
                     )
                     await db.messages.insert_one(assistant_msg.model_dump(by_alias=True))
 
-                    # Update conversation's updated_at
+                    # Update conversation's updated_at and dialogue state
                     await db.conversations.update_one(
                         {"_id": conv_obj_id},
-                        {"$set": {"updated_at": datetime.utcnow()}}
+                        {"$set": {
+                            "updated_at": datetime.utcnow(),
+                            f"metadata.{METADATA_KEY}": dialogue_state.model_dump()
+                        }}
                     )
 
                 # Update local history
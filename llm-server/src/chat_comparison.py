@@ -7,7 +7,8 @@ LLMのプロンプトエンジニアリングのみで深掘り質問を生成
 import json
 import logging
 from typing import List, Dict, Optional, Generator, Union
-import src.config as config
+import src.llm_client as llm
+from src.history_packer import pack_history
 
 
 WELCOME_MESSAGE = "こんにちは。ご相談やご質問があればお気軽にお知らせください。"
@@ -55,17 +56,13 @@ class LLMOnlyManager:
 
 JSON形式で出力してください。
 """
-        client = config.get_openai_client()
-        resp = client.chat.completions.create(
-            model=config.get_model("classifier"),
-            temperature=config.get_temperature("classifier"),
-            response_format={"type": "json_object"},
-            messages=[
+        return llm.complete_json(
+            [
                 {"role": "system", "content": inst},
                 {"role": "user", "content": text}
-            ]
+            ],
+            purpose="classifier"
         )
-        return json.loads(resp.choices[0].message.content)
 
     def generate_clarifying_questions(self, hist: List[Dict], response_type: str) -> Optional[str]:
         """LLMのみで深掘り質問を生成（データテーブル不使用）"""
@@ -123,7 +120,7 @@ JSON形式で出力してください。
 
         user_prompt = f"""
 会話履歴:
-{json.dumps(hist, ensure_ascii=False)}
+{json.dumps(pack_history(hist, 'question_generator'), ensure_ascii=False)}
 
 これまでの深掘り質問回数: {rounds_completed}
 最大実施回数: {MAX_CLARIFY_ROUNDS}
@@ -138,19 +135,14 @@ JSON形式で出力してください。
 """
 
         try:
-            client = config.get_openai_client()
-            resp = client.chat.completions.create(
-                model=config.get_model("question_generator"),
-                temperature=config.get_temperature("question_generator"),
-                response_format={"type": "json_object"},
-                messages=[
+            result = llm.complete_json(
+                [
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": user_prompt}
-                ]
+                ],
+                purpose="question_generator"
             )
 
-            result = json.loads(resp.choices[0].message.content)
-
             if result.get('ask_more') and result.get('question_items'):
                 questions = result['question_items'][:MAX_QUESTIONS]
                 if len(questions) >= MIN_QUESTIONS:
@@ -204,19 +196,7 @@ JSON形式で出力してください。
 回答は簡潔にまとめ、相談者が理解しやすい形で提供してください。
 """
 
-        client = config.get_openai_client()
-        resp = client.chat.completions.create(
-            model=config.get_model("streaming"),
-            temperature=config.get_temperature("streaming"),
-            stream=True,
-            messages=[{"role": "system", "content": inst}] + hist
-        )
-
-        for chunk in resp:
-            if chunk:
-                content = chunk.choices[0].delta.content
-                if content:
-                    yield content
+        yield from llm.stream_text([{"role": "system", "content": inst}] + pack_history(hist, "streaming"), purpose="streaming")
 
     def generate_crime_prediction(self, hist: List[Dict]) -> Generator[str, None, None]:
         """LLMのみで罪名予測を行う（データテーブル不使用）"""
@@ -234,19 +214,7 @@ JSON形式で出力してください。
 最終的に、最も可能性の高い罪名を3個以下に絞って提示してください。
 """
 
-        client = config.get_openai_client()
-        resp = client.chat.completions.create(
-            model=config.get_model("streaming"),
-            temperature=config.get_temperature("streaming"),
-            stream=True,
-            messages=[{"role": "system", "content": inst}] + hist
-        )
-
-        for chunk in resp:
-            if chunk:
-                content = chunk.choices[0].delta.content
-                if content:
-                    yield content
+        yield from llm.stream_text([{"role": "system", "content": inst}] + pack_history(hist, "streaming"), purpose="streaming")
 
     def generate_punishment_prediction(self, hist: List[Dict]) -> Generator[str, None, None]:
         """LLMのみで量刑予測を行う（データテーブル不使用）"""
@@ -266,19 +234,7 @@ JSON形式で出力してください。
 執行猶予の可能性がある場合は、その条件も含めて説明してください。
 """
 
-        client = config.get_openai_client()
-        resp = client.chat.completions.create(
-            model=config.get_model("streaming"),
-            temperature=config.get_temperature("streaming"),
-            stream=True,
-            messages=[{"role": "system", "content": inst}] + hist
-        )
-
-        for chunk in resp:
-            if chunk:
-                content = chunk.choices[0].delta.content
-                if content:
-                    yield content
+        yield from llm.stream_text([{"role": "system", "content": inst}] + pack_history(hist, "streaming"), purpose="streaming")
 
     def generate_legal_process_answer(self, hist: List[Dict]) -> Generator[str, None, None]:
         """LLMのみで法プロセスに関する回答を生成"""
@@ -287,19 +243,7 @@ JSON形式で出力してください。
 できるだけ簡潔かつ正確に、相談者が理解しやすい言葉で説明してください。
 """
 
-        client = config.get_openai_client()
-        resp = client.chat.completions.create(
-            model=config.get_model("streaming"),
-            temperature=config.get_temperature("streaming"),
-            stream=True,
-            messages=[{"role": "system", "content": inst}] + hist
-        )
-
-        for chunk in resp:
-            if chunk:
-                content = chunk.choices[0].delta.content
-                if content:
-                    yield content
+        yield from llm.stream_text([{"role": "system", "content": inst}] + pack_history(hist, "streaming"), purpose="streaming")
 
 
 # シングルトンインスタンス
@@ -314,7 +258,7 @@ def reply_without_data(hist: List[Dict]) -> Union[Generator[str, None, None], st
         return WELCOME_MESSAGE
 
     # 全履歴からテキストを結合して分類
-    text = '\n'.join([h['content'] for h in hist if h.get('content')])
+    text = '\n'.join([h['content'] for h in pack_history(hist, "classifier") if h.get('content')])
     response_type = llm_only_manager.classify_response_type(text)
     rt = response_type['type']
 
@@ -6,7 +6,7 @@ from functools import lru_cache
 from pathlib import Path
 
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
 
 # `.env` がどこから実行しても読み込まれるように絶対パスで指定
@@ -56,11 +56,87 @@ COMPARISON_MODE_ENABLED = os.getenv("ENABLE_COMPARISON_MODE", "false").lower() =
 RAG_ENABLED = os.getenv("ENABLE_RAG", "false").lower() == "true"
 VECTOR_STORE_ID = os.getenv("VECTOR_STORE_ID", "")
 RAG_ONLY_MODE = os.getenv("RAG_ONLY_MODE", "false").lower() == "true"
+# RAGのAssistantは用途・モデル・ベクトルストアごとに1回だけ作成し、IDをSQLiteに保存して再起動後も使い回す（空文字で保存しない）
+RAG_ASSISTANT_STORE_PATH = os.getenv("RAG_ASSISTANT_STORE_PATH", "rag_assistants.sqlite3")
+# RAGデータ生成（rag_loader）のembedding。1リクエストあたりの入力数・トークン数の上限、同時に送るバッチ数、レート制限時の再試行回数
+RAG_EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", "256"))
+RAG_EMBED_BATCH_TOKENS = int(os.getenv("RAG_EMBED_BATCH_TOKENS", "100000"))
+RAG_EMBED_CONCURRENCY = int(os.getenv("RAG_EMBED_CONCURRENCY", "4"))
+RAG_EMBED_MAX_RETRIES = int(os.getenv("RAG_EMBED_MAX_RETRIES", "6"))
+
+# 継続判定・分類・充足度判定を1回のLLM呼び出しにまとめる（falseで従来の個別呼び出し）
+TURN_PLANNER_ENABLED = os.getenv("ENABLE_TURN_PLANNER", "true").lower() == "true"
+
+# 大分類の決まった後の深掘りラウンドは、罪名予測テーブル・量刑予測ヒアリングシートから質問をローカルで選ぶ（LLMを呼ばない）
+LOCAL_QUESTION_SELECTION_ENABLED = os.getenv("ENABLE_LOCAL_QUESTION_SELECTION", "true").lower() == "true"
+
+# 大分類が決まっている（または大分類シートで事前分類できる）場合、深掘り判定の参考資料をその分類の項目だけにする
+SCOPED_REFERENCE_ENABLED = os.getenv("ENABLE_SCOPED_REFERENCE", "true").lower() == "true"
+
+# 罪名予測テーブル・ヒアリング項目を、◯のついた基準だけを列挙するコンパクトな表現でプロンプトに含める
+COMPACT_TABLE_PROMPT_ENABLED = os.getenv("ENABLE_COMPACT_TABLE_PROMPT", "true").lower() == "true"
+
+# 罪名予測テーブル・量刑予測ヒアリングシートの更新を確認する間隔（秒）。変更があれば再起動なしで読み直す（0で確認しない）
+TABLE_RELOAD_INTERVAL = float(os.getenv("TABLE_RELOAD_INTERVAL", "30"))
+
+# 深掘り判定の補助呼び出し（充足度分析・不明回答検出・判明事実抽出）の並行実行設定
+CLARIFY_CALL_TIMEOUT = float(os.getenv("CLARIFY_CALL_TIMEOUT", "20"))  # 1呼び出しあたりの秒数
+CLARIFY_MAX_WORKERS = int(os.getenv("CLARIFY_MAX_WORKERS", "8"))
+
+# ローカル分類器（応答タイプ・継続判定）。学習済みモデルがある場合のみ使用
+INTENT_CLASSIFIER_ENABLED = os.getenv("ENABLE_INTENT_CLASSIFIER", "true").lower() == "true"
+INTENT_MODEL_DIR = os.getenv("INTENT_MODEL_DIR", "intent_model")
+INTENT_CLASSIFIER_THRESHOLD = float(os.getenv("INTENT_CLASSIFIER_THRESHOLD", "0.9"))  # これ未満はLLMで判定
+
+# 深掘り判定中に最終回答を先行生成する（reply_asyncのみ）。上限は文字数（トークン数の目安）
+SPECULATIVE_ANSWER_ENABLED = os.getenv("ENABLE_SPECULATIVE_ANSWER", "false").lower() == "true"
+SPECULATIVE_MAX_CHARS = int(os.getenv("SPECULATIVE_MAX_CHARS", "1500"))  # 確定前に先行生成する上限（1ターン）
+SPECULATIVE_WASTE_BUDGET_CHARS = int(os.getenv("SPECULATIVE_WASTE_BUDGET_CHARS", "200000"))  # 破棄してよい量（1時間）
+
+# temperature 0 の呼び出しの応答キャッシュ（メモリLRU + SQLite）
+# 相談内容と回答がディスクに残るため、明示的に有効にした場合のみ使う
+LLM_CACHE_ENABLED = os.getenv("ENABLE_LLM_CACHE", "false").lower() == "true"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")  # 空文字でディスク保存なし
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MAX_MEMORY_ENTRIES", "1000"))
+LLM_CACHE_MAX_DISK_ENTRIES = int(os.getenv("LLM_CACHE_MAX_DISK_ENTRIES", "50000"))
+
+# embeddingのキャッシュ（モデルと正規化したテキストのハッシュがキー。メモリLRU + SQLite）と、同時に来た1件ずつの要求をまとめる待ち時間
+EMBEDDING_CACHE_ENABLED = os.getenv("ENABLE_EMBEDDING_CACHE", "true").lower() == "true"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")  # 空文字でディスク保存なし
+EMBEDDING_CACHE_MAX_MEMORY_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_MEMORY_ENTRIES", "10000"))
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "10"))
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "256"))
+
+# 言い換えに近い相談への意味キャッシュ（法プロセスの回答・深掘り質問の第1回を再利用）
+SEMANTIC_CACHE_ENABLED = os.getenv("ENABLE_SEMANTIC_CACHE", "false").lower() == "true"
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.sqlite3")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # コサイン類似度
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+SEMANTIC_CACHE_RESPONSE_TYPES = [
+    t.strip() for t in os.getenv(
+        "SEMANTIC_CACHE_RESPONSE_TYPES",
+        "legal_process,predict_crime_and_punishment,predict_crime_type,predict_punishment"
+    ).split(",") if t.strip()
+]
+
+# プロンプトに含める会話履歴のトークン予算（用途ごと）。超えた分は古いターンから短縮する
+HISTORY_TOKEN_BUDGETS = {
+    purpose: int(os.getenv(f"HISTORY_TOKEN_BUDGET_{purpose.upper()}", default))
+    for purpose, default in {
+        "main": "8000",
+        "classifier": "2000",
+        "question_generator": "6000",
+        "streaming": "8000"
+    }.items()
+}
 
+# 任意追加質問は回答と並行して会話履歴から生成する。trueなら回答完了後に回答本文を踏まえて生成し直す
+OPTIONAL_FOLLOW_UP_REFINE = os.getenv("OPTIONAL_FOLLOW_UP_REFINE", "false").lower() == "true"
 
-@lru_cache
-def get_openai_client() -> OpenAI:
-    """Create a reusable OpenAI client with env var validation."""
+
+def _openai_client_args() -> dict:
+    """OpenAIクライアントの共通引数を環境変数から組み立てる"""
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY が設定されていません。llm-server/.env を確認してください。")
@@ -78,7 +154,19 @@ def get_openai_client() -> OpenAI:
     if organization:
         client_args["organization"] = organization
 
-    return OpenAI(**client_args)
+    return client_args
+
+
+@lru_cache
+def get_openai_client() -> OpenAI:
+    """Create a reusable OpenAI client with env var validation."""
+    return OpenAI(**_openai_client_args())
+
+
+@lru_cache
+def get_async_openai_client() -> AsyncOpenAI:
+    """Create a reusable AsyncOpenAI client for use inside the event loop."""
+    return AsyncOpenAI(**_openai_client_args())
 
 def get_model(purpose="main"):
     """
@@ -0,0 +1,160 @@
+"""
+罪名予測テーブルの◯行列インデックス
+
+罪名予測テーブル（大分類・各カテゴリのシート）は「罪名 × 判断基準」の◯行列のため、
+シートごとにNumPyの真偽値行列（行＝罪名、列＝判断基準）へ変換しておく。
+判断基準への はい/いいえ の回答から、残る候補の罪名と、候補をまだ区別できる判断基準を求める。
+プロンプトには生き残った行だけを渡せるよう、部分表をCSVとして書き出す機能も持つ。
+読み込んだテーブルは table_registry がまとめて保持し、ファイルの更新時に読み直す。
+"""
+
+import csv
+import unicodedata
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+# 読み込み順（先に見つかったシートを優先）。TSVはリポジトリ管理、CSVは dataset/raw の元データ
+TABLE_DIRS = [Path("罪名予測テーブル"), Path("dataset/raw")]
+SHEET_PREFIXES = ("罪名予測テーブル - ", "罪名予測テーブル_")
+BIG_CATEGORY = "大分類"
+MARK = "◯"
+
+
+def _normalize(text: str) -> str:
+    # 元データのファイル名・セルにはNFDの濁点などが混ざるためNFCにそろえる
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def sheet_name(path: Path) -> str:
+    """ファイル名から参照シート名を取り出す（例: 罪名予測テーブル - 身体に対する罪.tsv → 身体に対する罪）"""
+    name = _normalize(path.stem)
+    for prefix in SHEET_PREFIXES:
+        if name.startswith(prefix):
+            return name[len(prefix):].strip()
+    return name
+
+
+def read_rows(path: Path) -> List[List[str]]:
+    """TSV/CSVの空行以外の行を読み込む"""
+    delimiter = '\t' if path.suffix == '.tsv' else ','
+    with open(path, 'r', encoding='utf-8') as f:
+        return [row for row in csv.reader(f, delimiter=delimiter) if row]
+
+
+def sheet_files(directories: Iterable[Path] = TABLE_DIRS) -> Iterator[Tuple[str, Path]]:
+    """ディレクトリ内の罪名予測テーブル（TSV/CSV）を (シート名, パス) で返す。同名のシートは先に見つかったものだけ"""
+    seen = set()
+    for directory in directories:
+        if not directory.exists():
+            continue
+        for path in sorted(directory.iterdir()):
+            if path.suffix not in ('.tsv', '.csv') or not _normalize(path.name).startswith(SHEET_PREFIXES):
+                continue
+            name = sheet_name(path)
+            if name not in seen:
+                seen.add(name)
+                yield name, path
+
+
+class CrimeTable:
+    """1シート分の◯行列"""
+
+    def __init__(self, name: str, crimes: List[str], criteria: List[str], matrix: np.ndarray):
+        self.name = name
+        self.crimes = crimes
+        self.criteria = criteria
+        self.matrix = matrix  # shape (罪名数, 判断基準数) の bool
+        self.crime_index = {crime: i for i, crime in enumerate(crimes)}
+        self.criterion_index = {criterion: j for j, criterion in enumerate(criteria)}
+
+    @classmethod
+    def from_rows(cls, name: str, rows: List[List[str]]) -> "CrimeTable":
+        header = [_normalize(h) for h in rows[0]]
+        columns = [j for j in range(1, len(header)) if header[j]]
+        crimes = []
+        marks = []
+        for row in rows[1:]:
+            if not row or not _normalize(row[0]):
+                continue
+            crimes.append(_normalize(row[0]))
+            marks.append([j < len(row) and _normalize(row[j]) == MARK for j in columns])
+        matrix = np.array(marks, dtype=bool).reshape(len(crimes), len(columns))
+        return cls(name, crimes, [header[j] for j in columns], matrix)
+
+    @classmethod
+    def from_file(cls, path: Path) -> "CrimeTable":
+        return cls.from_rows(sheet_name(path), read_rows(path))
+
+    def _mask(self, crimes: Optional[Iterable[str]]) -> np.ndarray:
+        if crimes is None:
+            return np.ones(len(self.crimes), dtype=bool)
+        mask = np.zeros(len(self.crimes), dtype=bool)
+        for crime in crimes:
+            i = self.crime_index.get(crime)
+            if i is not None:
+                mask[i] = True
+        return mask
+
+    def narrow(self, answers: Dict[str, bool], candidates: Optional[Iterable[str]] = None) -> Dict:
+        """
+        判断基準への回答（基準名 → はい/いいえ）で候補を絞り込む
+        回答と◯の有無が全て一致する罪名を残し、該当がなければ不一致の最も少ない罪名を残す。
+        表にない基準名は無視する。
+
+        Returns:
+            {"candidates": 残った罪名, "discriminating": 候補をまだ区別できる未回答の基準（二分の偏りが小さい順）,
+             "mismatches": 残った罪名の不一致数}
+        """
+        mask = self._mask(candidates)
+        columns = [self.criterion_index[c] for c in answers if c in self.criterion_index]
+        mismatches = 0
+        if columns and mask.any():
+            expected = np.array([bool(answers[self.criteria[j]]) for j in columns])
+            errors = (self.matrix[:, columns] != expected).sum(axis=1)
+            mismatches = int(errors[mask].min())
+            mask &= errors == mismatches
+
+        rows = np.flatnonzero(mask)
+        return {
+            "candidates": [self.crimes[i] for i in rows],
+            "discriminating": self.discriminating_criteria(rows, exclude=columns),
+            "mismatches": mismatches
+        }
+
+    def discriminating_criteria(self, rows: np.ndarray, exclude: Iterable[int] = ()) -> List[str]:
+        """候補の行を◯あり/なしに分けられる基準を、二分の偏りが小さい順に返す"""
+        if len(rows) < 2:
+            return []
+        counts = self.matrix[rows].sum(axis=0)
+        splits = (counts > 0) & (counts < len(rows))
+        splits[list(exclude)] = False
+        columns = np.flatnonzero(splits)
+        imbalance = np.abs(2 * counts[columns] - len(rows))
+        return [self.criteria[j] for j in columns[np.argsort(imbalance, kind="stable")]]
+
+    def marked_criteria(self, crime: str) -> List[str]:
+        """罪名に◯がついている判断基準"""
+        return [self.criteria[j] for j in np.flatnonzero(self.matrix[self.crime_index[crime]])]
+
+    def render(self, crimes: Optional[Iterable[str]] = None) -> str:
+        """指定した罪名の行（省略時は全行）だけのCSVを返す。どの行にも◯がない列は省く"""
+        rows = np.flatnonzero(self._mask(crimes))
+        columns = np.flatnonzero(self.matrix[rows].any(axis=0)) if len(rows) else np.array([], dtype=int)
+        lines = [','.join(['参照シート名' if self.name == BIG_CATEGORY else '罪名'] + [self.criteria[j] for j in columns])]
+        for i in rows:
+            lines.append(','.join([self.crimes[i]] + [MARK if self.matrix[i, j] else '' for j in columns]))
+        return '\n'.join(lines)
+
+
+def load_crime_tables(directories: Iterable[Path] = TABLE_DIRS) -> Dict[str, CrimeTable]:
+    """ディレクトリ内の罪名予測テーブル（TSV/CSV）を読み込む。同名のシートは先に読んだものを使う"""
+    return {name: CrimeTable.from_file(path) for name, path in sheet_files(directories)}
+
+
+def get_crime_tables() -> Dict[str, CrimeTable]:
+    """罪名予測テーブルのインデックス（シート名 → CrimeTable）。table_registry の現在のスナップショットのもの"""
+    from src.table_registry import current_tables
+    return current_tables().crime_tables
@@ -0,0 +1,88 @@
+"""
+会話ごとの対話状態
+
+応答タイプ・深掘りラウンド数・大分類・任意追加質問の有無をターンごとに差分更新し、
+ConversationModel.metadata["dialogue_state"] に保存する。
+保存済みの状態が会話履歴と一致していれば、毎ターンの再分類や履歴の全走査を省略できる。
+
+判明事実の台帳（known_facts）も同じく保存し、各ラウンドでは未反映のユーザー発話から抽出した事実だけを統合する。
+深掘り質問をローカルで選んだラウンド（question_selector）については、尋ねた判断基準・項目と、
+判断基準への はい/いいえ の回答も保存し、次のラウンドの質問選択と罪名の候補の絞り込みに使う。
+"""
+
+import logging
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel, ValidationError
+
+
+METADATA_KEY = "dialogue_state"
+
+
+def fact_key(fact: str) -> str:
+    """「項目名：内容」形式の事実の項目名（区切りがなければ全体）"""
+    for separator in ("：", ":"):
+        if separator in fact:
+            return fact.split(separator, 1)[0].strip()
+    return fact.strip()
+
+
+class DialogueState(BaseModel):
+    response_type: Optional[str] = None  # 現在の相談の応答タイプ（未確定ならNone）
+    clarify_rounds: int = 0  # 実施済みの深掘りラウンド数
+    awaiting_clarification: bool = False  # 直前の応答が深掘り質問か
+    big_category: Optional[str] = None  # 深掘り分析で選ばれた罪名大分類
+    optional_follow_up_pending: bool = False  # これまでの応答で任意追加質問を提示したか
+    hist_length: int = 0  # この状態に反映済みの会話履歴の件数
+    known_facts: List[str] = []  # 判明事実の台帳（「項目名：内容」）
+    facts_hist_length: int = 0  # 判明事実の台帳に反映済みの会話履歴の件数
+    criteria_answers: Dict[str, bool] = {}  # 罪名予測テーブルの判断基準への回答（はい/いいえ）
+    asked_items: List[str] = []  # ローカルで選んで尋ねた判断基準・量刑の項目
+    pending_criteria: List[Optional[str]] = []  # 直前の深掘り質問の並び順の判断基準（判断基準でない質問はNone）
+
+    @classmethod
+    def from_metadata(cls, metadata: Optional[Dict[str, Any]]) -> "DialogueState":
+        """会話のmetadataから状態を復元する（存在しない・壊れている場合は初期状態）"""
+        data = (metadata or {}).get(METADATA_KEY)
+        if not data:
+            return cls()
+        try:
+            return cls.model_validate(data)
+        except ValidationError as e:
+            logging.warning(f"Invalid dialogue state discarded: {e}")
+            return cls()
+
+    def is_synced(self, hist: List[Dict]) -> bool:
+        """保存済みの状態が、最新のユーザー発話を除く会話履歴と一致しているか"""
+        return self.hist_length > 0 and len(hist) == self.hist_length + 1
+
+    def pending_fact_turns(self, hist: List[Dict]) -> List[Dict]:
+        """判明事実の台帳にまだ反映していない会話履歴（台帳が履歴と食い違う場合は全体）"""
+        if 0 < self.facts_hist_length <= len(hist):
+            return hist[self.facts_hist_length:]
+        return hist
+
+    def merge_facts(self, facts: List[str], hist_length: int):
+        """
+        新たに抽出した事実を台帳に統合する
+        同じ項目名の事実は新しい内容で置き換え、それ以外は末尾に追加する
+        """
+        merged = list(self.known_facts)
+        for fact in facts:
+            key = fact_key(fact)
+            for i, existing in enumerate(merged):
+                if fact_key(existing) == key:
+                    merged[i] = fact
+                    break
+            else:
+                merged.append(fact)
+        self.known_facts = merged
+        self.facts_hist_length = hist_length
+
+    def record_reply(self, hist: List[Dict], clarification: bool, optional_follow_up: bool):
+        """応答を1件反映する（histは応答前の会話履歴）"""
+        self.awaiting_clarification = clarification
+        if clarification:
+            self.clarify_rounds += 1
+        self.optional_follow_up_pending = optional_follow_up
+        self.hist_length = len(hist) + 1
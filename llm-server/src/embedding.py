@@ -1,36 +1,265 @@
+"""
+embeddingの取得（全ての呼び出し元で共有するサービス）
+
+ada・ada_batch・gen/rag・gen/chat・意味キャッシュのembeddingは全て EmbeddingService を通ります。
+- キーは (モデル, 正規化したテキスト) のハッシュで、メモリ上のLRUとSQLiteに保存する（同じ文字列は1回だけAPIに送る）
+- 同時に来た1件ずつの要求は短い待ち時間の間まとめて、1回の embeddings.create で取得する
+"""
+
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache
+from queue import Empty, Queue
+from typing import Dict, List, Optional, Union
+
 import numpy as np
-from typing import List, Union
 
 import src.config as config
+import src.similarity as similarity
+
+
+def normalize_text(text: str) -> str:
+    """キャッシュのキーとAPIに送るテキストの正規化（NFKC・前後の空白除去・連続する空白を1つに）"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def make_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingService:
+    def __init__(
+        self,
+        path: str,
+        max_memory_entries: int,
+        batch_window_seconds: float,
+        max_batch_size: int,
+        cache_enabled: bool = True
+    ):
+        self.max_memory_entries = max_memory_entries
+        self.batch_window_seconds = batch_window_seconds
+        self.max_batch_size = max_batch_size
+        self.cache_enabled = cache_enabled
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()  # key -> float32のembedding
+        self._inflight: Dict[str, Future] = {}  # APIに問い合わせ中のキー（同じテキストの同時要求は1つにまとめる）
+        self._lock = threading.Lock()
+        self._queue: "Queue[tuple]" = Queue()
+        self._worker = None
+        self._stats = {"hits": 0, "misses": 0, "api_calls": 0, "api_texts": 0}
+
+        self._conn = None
+        if cache_enabled and path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, model TEXT, vector BLOB, created_at REAL)"
+            )
+            self._conn.commit()
+
+    @property
+    def model(self) -> str:
+        return config.get_model("embedding")
+
+    # キャッシュ
+
+    def _get(self, key: str) -> Optional[np.ndarray]:
+        if not self.cache_enabled:
+            return None
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                return vector
+            if self._conn is None:
+                return None
+            try:
+                row = self._conn.execute("SELECT vector FROM embedding_cache WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                logging.error(f"Embedding cache read failed: {e}")
+                return None
+            if row is None:
+                return None
+            vector = np.frombuffer(row[0], dtype=np.float32)
+            self._remember(key, vector)
+            return vector
+
+    def _set_many(self, items: Dict[str, np.ndarray]):
+        if not self.cache_enabled or not items:
+            return
+        with self._lock:
+            for key, vector in items.items():
+                self._remember(key, vector)
+            if self._conn is None:
+                return
+            created_at = time.time()
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embedding_cache (key, model, vector, created_at) VALUES (?, ?, ?, ?)",
+                    [(key, self.model, vector.tobytes(), created_at) for key, vector in items.items()]
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Embedding cache write failed: {e}")
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            self._stats[name] += n
+
+    # API
+
+    def _create(self, texts: List[str]) -> List[np.ndarray]:
+        """正規化済みのテキストをまとめて1回の embeddings.create で取得する"""
+        client = config.get_openai_client()
+        response = client.embeddings.create(model=self.model, input=texts)
+        self._count("api_calls")
+        self._count("api_texts", len(texts))
+        return [np.asarray(data.embedding, dtype=np.float32) for data in response.data]
+
+    def _fetch(self, keys: List[str], texts: Dict[str, str]) -> Dict[str, np.ndarray]:
+        """キャッシュにないキーをAPIから取得してキャッシュに保存する"""
+        vectors = dict(zip(keys, self._create([texts[key] for key in keys])))
+        self._set_many(vectors)
+        return vectors
+
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """
+        複数のテキストをembeddingに変換する（呼び出し側でバッチにまとめ済みのもの。待ち時間なしで1回で送る）
+        キャッシュにあるもの・同じテキストの重複は送らない
+        """
+        model = self.model
+        keys = [make_key(model, text) for text in texts]
+        found = {}
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in found or key in missing:
+                continue
+            vector = self._get(key)
+            if vector is not None:
+                found[key] = vector
+            else:
+                missing[key] = normalize_text(text)
+        self._count("hits", sum(1 for key in keys if key in found))
+        self._count("misses", sum(1 for key in keys if key in missing))
+        if missing:
+            found.update(self._fetch(list(missing), missing))
+        return [found[key].tolist() for key in keys]
+
+    def embed(self, text: str) -> List[float]:
+        """
+        1件のテキストをembeddingに変換する
+        キャッシュになければ、同時に来た他の要求と短い待ち時間の間まとめてAPIに送る
+        """
+        key = make_key(self.model, text)
+        vector = self._get(key)
+        if vector is not None:
+            self._count("hits")
+            return vector.tolist()
+        self._count("misses")
+
+        with self._lock:
+            # 待っている間に他の要求が同じテキストを取得し終えていればそれを使う
+            vector = self._memory.get(key)
+            if vector is not None:
+                return vector.tolist()
+            future = self._inflight.get(key)
+            if future is None:
+                future = Future()
+                self._inflight[key] = future
+                self._queue.put((key, normalize_text(text), future))
+                self._ensure_worker()
+        return future.result().tolist()
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        """最初の要求から batch_window_seconds の間（または max_batch_size 件まで）集めて1回で送る"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_window_seconds
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch: List[tuple]):
+        keys = [key for key, _, _ in batch]
+        texts = {key: text for key, text, _ in batch}
+        try:
+            vectors = self._fetch(keys, texts)
+        except Exception as e:
+            vectors = None
+            error = e
+        with self._lock:
+            for key in keys:
+                self._inflight.pop(key, None)
+        for key, _, future in batch:
+            if vectors is None:
+                future.set_exception(error)
+            else:
+                future.set_result(vectors[key])
+
+    def get_stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+@lru_cache(maxsize=1)
+def get_embedding_service() -> EmbeddingService:
+    """embeddingサービスのシングルトン"""
+    return EmbeddingService(
+        path=config.EMBEDDING_CACHE_PATH,
+        max_memory_entries=config.EMBEDDING_CACHE_MAX_MEMORY_ENTRIES,
+        batch_window_seconds=config.EMBEDDING_BATCH_WINDOW_MS / 1000,
+        max_batch_size=config.EMBEDDING_MAX_BATCH_SIZE,
+        cache_enabled=config.EMBEDDING_CACHE_ENABLED
+    )
+
+
+def get_embedding_stats() -> Dict[str, Union[int, float]]:
+    return get_embedding_service().get_stats()
+
 
 def ada(text: str) -> List[float]:
     """
     OpenAI APIを使用してテキストをembeddingに変換
     設定ファイルで指定されたembeddingモデルを使用
     """
-    client = config.get_openai_client()
-    response = client.embeddings.create(
-        model=config.get_model("embedding"),
-        input=text
-    )
-    return response.data[0].embedding
+    return get_embedding_service().embed(text)
 
 def ada_batch(texts: List[str]) -> List[List[float]]:
     """
     複数のテキストを一度にembeddingに変換
     """
-    client = config.get_openai_client()
-    response = client.embeddings.create(
-        model=config.get_model("embedding"),
-        input=texts
-    )
-    return [data.embedding for data in response.data]
+    return get_embedding_service().embed_many(texts)
 
-def cosine_similarity(vec1: Union[List[float], np.ndarray], 
+def cosine_similarity(vec1: Union[List[float], np.ndarray],
                      vec2: Union[List[float], np.ndarray]) -> float:
     """
     2つのベクトル間のコサイン類似度を計算
+    多数のベクトルと比べる場合は similarity.SimilarityIndex を使う
     """
-    vec1 = np.array(vec1)
-    vec2 = np.array(vec2)
-    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
+    return similarity.cosine_similarity(vec1, vec2)
@@ -1,15 +1,18 @@
 import os, sys
 import traceback
-import numpy as np
 #from tqdm import tqdm
 from tqdm.notebook import tqdm
 import openai
 import src.gen.util as util
 import time
+import src.embedding as emb
+import src.similarity as similarity
 
 
-def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+def get_embedding(text: str):
+    return emb.ada(text)
+
+cosine_similarity = similarity.cosine_similarity
 
 def vector_search(
   query: str, 
@@ -17,16 +20,14 @@ def vector_search(
   k: int = 3,
   distance_metric: str = "cosine"
 ):
-  query_embedding = np.array(get_embedding(query))
-  
-  distances = []
-  for i, item_embedding in enumerate(embeddings):
-    if distance_metric == "cosine":
-      cosine_distance = cosine_similarity(query_embedding, item_embedding)
-      distances.append((i, cosine_distance))
-  distances = sorted(distances, key=lambda x: x[1], reverse=True)[:k]
-  top_k = [d[0] for d in distances]
-  return top_k
+  # embeddings は SimilarityIndex も受け付ける（同じリストなら行列は1回だけ作る）
+  if isinstance(embeddings, similarity.SimilarityIndex):
+    index = embeddings
+  else:
+    index = similarity.cached_index(embeddings, lambda: similarity.SimilarityIndex(embeddings))
+  if not len(index):
+    return []
+  return [i for i, _ in index.search(get_embedding(query), k)]
 
 
 ###
@@ -127,8 +128,8 @@ def gen_ref(texts_and_doc_ids, docs={}, debug=False):
     return docs
 
 def nearest(user_text:str, docs):
-    embs = [x['emb'] for x in docs]
-    i = vector_search(user_text, embs, k=1)[0]
+    index = similarity.cached_index(docs, lambda: similarity.SimilarityIndex([x['emb'] for x in docs]))
+    i = vector_search(user_text, index, k=1)[0]
     return docs[i]
 
 def get_related_doc(docs, doc_id):
@@ -1,6 +1,5 @@
 import os, sys
 import traceback
-import numpy as np
 #from tqdm import tqdm
 from tqdm import tqdm
 import openai
@@ -8,13 +7,14 @@ import src.gen.util as util
 import time
 import src.embedding as emb
 import pickle
+import src.similarity as similarity
+from src.vector_index import VectorIndex
 
 # make Dataset
 def save_ref(target_text :str, target_name, ref_tag :str):
     text = util.remove_newlines_and_spaces(target_text)
     texts = util.splitter(text, 2200)
     for i, text in enumerate(texts):
-        em = emb.ada(text)
         d = dict()
         d['text'] = text
         d['emb'] = emb.ada(text)
@@ -29,23 +29,31 @@ def load_ref(target_path):
         return pickle.load(f)
 
 # Search
-def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+cosine_similarity = similarity.cosine_similarity
 
-def similar_refs(query: str, refs, k: int = 3, distance_metric: str = "cosine"):
+def similar_refs(query: str, refs, k: int = 3, distance_metric: str = "cosine", tag=None):
     """
-    refs[0]={'text':text, 'emb':[0.01, -0.02, 0.10]}
+    refs[0]={'text':text, 'emb':[0.01, -0.02, 0.10], 'tag':ref_tag}
+    refsは変更しない（embeddingは正規化した行列にまとめて1回の内積で類似度を求める）
+    行列は同じ refs に対して1回だけ作り、呼び出しごとにはクエリだけを正規化する
+    tag を指定するとその tag の refs だけから選ぶ
     """
-    em = emb.ada(query)
-    query_embedding = np.array(em)
-    for i, ref in enumerate(refs):
-        refs[i]['emb'] = np.array(ref['emb'])
-    distances = []
-    for i, ref in enumerate(refs):
-        if distance_metric == "cosine":
-            cosine_distance = cosine_similarity(query_embedding, ref['emb'])
-            distances.append((i, cosine_distance))
-    distances = sorted(distances, key=lambda x: x[1], reverse=True)[:k]
-    top_k = [d[0] for d in distances]
-    return top_k
+    if not refs:
+        return []
+    index = similarity.cached_index(refs, lambda: similarity.SimilarityIndex(
+        [ref['emb'] for ref in refs], tags=[ref.get('tag') for ref in refs]
+    ))
+    return [i for i, _ in index.search(emb.ada(query), k, tag)]
 
+def search_index(query: str, index: VectorIndex, k: int = 3, tag=None):
+    """
+    rag_loader が保存したインデックス（vector_index）から類似する行を検索する
+    tag（"crime_prediction_身体に対する罪" など。複数可）を指定するとその行だけから選ぶ
+    戻り値: [{'text', 'tag', 'metadata', 'score'}]（類似度の高い順）
+    """
+    results = []
+    for i, score in index.search(emb.ada(query), k, tag):
+        record = index.record(i)
+        record['score'] = score
+        results.append(record)
+    return results
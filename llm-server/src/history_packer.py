@@ -0,0 +1,203 @@
+"""
+会話履歴のトークン予算内への詰め込み
+
+相談が長くなるとプロンプトに渡す会話履歴が際限なく伸び、レイテンシ・コストが増え、いずれコンテキスト長を超える。
+用途（config.GPT_MODELS のキー）ごとのトークン予算に収まるよう、LLMに渡す直前の履歴を次の順で縮める。
+
+1. 最新以外の深掘り質問（【確認ステップ】）から、毎回繰り返される判明事実・前置きを除き質問だけを残す
+2. 予算を超える場合、新しいメッセージから順に原文のまま残し、それより古いものは要点だけに短縮する
+3. それでも超える場合は、最初のユーザー発話（相談の概要）を優先して残しつつ古いものから落とす
+
+ロール構成はそのまま保つため、呼び出し側は hist と同じ形式で扱える。
+判明事実の台帳（DialogueState.known_facts）を渡した場合は先頭にまとめて置き、
+予算超過時の古いターンは短縮せず台帳で置き換える（最初のユーザー発話は残す）。
+"""
+
+import logging
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import src.config as config
+
+
+CLARIFY_HEADER = re.compile(r"^【確認ステップ[^】]*】")
+NUMBERED_LINE = re.compile(r"^\s*\d+[.．)）]\s*\S")
+OPTIONAL_FOLLOW_UP_MARK = "【任意追加確認】"
+
+# 予算超過時に原文のまま残す最新メッセージの割合（残りを古いメッセージの要約に充てる）
+RECENT_SHARE = 0.7
+OLDER_USER_CHARS = 300  # 古いユーザー発話の短縮後の上限文字数
+OLDER_ASSISTANT_CHARS = 150  # 古い回答の短縮後の上限文字数
+TRUNCATION_MARK = "…（省略）"
+MESSAGE_OVERHEAD_TOKENS = 4  # ロール等の1メッセージあたりの付加トークン
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """tiktokenのエンコーディング（取得できない環境ではNoneを返し、文字数で概算する）"""
+    try:
+        import tiktoken
+    except ImportError:
+        logging.warning("tiktoken is not installed; history tokens are estimated from characters")
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(config.get_model("main"))
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.warning(f"Failed to load tiktoken encoding; history tokens are estimated from characters: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        # 日本語は概ね1文字1トークン前後のため、文字数を上限側の目安として使う
+        return len(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _message_tokens(message: Dict) -> int:
+    return count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + TRUNCATION_MARK
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """先頭と末尾を残して中間を省略し、max_tokens 以内に収める"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    keep = max(max_tokens - count_tokens(TRUNCATION_MARK), 0)
+    encoding = _encoding()
+    if encoding is None:
+        head = keep // 2
+        return text[:head] + TRUNCATION_MARK + text[len(text) - (keep - head):]
+    tokens = encoding.encode(text, disallowed_special=())
+    head = keep // 2
+    return (
+        encoding.decode(tokens[:head]) + TRUNCATION_MARK + encoding.decode(tokens[len(tokens) - (keep - head):])
+    )
+
+
+def strip_clarification_boilerplate(content: str) -> str:
+    """深掘り質問から見出しと番号付きの質問だけを残す（判明事実の一覧や前置きを除く）"""
+    lines = content.splitlines()
+    if not lines or not CLARIFY_HEADER.match(lines[0]):
+        return content
+    questions = [line for line in lines[1:] if NUMBERED_LINE.match(line)]
+    return "\n".join([lines[0]] + questions)
+
+
+def strip_optional_follow_up(content: str) -> str:
+    """回答末尾の任意追加確認から区切り線・注記を除き、質問だけを残す"""
+    if OPTIONAL_FOLLOW_UP_MARK not in content:
+        return content
+    answer, follow_up = content.split(OPTIONAL_FOLLOW_UP_MARK, 1)
+    answer = answer.rstrip().rstrip("=").rstrip()
+    questions = [line for line in follow_up.splitlines() if NUMBERED_LINE.match(line)]
+    return "\n".join([answer, OPTIONAL_FOLLOW_UP_MARK] + questions)
+
+
+def _compress(message: Dict) -> Dict:
+    """古いメッセージを要点だけに短縮する"""
+    content = message.get("content") or ""
+    if message.get("role") == "user":
+        return dict(message, content=_truncate(content, OLDER_USER_CHARS))
+    if CLARIFY_HEADER.match(content):
+        # 質問文は後続のユーザー回答を読むのに必要なため残す
+        return message
+    return dict(message, content=_truncate(content, OLDER_ASSISTANT_CHARS))
+
+
+def known_facts_message(known_facts: Optional[List[str]]) -> Optional[Dict]:
+    """判明事実の台帳をプロンプトに含めるメッセージ（台帳が空ならNone）"""
+    if not known_facts:
+        return None
+    lines = ["【これまでに判明している事実】"] + [f"・{fact}" for fact in known_facts]
+    return {"role": "system", "content": "\n".join(lines)}
+
+
+def get_history_budget(purpose: str) -> int:
+    return config.HISTORY_TOKEN_BUDGETS.get(purpose, config.HISTORY_TOKEN_BUDGETS["main"])
+
+
+def pack_history(
+    hist: List[Dict],
+    purpose: str = "main",
+    budget: Optional[int] = None,
+    known_facts: Optional[List[str]] = None
+) -> List[Dict]:
+    """
+    会話履歴を用途ごとのトークン予算に収める（histは変更せず新しいリストを返す）
+
+    Args:
+        hist: 会話履歴
+        purpose: 呼び出し用途（予算の選択に使う）
+        budget: 予算を直接指定する場合のトークン数
+        known_facts: 判明事実の台帳。指定時は先頭に置き、予算超過時の古いターンの代わりにする
+    """
+    ledger = known_facts_message(known_facts)
+    if not hist:
+        return [ledger] if ledger else []
+    budget = budget if budget is not None else get_history_budget(purpose)
+    if ledger:
+        budget = max(budget - _message_tokens(ledger), 0)
+        return [ledger] + _pack(hist, purpose, budget, replace_older=True)
+    return _pack(hist, purpose, budget, replace_older=False)
+
+
+def _pack(hist: List[Dict], purpose: str, budget: int, replace_older: bool) -> List[Dict]:
+    # 最新の深掘り質問以外は、繰り返される定型部分を除く
+    last_assistant = max((i for i, h in enumerate(hist) if h.get("role") == "assistant"), default=-1)
+    messages = []
+    for i, message in enumerate(hist):
+        content = message.get("content") or ""
+        if message.get("role") == "assistant" and i != last_assistant:
+            content = strip_optional_follow_up(strip_clarification_boilerplate(content))
+        messages.append(dict(message, content=content))
+
+    sizes = [_message_tokens(m) for m in messages]
+    if sum(sizes) <= budget:
+        return messages
+
+    # 新しい側から原文のまま残す範囲を決める（最新メッセージは必ず残す）
+    recent_start = len(messages) - 1
+    used = sizes[-1]
+    while recent_start > 0 and used + sizes[recent_start - 1] <= budget * RECENT_SHARE:
+        recent_start -= 1
+        used += sizes[recent_start]
+
+    older = [_compress(m) for m in messages[:recent_start]]
+    older_sizes = [_message_tokens(m) for m in older]
+
+    # 古い側がまだ予算を超える場合、最初のユーザー発話（相談の概要）を残して古いものから落とす
+    # 判明事実の台帳がある場合は、古いターンは台帳で代替できるため最初のユーザー発話以外を落とす
+    first_user = next((i for i, m in enumerate(older) if m.get("role") == "user"), None)
+    if replace_older:
+        keep = [first_user] if first_user is not None else []
+    else:
+        keep = list(range(len(older)))
+    remaining = budget - used
+    for i in range(len(older)):
+        if sum(older_sizes[j] for j in keep) <= remaining:
+            break
+        if i != first_user and i in keep:
+            keep.remove(i)
+    if first_user is not None and sum(older_sizes[j] for j in keep) > remaining:
+        keep.remove(first_user)
+
+    packed = [older[j] for j in keep] + messages[recent_start:]
+    overflow = sum(_message_tokens(m) for m in packed) - budget
+    if overflow > 0:
+        # 最新メッセージ単体が予算を超える場合は中間を省略する
+        last = packed[-1]
+        packed[-1] = dict(last, content=_truncate_to_tokens(last["content"], count_tokens(last["content"]) - overflow))
+    if len(packed) < len(hist):
+        logging.debug("Packed history for %s: %d -> %d messages", purpose, len(hist), len(packed))
+    return packed
@@ -0,0 +1,366 @@
+"""
+応答タイプ分類・継続判定のローカル高速分類器
+
+文字n-gram（1〜3文字）をハッシュしてNumPyの線形モデル（多クラスロジスティック回帰）で分類します。
+確信度がしきい値以上の入力はローカルで判定し、それ以外はこれまでどおりLLMに問い合わせます。
+
+学習は保存済みの会話（MongoDBのmessages）とlog.txtから行い、ラベルはLLMの判定結果を使います。
+    python -m src.intent_classifier --log log.txt
+"""
+
+import argparse
+import json
+import logging
+import time
+import unicodedata
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import src.config as config
+
+
+RESPONSE_TYPE_TASK = "response_type"
+CONTINUATION_TASK = "continuation"
+TASKS = [RESPONSE_TYPE_TASK, CONTINUATION_TASK]
+
+NGRAM_RANGE = (1, 3)
+HASH_DIM = 2 ** 16
+_HASH_PRIME = np.uint64(1000003)
+LABELS_FILE = "labels.jsonl"
+REPORT_THRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99]
+
+
+def featurize(text: str, dim: int = HASH_DIM) -> Tuple[np.ndarray, np.ndarray]:
+    """文字n-gramをハッシュし、(特徴インデックス, L2正規化済みの重み) を返す"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+
+    # n-gramごとのハッシュを文字コードの多項式としてまとめて計算する（Pythonのループを避ける）
+    hashed = []
+    low, high = NGRAM_RANGE
+    for n in range(low, min(high, len(codes)) + 1):
+        h = np.full(len(codes) - n + 1, n, dtype=np.uint64)
+        for k in range(n):
+            h = h * _HASH_PRIME + codes[k:len(codes) - n + 1 + k]
+        hashed.append(h ^ (h >> np.uint64(29)))
+    if not hashed:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    indices, counts = np.unique(np.concatenate(hashed) % np.uint64(dim), return_counts=True)
+    values = np.log1p(counts).astype(np.float32)
+    values /= np.linalg.norm(values)
+    return indices.astype(np.int64), values
+
+
+def continuation_text(hist: List[Dict]) -> str:
+    """継続判定の入力（最新のユーザー発話）"""
+    for msg in reversed(hist):
+        if msg.get("role") == "user":
+            return msg.get("content", "")
+    return ""
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    exp = np.exp(logits - logits.max())
+    return exp / exp.sum()
+
+
+class IntentClassifier:
+    def __init__(self, labels: List[str], weights: np.ndarray, bias: np.ndarray):
+        self.labels = list(labels)
+        self.weights = weights  # (HASH_DIM, ラベル数)
+        self.bias = bias
+
+    @property
+    def dim(self) -> int:
+        return self.weights.shape[0]
+
+    def predict_proba(self, text: str) -> np.ndarray:
+        indices, values = featurize(text, self.dim)
+        return _softmax(values @ self.weights[indices] + self.bias)
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """(ラベル, 確信度) を返す"""
+        proba = self.predict_proba(text)
+        best = int(proba.argmax())
+        return self.labels[best], float(proba[best])
+
+    @classmethod
+    def train(
+        cls,
+        texts: List[str],
+        labels: List[str],
+        dim: int = HASH_DIM,
+        epochs: int = 30,
+        learning_rate: float = 0.5,
+        seed: int = 0
+    ) -> "IntentClassifier":
+        """確率的勾配降下法で学習する（特徴が疎なため、出現した行だけを更新する）"""
+        label_names = sorted(set(labels))
+        targets = np.array([label_names.index(label) for label in labels])
+        features = [featurize(text, dim) for text in texts]
+
+        weights = np.zeros((dim, len(label_names)), dtype=np.float32)
+        bias = np.zeros(len(label_names), dtype=np.float32)
+        rng = np.random.default_rng(seed)
+
+        for epoch in range(epochs):
+            rate = learning_rate / (1 + epoch * 0.1)
+            for i in rng.permutation(len(features)):
+                indices, values = features[i]
+                proba = _softmax(values @ weights[indices] + bias)
+                proba[targets[i]] -= 1.0
+                weights[indices] -= rate * np.outer(values, proba)
+                bias -= rate * proba
+
+        return cls(label_names, weights, bias)
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, labels=np.array(self.labels))
+
+    @classmethod
+    def load(cls, path: Path) -> "IntentClassifier":
+        with np.load(path) as data:
+            return cls([str(label) for label in data["labels"]], data["weights"], data["bias"])
+
+
+@lru_cache(maxsize=None)
+def get_classifier(task: str) -> Optional[IntentClassifier]:
+    """学習済みモデルを読み込む（無効化されている・未学習の場合はNone）"""
+    if not config.INTENT_CLASSIFIER_ENABLED:
+        return None
+    path = Path(config.INTENT_MODEL_DIR) / f"{task}.npz"
+    if not path.exists():
+        return None
+    try:
+        return IntentClassifier.load(path)
+    except Exception as e:
+        logging.error(f"Failed to load intent classifier {path}: {e}")
+        return None
+
+
+def classify_locally(task: str, text: str) -> Optional[str]:
+    """確信度がしきい値以上ならラベルを、そうでなければNoneを返す（NoneのときはLLMで判定）"""
+    classifier = get_classifier(task)
+    if classifier is None:
+        return None
+    label, confidence = classifier.predict(text)
+    if confidence < config.INTENT_CLASSIFIER_THRESHOLD:
+        return None
+    return label
+
+
+# ---- 学習用 ----
+
+def load_log_exchanges(path: Path) -> List[List[Dict]]:
+    """log.txt を1往復ごとのメッセージ列に分割する"""
+    exchanges = []
+    current = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line == "=" * 50:
+                if current:
+                    exchanges.append(current)
+                current = []
+                continue
+            role, sep, content = line.partition(": ")
+            if sep and role in ("user", "assistant"):
+                current.append({"role": role, "content": content})
+            elif current:
+                current[-1]["content"] += "\n" + line
+    if current:
+        exchanges.append(current)
+
+    for exchange in exchanges:
+        for msg in exchange:
+            msg["content"] = msg["content"].strip()
+    return exchanges
+
+
+def load_mongo_conversations() -> List[List[Dict]]:
+    """MongoDBに保存された会話を時系列順のメッセージ列として読み込む"""
+    from src.database.connection import connect_to_mongo_sync, close_mongo_connection_sync, mongodb
+
+    connect_to_mongo_sync()
+    try:
+        conversations: Dict[str, List[Dict]] = {}
+        for msg in mongodb.sync_database.messages.find({}).sort("created_at", 1):
+            conversations.setdefault(msg["conversation_id"], []).append(
+                {"role": msg["role"], "content": msg["content"]}
+            )
+        return list(conversations.values())
+    finally:
+        close_mongo_connection_sync()
+
+
+def collect_inputs(log_paths: List[Path], use_mongo: bool) -> Dict[str, List]:
+    """
+    分類器の入力を実行時と同じ形で集める
+    - 応答タイプ: ユーザー発話時点までの会話内容を連結したテキスト
+    - 継続判定: 任意追加質問の後で、キーワード判定では決まらないユーザー発話までの履歴
+    """
+    import src.chat as chat
+
+    histories = []
+    for path in log_paths:
+        exchanges = load_log_exchanges(path)
+        # ログは1往復ずつなので、連続する往復を前後の文脈としてつなぐ
+        for prev, exchange in zip([[]] + exchanges[:-1], exchanges):
+            if exchange and exchange[0]["role"] == "user":
+                histories.append(prev[-1:] + exchange[:1])
+    if use_mongo:
+        for messages in load_mongo_conversations():
+            for i, msg in enumerate(messages):
+                if msg["role"] == "user":
+                    histories.append(messages[:i + 1])
+
+    inputs = {RESPONSE_TYPE_TASK: [], CONTINUATION_TASK: []}
+    for hist in histories:
+        inputs[RESPONSE_TYPE_TASK].append('\n'.join(h["content"] for h in hist))
+        if chat._has_optional_questions(hist) and chat._continuation_by_rules(hist) is None:
+            inputs[CONTINUATION_TASK].append(hist)
+    return inputs
+
+
+def llm_label(task: str, item) -> str:
+    """LLMによる正解ラベル（分類器を通さずに問い合わせる）"""
+    import src.chat as chat
+    import src.llm_client as llm
+
+    if task == RESPONSE_TYPE_TASK:
+        return llm.complete_json(chat._classification_messages(item), purpose="classifier")["type"]
+    result = llm.complete_json(chat._continuation_messages(item), purpose="classifier", temperature=0)
+    return "continuation" if result.get("intent") == "continuation" else "new_consultation"
+
+
+def label_inputs(task: str, items: List, labels_path: Path) -> List[Dict]:
+    """
+    LLMでラベル付けする。結果はlabels.jsonlに追記し、再実行時は問い合わせを省く
+    """
+    cached = {}
+    if labels_path.exists():
+        with open(labels_path, "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                cached[(record["task"], record["text"])] = record
+
+    records = []
+    with open(labels_path, "a", encoding="utf-8") as f:
+        for i, item in enumerate(items):
+            text = item if task == RESPONSE_TYPE_TASK else continuation_text(item)
+            record = cached.get((task, text))
+            if record is None:
+                start = time.perf_counter()
+                try:
+                    label = llm_label(task, item)
+                except Exception as e:
+                    logging.error(f"Labeling failed: {e}")
+                    continue
+                record = {"task": task, "text": text, "label": label, "llm_ms": (time.perf_counter() - start) * 1000}
+                cached[(task, text)] = record
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            records.append(record)
+
+            if (i + 1) % 10 == 0:
+                print(f"[{task}] Labeled {i + 1}/{len(items)}")
+    return records
+
+
+def evaluate(classifier: IntentClassifier, records: List[Dict]) -> Dict:
+    """LLMラベルに対する精度と、しきい値ごとのカバー率・精度、推論時間を返す"""
+    confidences, correct, latencies = [], [], []
+    for record in records:
+        start = time.perf_counter()
+        label, confidence = classifier.predict(record["text"])
+        latencies.append((time.perf_counter() - start) * 1000)
+        confidences.append(confidence)
+        correct.append(label == record["label"])
+
+    confidences = np.array(confidences)
+    correct = np.array(correct)
+    thresholds = []
+    for threshold in REPORT_THRESHOLDS:
+        covered = confidences >= threshold
+        thresholds.append({
+            "threshold": threshold,
+            "coverage": float(covered.mean()),
+            "accuracy": float(correct[covered].mean()) if covered.any() else None
+        })
+
+    llm_latencies = [r["llm_ms"] for r in records if r.get("llm_ms")]
+    return {
+        "samples": len(records),
+        "accuracy": float(correct.mean()),
+        "local_ms_mean": float(np.mean(latencies)),
+        "local_ms_p99": float(np.percentile(latencies, 99)),
+        "llm_ms_mean": float(np.mean(llm_latencies)) if llm_latencies else None,
+        "thresholds": thresholds
+    }
+
+
+def _is_test_sample(text: str, test_ratio: float) -> bool:
+    # テキストのハッシュで分割し、再学習しても同じ評価データになるようにする
+    return zlib.crc32(text.encode("utf-8")) % 1000 < test_ratio * 1000
+
+
+def train_task(task: str, records: List[Dict], model_dir: Path, epochs: int, test_ratio: float) -> Optional[Dict]:
+    if len({r["label"] for r in records}) < 2:
+        print(f"[{task}] Not enough labeled data ({len(records)} samples), skipped")
+        return None
+
+    train = [r for r in records if not _is_test_sample(r["text"], test_ratio)]
+    test = [r for r in records if _is_test_sample(r["text"], test_ratio)]
+    report = None
+    if train and test and len({r["label"] for r in train}) >= 2:
+        classifier = IntentClassifier.train([r["text"] for r in train], [r["label"] for r in train], epochs=epochs)
+        report = evaluate(classifier, test)
+
+    # 評価後は全データで学習し直して保存する
+    classifier = IntentClassifier.train([r["text"] for r in records], [r["label"] for r in records], epochs=epochs)
+    classifier.save(model_dir / f"{task}.npz")
+    return report
+
+
+def print_report(task: str, report: Dict):
+    print(f"\n[{task}] test samples: {report['samples']}, accuracy: {report['accuracy']:.3f}")
+    llm_ms = f"{report['llm_ms_mean']:.0f}ms" if report["llm_ms_mean"] is not None else "-"
+    print(f"  latency local: mean {report['local_ms_mean']:.3f}ms / p99 {report['local_ms_p99']:.3f}ms, LLM: mean {llm_ms}")
+    print("  threshold  coverage  accuracy")
+    for row in report["thresholds"]:
+        accuracy = f"{row['accuracy']:.3f}" if row["accuracy"] is not None else "-"
+        print(f"  {row['threshold']:>9.2f}  {row['coverage']:>8.3f}  {accuracy:>8}")
+
+
+def main():
+    """
+    会話ログからLLMラベルを作成して分類器を学習し、評価結果を表示するメイン関数
+    """
+    parser = argparse.ArgumentParser(description="Train the local intent classifier from conversation logs")
+    parser.add_argument("--log", action="append", default=[], help="log.txt のパス（複数指定可）")
+    parser.add_argument("--mongo", action="store_true", help="MongoDBに保存された会話も使う")
+    parser.add_argument("--model-dir", default=config.INTENT_MODEL_DIR)
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--test-ratio", type=float, default=0.2)
+    args = parser.parse_args()
+
+    model_dir = Path(args.model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    inputs = collect_inputs([Path(p) for p in args.log], args.mongo)
+
+    for task in TASKS:
+        records = label_inputs(task, inputs[task], model_dir / LABELS_FILE)
+        report = train_task(task, records, model_dir, args.epochs, args.test_ratio)
+        if report:
+            print_report(task, report)
+
+    print(f"\nModels saved to {model_dir}. Tune INTENT_CLASSIFIER_THRESHOLD with the table above.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+temperature 0 のChat Completions呼び出しの応答キャッシュ
+
+TEMPERATURE_SETTINGS は全て0のため、同じ入力への分類・質問生成・回答は実質的に同じ結果になります。
+再送・再読み込み・比較モードで繰り返される呼び出しを、メモリ上のLRUとSQLiteのディスクキャッシュで省きます。
+キーはモデル・メッセージ・response_format（と温度・ストリーミング有無）のハッシュです。
+ストリーミング応答は受信した断片の列として保存し、ヒット時はそのまま再生します。
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Optional
+
+import src.config as config
+
+
+# ディスクの件数上限チェックを行う書き込み間隔
+EVICT_INTERVAL = 100
+
+
+class LLMCache:
+    def __init__(
+        self,
+        path: str,
+        max_memory_entries: int,
+        max_disk_entries: int,
+        ttl_seconds: float
+    ):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (保存時刻, 値)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._stats = {purpose: {"hits": 0, "misses": 0} for purpose in config.GPT_MODELS}
+
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT, created_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_created_at ON llm_cache (created_at)")
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(request_args: Dict) -> str:
+        payload = {
+            "model": request_args.get("model"),
+            "messages": request_args.get("messages"),
+            "response_format": request_args.get("response_format"),
+            "temperature": request_args.get("temperature"),
+            "stream": bool(request_args.get("stream"))
+        }
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _expired(self, created_at: float) -> bool:
+        return time.time() - created_at > self.ttl_seconds
+
+    def get(self, key: str, purpose: str) -> Optional[str]:
+        """キャッシュを引き、用途ごとのヒット/ミスを記録する"""
+        value = self._get(key)
+        with self._lock:
+            counter = self._stats.setdefault(purpose, {"hits": 0, "misses": 0})
+            counter["hits" if value is not None else "misses"] += 1
+        return value
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._memory.move_to_end(key)
+                    return entry[1]
+                del self._memory[key]
+
+            if self._conn is None:
+                return None
+            try:
+                row = self._conn.execute(
+                    "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logging.error(f"LLM cache read failed: {e}")
+                return None
+            if row is None or self._expired(row[1]):
+                return None
+            self._remember(key, row[0], row[1])
+            return row[0]
+
+    def set(self, key: str, value: str):
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, value, created_at)
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, value, created_at)
+                )
+                self._writes += 1
+                if self._writes % EVICT_INTERVAL == 0:
+                    self._evict_disk()
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"LLM cache write failed: {e}")
+
+    def _remember(self, key: str, value: str, created_at: float):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        """期限切れの行と、件数上限を超えた古い行を削除する"""
+        self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        self._conn.execute(
+            "DELETE FROM llm_cache WHERE key IN ("
+            "SELECT key FROM llm_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,)
+        )
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {purpose: dict(counter) for purpose, counter in self._stats.items()}
+
+
+@lru_cache(maxsize=1)
+def get_llm_cache() -> Optional[LLMCache]:
+    """キャッシュのシングルトン（無効化されている場合はNone）"""
+    if not config.LLM_CACHE_ENABLED:
+        return None
+    return LLMCache(
+        path=config.LLM_CACHE_PATH,
+        max_memory_entries=config.LLM_CACHE_MAX_MEMORY_ENTRIES,
+        max_disk_entries=config.LLM_CACHE_MAX_DISK_ENTRIES,
+        ttl_seconds=config.LLM_CACHE_TTL_SECONDS
+    )
+
+
+def get_cache_stats() -> Dict[str, Dict[str, int]]:
+    cache = get_llm_cache()
+    return cache.get_stats() if cache is not None else {}
@@ -0,0 +1,173 @@
+"""
+Chat Completions呼び出しの共通ヘルパー
+
+同期版は既存のジェネレータ実装（テストスクリプトや比較モード）用、
+非同期版はWebSocketのイベントループをブロックしないための実装です。
+プロンプトの組み立ては呼び出し側で行い、ここではAPI呼び出しのみを扱います。
+temperature 0 の呼び出しは llm_cache で応答をキャッシュします（非同期版のキャッシュの読み書きはスレッドで行います）。
+"""
+
+import asyncio
+import json
+from typing import AsyncGenerator, Dict, Generator, Iterable, List, Optional
+
+import src.config as config
+from src.llm_cache import get_llm_cache
+
+
+def _request_args(
+    messages: List[Dict],
+    purpose: str,
+    temperature: Optional[float],
+    json_mode: bool,
+    response_format: Optional[Dict] = None
+) -> Dict:
+    args = {
+        "model": config.get_model(purpose),
+        "temperature": config.get_temperature(purpose) if temperature is None else temperature,
+        "messages": messages
+    }
+    if json_mode:
+        args["response_format"] = response_format or config.SETTINGS["response_format_json"]
+    return args
+
+
+def _cache_for(args: Dict):
+    """キャッシュ対象の呼び出しなら (キャッシュ, キー) を、対象外なら (None, None) を返す"""
+    cache = get_llm_cache()
+    if cache is None or args["temperature"] != 0:
+        return None, None
+    return cache, cache.make_key(args)
+
+
+def _chunk_text(chunk) -> Optional[str]:
+    if not chunk or not chunk.choices:
+        return None
+    return chunk.choices[0].delta.content
+
+
+def complete_json(
+    messages: List[Dict],
+    purpose: str = "main",
+    temperature: Optional[float] = None,
+    response_format: Optional[Dict] = None
+) -> Dict:
+    """
+    JSONモードで1回だけ問い合わせ、パース済みの結果を返す
+    response_format を指定した場合（json_schema による構造化出力など）はJSONモードの代わりに使う
+    """
+    args = _request_args(messages, purpose, temperature, json_mode=True, response_format=response_format)
+    cache, key = _cache_for(args)
+    if cache is not None:
+        cached = cache.get(key, purpose)
+        if cached is not None:
+            return json.loads(cached)
+
+    client = config.get_openai_client()
+    resp = client.chat.completions.create(**args)
+    content = resp.choices[0].message.content
+    result = json.loads(content)
+    if cache is not None:
+        cache.set(key, content)
+    return result
+
+
+def stream_text(
+    messages: List[Dict],
+    purpose: str = "streaming",
+    temperature: Optional[float] = None
+) -> Generator[str, None, None]:
+    """
+    ストリーミングで問い合わせ、テキスト断片を順に返す
+    キャッシュ済みなら保存した断片を再生する（最後まで受信できた応答のみ保存）
+    """
+    args = _request_args(messages, purpose, temperature, json_mode=False)
+    args["stream"] = True
+    cache, key = _cache_for(args)
+    if cache is not None:
+        cached = cache.get(key, purpose)
+        if cached is not None:
+            yield from json.loads(cached)
+            return
+
+    client = config.get_openai_client()
+    resp = client.chat.completions.create(**args)
+    chunks = []
+    try:
+        for chunk in resp:
+            content = _chunk_text(chunk)
+            if content:
+                chunks.append(content)
+                yield content
+    finally:
+        resp.close()
+    if cache is not None:
+        cache.set(key, json.dumps(chunks, ensure_ascii=False))
+
+
+async def acomplete_json(
+    messages: List[Dict],
+    purpose: str = "main",
+    temperature: Optional[float] = None,
+    response_format: Optional[Dict] = None
+) -> Dict:
+    """complete_json の非同期版"""
+    args = _request_args(messages, purpose, temperature, json_mode=True, response_format=response_format)
+    cache, key = _cache_for(args)
+    if cache is not None:
+        cached = await asyncio.to_thread(cache.get, key, purpose)
+        if cached is not None:
+            return json.loads(cached)
+
+    client = config.get_async_openai_client()
+    resp = await client.chat.completions.create(**args)
+    content = resp.choices[0].message.content
+    result = json.loads(content)
+    if cache is not None:
+        await asyncio.to_thread(cache.set, key, content)
+    return result
+
+
+async def astream_text(
+    messages: List[Dict],
+    purpose: str = "streaming",
+    temperature: Optional[float] = None
+) -> AsyncGenerator[str, None]:
+    """stream_text の非同期版。途中で閉じられた場合は上流のストリームも閉じる"""
+    args = _request_args(messages, purpose, temperature, json_mode=False)
+    args["stream"] = True
+    cache, key = _cache_for(args)
+    if cache is not None:
+        cached = await asyncio.to_thread(cache.get, key, purpose)
+        if cached is not None:
+            for content in json.loads(cached):
+                yield content
+            return
+
+    client = config.get_async_openai_client()
+    resp = await client.chat.completions.create(**args)
+    chunks = []
+    try:
+        async for chunk in resp:
+            content = _chunk_text(chunk)
+            if content:
+                chunks.append(content)
+                yield content
+    finally:
+        await resp.close()
+    if cache is not None:
+        await asyncio.to_thread(cache.set, key, json.dumps(chunks, ensure_ascii=False))
+
+
+async def iterate_in_thread(iterable: Iterable[str]) -> AsyncGenerator[str, None]:
+    """
+    同期ジェネレータをワーカースレッドで1要素ずつ進める
+    （Assistants APIなど非同期版がない処理でイベントループを止めないため）
+    """
+    iterator = iter(iterable)
+    sentinel = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, sentinel)
+        if item is sentinel:
+            break
+        yield item
@@ -15,6 +15,12 @@ from src.database.connection import (
     connect_to_mongo, close_mongo_connection, init_indexes, get_database
 )
 from src.database.models import MessageModel, ConversationModel
+from src.dialogue_state import DialogueState, METADATA_KEY
+from src.embedding import get_embedding_stats
+from src.llm_cache import get_cache_stats
+from src.semantic_cache import get_semantic_cache_stats
+from src.table_prompt import get_token_report
+from src.table_registry import current_tables, get_table_registry, warm
 from src.api import session_routes, conversation_routes, websocket_routes, oauth_routes
 from src.auth.authentication import decode_token
 from datetime import datetime
@@ -42,6 +48,9 @@ async def lifespan(app: FastAPI):
         import traceback
         traceback.print_exc()
 
+    # 最初のリクエストでシートの整形を待たせないよう、起動時に作っておく
+    warm(current_tables())
+
     yield
 
     # Shutdown
@@ -77,6 +86,34 @@ class LLMResponse(BaseModel):
 def healthcheck():
     return {}
 
+@app.get("/llm_cache/stats")
+def llm_cache_stats():
+    """用途ごとのLLM応答キャッシュのヒット/ミス数"""
+    return get_cache_stats()
+
+
+@app.get("/embedding/stats")
+def embedding_stats():
+    """embeddingキャッシュのヒット率とAPI呼び出し回数（まとめて送った件数）"""
+    return get_embedding_stats()
+
+
+@app.get("/semantic_cache/stats")
+def semantic_cache_stats():
+    """意味キャッシュのヒット率と、省けた生成時間・文字数"""
+    return get_semantic_cache_stats()
+
+
+@app.get("/table_prompt/stats")
+def table_prompt_stats():
+    """罪名予測テーブル・ヒアリング項目のコンパクト表現で減ったトークン数（シートごと）"""
+    return get_token_report()
+
+@app.get("/tables/stats")
+def table_registry_stats():
+    """罪名予測テーブル・量刑予測ヒアリングシートの読み込み状況（バージョン・読み込み時刻・シート数）"""
+    return get_table_registry().stats()
+
 # Include routers for authentication and conversations
 app.include_router(session_routes.router)
 app.include_router(oauth_routes.router)
@@ -95,6 +132,8 @@ async def websocket_endpoint(ws: WebSocket, token: Optional[str] = Query(None)):
     # Optional: Authenticate user if token is provided
     user_id = None
     conversation_id = None
+    # 接続中の対話状態（認証済みの場合は会話のmetadataにも保存）
+    dialogue_state = DialogueState()
 
     # メッセージ処理用のロックを作成
     processing_lock = asyncio.Lock()
@@ -167,19 +206,14 @@ async def websocket_endpoint(ws: WebSocket, token: Optional[str] = Query(None)):
                         )
                         await db.messages.insert_one(user_msg.model_dump(by_alias=True))
 
-                rep = c.reply(acc, genre=genre, use_rag=use_rag)
                 response_text = ""
 
                 await ws.send_json({'text': '<start>'})
 
-                # repがジェネレータの場合とそうでない場合を区別
-                if isinstance(rep, str):
-                    response_text += rep
-                    await ws.send_json({'text': rep})
-                else:
-                    for x in rep:
-                        response_text += x
-                        await ws.send_json({'text': x})
+                # LLM呼び出しは全て非同期で行い、他の接続の処理を止めない
+                async for x in c.reply_async(acc, genre=genre, use_rag=use_rag, state=dialogue_state):
+                    response_text += x
+                    await ws.send_json({'text': x})
 
                 await ws.send_json({'text': '<end>'})
 
@@ -194,10 +228,13 @@ async def websocket_endpoint(ws: WebSocket, token: Optional[str] = Query(None)):
                         )
                         await db.messages.insert_one(assistant_msg.model_dump(by_alias=True))
 
-                        # Update conversation's updated_at
+                        # Update conversation's updated_at and dialogue state
                         await db.conversations.update_one(
                             {"_id": conv_model.id},
-                            {"$set": {"updated_at": datetime.utcnow()}}
+                            {"$set": {
+                                "updated_at": datetime.utcnow(),
+                                f"metadata.{METADATA_KEY}": dialogue_state.model_dump()
+                            }}
                         )
 
                 acc.append({"role": "assistant", "content": response_text})
@@ -1,10 +1,8 @@
 # 罪名予測
 
 import os, sys
-import csv
 import re
 import logging
-from pathlib import Path
 from importlib import reload
 
 import numpy as np
@@ -12,37 +10,27 @@ from tqdm import tqdm_notebook as tqdm
 
 import src.gen.chat as chat
 import src.config as config
+import src.llm_client as llm
 from src.rag_manager import get_rag_manager
+from src.history_packer import pack_history
+from src.crime_table_index import BIG_CATEGORY
+from src.question_selector import mentioned
+from src.table_registry import current_tables, on_reload
+import src.table_prompt as table_prompt
 
 
 
-raw_dir = Path("dataset/raw")
+def get_crime_map(snapshot=None):
+    """参照シート名 → シートのCSV（大分類を除く）"""
+    return (snapshot or current_tables()).crime_sheets
 
-def read_csv(path):
-    with open(path, 'r') as file:
-        reader = csv.reader(file)
-        lines = []
-        for row in reader:
-            lines.append(','.join(row))
-        text = '\n'.join(lines)
-        return text
 
-def make_crime_dict():
-    targets = ["身体に対する罪","交通に対する罪","居住に対する罪", "偽造に対する罪", "財産に対する罪","名誉に対する罪",
-               "自由に対する罪","公共の安全に対する罪","性に対する罪","風俗に対する罪", "国家の作用に対する罪","薬物犯罪",
-               "内乱・外患・国交に関する罪","軽犯罪法","ストーカー規制法", "組織犯罪・犯罪収益", "不正アクセス", "日常生活に関する罪"]
-    d = {}
-    for target in targets:
-        filename = '罪名予測テーブル_' + target +'.csv'
-        d[target] = read_csv(raw_dir / filename)
-    return d
-    
-    
-topics_csv = read_csv(raw_dir / '罪名予測テーブル_大分類.csv')
+def get_topics_csv(snapshot=None):
+    """大分類シートのCSV"""
+    return (snapshot or current_tables()).topics_csv
 
-crime_map = make_crime_dict()
 
-macro_inst = """
+MACRO_INST = """
 あなたは弁護士の代わりに相談者から情報を取得するチャットボットです。
 相談者から入力があった場合に、相談者の発話の中から情報を取得し、以下の大分類シートを活用して参照シート名を１つまでに特定してください。
 また、特定できない場合は、大分類シートの情報を使用して深掘り質問を相談者に行ってください。
@@ -54,32 +42,276 @@ macro_inst = """
 また回答や質問は相談者に提示する範囲のみとし、途中の思考経路は表示しないようにしてください。
 
 # 大分類シート
-""" + topics_csv
-
-
-def gen(inst, hist):
-    client = config.get_openai_client()
-    resp = client.chat.completions.create(
-        model=config.get_model("main"),
-        temperature=config.get_temperature("main"),
-        stream=True,
-        messages=[{"role": "system", "content": inst}] + hist)
-    #return response["choices"][0]["message"]["content"]
-    response_text = ""
-    for chunk in resp:
-        if chunk:
-            content = chunk.choices[0].delta.content
-            if content:
-                response_text += content
-                yield content
+"""
+
+
+def make_macro_inst(snapshot=None):
+    """MOVE形式で参照シートを判定する指示（大分類シートは現在のテーブルのもの）"""
+    return MACRO_INST + get_topics_csv(snapshot)
+
+
+# 大分類シートの判断基準（列）ごとに、会話中に現れれば該当とみなす語
+CRITERION_KEYWORDS = {
+    "身体や生命に関わるか": ["殴", "蹴", "暴行", "暴力", "怪我", "けが", "負傷", "骨折", "打撲", "死亡", "殺", "傷害"],
+    "運転していたか": ["運転", "自動車", "乗用車", "バイク", "原付", "交通事故", "ひき逃げ", "轢", "飲酒運転", "スピード違反"],
+    # 「お金」「金銭」は示談金・離婚の話など財産犯以外の相談にも現れるため含めない
+    "他人の財産や利益か": ["盗", "万引き", "窃盗", "財布", "横領", "損害", "壊し", "器物"],
+    "無断で建物や私有地に入ったか": ["侵入", "忍び込", "無断で入", "勝手に入"],
+    "本人の許可なく偽造したか": ["偽造", "改ざん", "改竄", "変造"],
+    "他人を欺いたか": ["騙", "だまし", "だまさ", "詐欺", "なりすま"],
+    "他人の社会的評価を損ねたか": ["名誉毀損", "誹謗", "中傷", "侮辱", "晒"],
+    "他人の自由を奪ったか": ["監禁", "拘束", "脅迫", "脅し", "脅さ", "誘拐", "連れ去", "強要"],
+    "公共の危険を生じさせたか": ["放火", "火をつけ", "火を付け", "爆発", "燃や"],
+    "わいせつな行為や性行為をしたか": ["わいせつ", "痴漢", "盗撮", "性行為", "性的", "性交"],
+    "労働や性、死者への敬意などの善良な風俗を害したか": ["賭博", "売春", "死体"],
+    "司法、行政などの国家の作用を妨害したか": ["公務執行妨害", "偽証", "証拠隠滅", "犯人隠避", "逃走"],
+    "公務などの国家の作用への信頼を損ねたか": ["賄賂", "収賄", "贈賄", "汚職"],
+    "違法薬物か": ["覚せい剤", "覚醒剤", "大麻", "麻薬", "薬物", "MDMA", "コカイン"],
+}
+
+
+# 参照シート内の候補がこの件数以下に絞れた場合は、その行だけをプロンプトに含める
+NARROW_MAX_CANDIDATES = 3
+
+
+def load_big_category_matrix(snapshot):
+    """大分類シートを {参照シート名: ◯がついた判断基準の集合} に変換する（参照シートがない行は除く）"""
+    table = snapshot.crime_tables.get(BIG_CATEGORY)
+    if table is None:
+        return {}
+    crime_map = get_crime_map(snapshot)
+    return {sheet: set(table.marked_criteria(sheet)) for sheet in table.crimes if sheet in crime_map}
+
+
+def get_big_category_matrix(snapshot=None):
+    """大分類シートの◯行列（スナップショットごとにキャッシュ）"""
+    return (snapshot or current_tables()).memo("big_category_matrix", load_big_category_matrix)
+
+
+def extract_criteria(texts):
+    """会話（判明事実・ユーザー発話）から該当する大分類の判断基準を取り出す"""
+    text = '\n'.join(texts)
+    found = set()
+    for criterion, keywords in CRITERION_KEYWORDS.items():
+        if any(mentioned(text, keyword) for keyword in keywords):
+            found.add(criterion)
+    return found
+
+
+def _conversation_texts(hist, known_facts=None):
+    return list(known_facts or []) + [h['content'] for h in hist if h.get('role') == 'user']
+
+
+def _compile_full_sheet(sheet):
+    def compile_sheet(snapshot):
+        csv_text = get_crime_map(snapshot)[sheet]
+        compact = table_prompt.compiled_sheet(sheet, snapshot)
+        if compact is None:
+            return csv_text, False
+        if table_prompt.record_savings(sheet, csv_text, compact)['saved_tokens'] <= 0:
+            return csv_text, False
+        return compact, True
+    return compile_sheet
+
+
+def full_sheet(sheet, snapshot=None):
+    """
+    参照シート全体を (表現, コンパクト表現か) で返す
+    コンパクト表現（table_prompt）が無効・作れない・元のCSVより短くならないシートは元のCSVを返す
+    """
+    snapshot = snapshot or current_tables()
+    if not config.COMPACT_TABLE_PROMPT_ENABLED:
+        return get_crime_map(snapshot)[sheet], False
+    return snapshot.memo(("full_sheet", sheet), _compile_full_sheet(sheet))
+
+
+@on_reload
+def _warm_sheets(snapshot):
+    """シートのコンパクト表現と大分類の◯行列を、スナップショットの差し替え前に作っておく"""
+    get_big_category_matrix(snapshot)
+    for sheet in get_crime_map(snapshot):
+        full_sheet(sheet, snapshot)
+
+
+def sheet_table(sheet, answers):
+    """
+    参照シートのうち、判断基準への回答（基準名 → はい/いいえ）と矛盾しない行だけを (表現, コンパクト表現か) で返す
+    候補が NARROW_MAX_CANDIDATES 件以下に絞れない・回答が表と矛盾する場合はシート全体を返す
+    """
+    snapshot = current_tables()
+    table = snapshot.crime_tables.get(sheet)
+    if table is None or not answers:
+        return full_sheet(sheet, snapshot)
+    narrowed = table.narrow(answers)
+    if narrowed['mismatches'] or not 0 < len(narrowed['candidates']) <= NARROW_MAX_CANDIDATES:
+        return full_sheet(sheet, snapshot)
+    print(f"＞候補を絞り込み: {', '.join(narrowed['candidates'])}")
+    if config.COMPACT_TABLE_PROMPT_ENABLED:
+        return table_prompt.compile_table(table, narrowed['candidates']), True
+    return table.render(narrowed['candidates']), False
+
+
+def pre_route(hist, known_facts=None, big_category=None):
+    """
+    大分類シートの◯行列だけで参照シートを決める（一意に決まらなければNone）
+    深掘り分析で選ばれた大分類があればそれを使い、なければ該当した判断基準を全て◯に持つ行がちょうど1つで、
+    かつ他の行がどの判断基準にも該当しない場合だけその行を選ぶ（それ以外はルーターに任せる）
+    """
+    snapshot = current_tables()
+    if big_category in get_crime_map(snapshot):
+        return big_category
+
+    criteria = extract_criteria(_conversation_texts(hist, known_facts))
+    if not criteria:
+        return None
+
+    matrix = get_big_category_matrix(snapshot)
+    consistent = [sheet for sheet, marks in matrix.items() if criteria <= marks]
+    matching = [sheet for sheet, marks in matrix.items() if marks & criteria]
+    if len(consistent) == 1 and matching == consistent:
+        return consistent[0]
+    return None
+
+
+ROUTER_INST = """
+あなたは弁護士の代わりに相談者から情報を取得するチャットボットです。
+相談者の発話の中から情報を取得し、以下の大分類シートを活用して参照シート名を１つまでに特定してください。
+大分類シートは２列目移行に判断基準が記載されおり、◯が該当している場合は行の特定ができるようになっています。
+特定できた場合は sheet に参照シート名を、message に空文字を出力してください。
+特定できない場合は sheet を null とし、message に相談者へ提示する文章を出力してください。
+その文章では、大分類シートの２列目移行のヒアリング項目の表現を使って深掘り質問を行うか、現時点で最も可能性の高い候補と不足している情報を簡潔にまとめてください。
+途中の思考経路は表示しないようにしてください。
+
+# 大分類シート
+"""
+
+
+def _router_messages(hist, known_facts=None):
+    inst = ROUTER_INST + get_topics_csv()
+    return [{"role": "system", "content": inst}] + pack_history(hist, "classifier", known_facts=known_facts)
+
+
+def router_response_format(snapshot=None):
+    """参照シート名を列挙型に限定した構造化出力（シート名は現在のテーブルのもの）"""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "crime_sheet_route",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "sheet": {"type": ["string", "null"], "enum": list(get_crime_map(snapshot)) + [None]},
+                    "message": {"type": "string"}
+                },
+                "required": ["sheet", "message"],
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+def _validate_route(result):
+    """ルーターの出力を (参照シート名 or None, 相談者への文章) にする。使えない場合はNone"""
+    if not isinstance(result, dict):
+        return None
+    sheet = result.get('sheet')
+    message = result.get('message') or ''
+    if sheet in get_crime_map():
+        return sheet, message
+    if sheet is None and message.strip():
+        return None, message
+    return None
+
+
+def _route_from_text(dicision):
+    """従来のMOVE形式の出力から (参照シート名 or None, 相談者への文章) を取り出す"""
+    if "MOVE{" not in dicision:
+        print("does not move")
+        return None, dicision
+    move_to = dicision.split("MOVE{")[1].split("}")[0].strip()
+    if move_to not in get_crime_map():
+        logging.warning("Unknown MOVE target received: %s", move_to)
+        return None, dicision
+    return move_to, ''
+
+
+def route(hist, known_facts=None, big_category=None):
+    """
+    参照シートを決める
+    ◯行列で一意に決まればLLMを呼ばず、決まらなければ構造化出力のルーターに問い合わせる
+    （ルーターが失敗した場合は従来のMOVE形式の生成で判定する）
+    """
+    sheet = pre_route(hist, known_facts, big_category)
+    if sheet is not None:
+        print(f"＞大分類シートで参照シートを特定: {sheet}")
+        return sheet, ''
+
+    try:
+        routed = _validate_route(llm.complete_json(
+            _router_messages(hist, known_facts), purpose="classifier", response_format=router_response_format()
+        ))
+    except Exception as e:
+        logging.error(f"Crime sheet routing failed: {e}")
+        routed = None
+    if routed is not None:
+        return routed
+    return _route_from_text(''.join(gen(make_macro_inst(), hist, known_facts)))
+
+
+async def route_async(hist, known_facts=None, big_category=None):
+    """route の非同期版"""
+    sheet = pre_route(hist, known_facts, big_category)
+    if sheet is not None:
+        print(f"＞大分類シートで参照シートを特定: {sheet}")
+        return sheet, ''
+
+    try:
+        routed = _validate_route(await llm.acomplete_json(
+            _router_messages(hist, known_facts), purpose="classifier", response_format=router_response_format()
+        ))
+    except Exception as e:
+        logging.error(f"Crime sheet routing failed: {e}")
+        routed = None
+    if routed is not None:
+        return routed
+    return _route_from_text(''.join([content async for content in gen_async(make_macro_inst(), hist, known_facts)]))
+
+
+def gen(inst, hist, known_facts=None):
+    messages = [{"role": "system", "content": inst}] + pack_history(hist, "main", known_facts=known_facts)
+    for content in llm.stream_text(messages, purpose="main"):
+        yield content
+
+
+async def gen_async(inst, hist, known_facts=None):
+    """gen の非同期版"""
+    messages = [{"role": "system", "content": inst}] + pack_history(hist, "main", known_facts=known_facts)
+    async for content in llm.astream_text(messages, purpose="main"):
+        yield content
 
         
-def make_inst(sheet_name, csv):
+# シートの形式の説明と、深掘り質問で使う判断基準の所在（元のCSV / コンパクト表現）
+SHEET_FORMATS = {
+    False: (
+        "シートはcsv形式のファイルとなっており、２列目移行に判断基準が記載され、その列に判断基準において◯がついている罪名に関しては候補になります。",
+        "２列目移行の判断基準"
+    ),
+    True: (
+        "シートは罪名ごとに◯がついている判断基準を列挙したものです。複数の罪名に共通する判断基準は番号で示し、"
+        "番号の意味は冒頭の判断基準一覧にあります。判断基準に該当する罪名が候補になります。",
+        "判断基準（番号の場合は判断基準一覧の文言）"
+    )
+}
+
+
+def make_inst(sheet_name, csv, compact=False):
+    sheet_format, criteria_label = SHEET_FORMATS[compact]
     inst = """あなたは弁護士の代わりに相談者から情報を取得するチャットボットです。
 相談者から入力があった場合に、相談者の発話の中から情報を取得し、以下のシートを活用して罪名の候補を3個以下になるように絞ってください。
-シートはcsv形式のファイルとなっており、２列目移行に判断基準が記載され、その列に判断基準において◯がついている罪名に関しては候補になります。
+""" + sheet_format + """
 相談者の発言から特定が十分にできていない場合は、相談者に深掘り質問を提示してください。
-深掘り質問を行う場合には、必ず２列目移行の判断基準の表現を1つ以上使用してください。
+深掘り質問を行う場合には、必ず""" + criteria_label + """の表現を1つ以上使用してください。
 罪名の候補が3個以下になったら、関連する罪名をすべて列挙して教えてください。
 必要な情報が不足している場合でも、現時点で判明している事実と不足している判断要素を整理し、追加確認事項を明示してください。
 事件概要から罪名が該当した理由は含めないでください。
@@ -89,7 +321,16 @@ def make_inst(sheet_name, csv):
     
     return inst
 
-def answer(hist, add_optional_questions=True, use_rag=False):
+def _criteria_answers(hist, known_facts, criteria_answers):
+    """会話から読み取れた判断基準（該当＝はい）に、明示的な回答を重ねる"""
+    answers = {criterion: True for criterion in extract_criteria(_conversation_texts(hist, known_facts))}
+    answers.update(criteria_answers or {})
+    return answers
+
+
+def answer(
+    hist, add_optional_questions=True, use_rag=False, known_facts=None, big_category=None, criteria_answers=None
+):
     """
     罪名予測を実行
 
@@ -97,20 +338,27 @@ def answer(hist, add_optional_questions=True, use_rag=False):
         hist: 会話履歴
         add_optional_questions: 任意の追加質問を付与するか（未使用、互換性のため）
         use_rag: RAGを使用するか
+        known_facts: 判明事実の台帳（DialogueState.known_facts）
+        big_category: 深掘り分析で選ばれた罪名大分類（DialogueState.big_category）
+        criteria_answers: 判断基準への回答（基準名 → はい/いいえ）。参照シートの候補の絞り込みに使う
     """
     # RAGを使用する場合
     if use_rag and config.is_rag_enabled():
         try:
             # 会話履歴からユーザーのテキストを結合
-            incident_text = '\n'.join([h['content'] for h in hist if h.get('role') == 'user'])
+            incident_text = '\n'.join([h['content'] for h in pack_history(hist, "main") if h.get('role') == 'user'])
 
-            rag_manager = get_rag_manager()
-            result = rag_manager.predict_crime_with_rag(incident_text)
+            # 最初の断片が届くまでに失敗した場合は通常モードにフォールバックする
+            stream = get_rag_manager().stream_crime_with_rag(incident_text)
+            first = next(stream)
 
-            # ジェネレータとして返す
             def rag_generator():
                 yield "【罪名予測（RAG）】\n"
-                yield result
+                yield first
+                try:
+                    yield from stream
+                except Exception as e:
+                    logging.error(f"RAG crime prediction interrupted: {e}")
 
             return rag_generator()
 
@@ -118,21 +366,47 @@ def answer(hist, add_optional_questions=True, use_rag=False):
             logging.error(f"RAG crime prediction failed: {e}")
             # エラー時は通常モードにフォールバック
 
-    # 通常モード（既存の実装）
-    dicision = ''.join(gen(macro_inst, hist))
-    print(dicision)
-    if not "MOVE" in dicision:
-        print("does not move")
-        return dicision
-    else:
-        move_to = dicision.split("MOVE{")[1].split("}")[0].strip()
-        target_csv = crime_map.get(move_to)
-        if target_csv is None:
-            logging.warning("Unknown MOVE target received: %s", move_to)
-            return dicision
-        inst = make_inst(move_to, target_csv)
-        result = gen(inst, hist)
-        return result
+    # 通常モード：参照シートを特定してから、そのシートで罪名を予測する
+    sheet, message = route(hist, known_facts, big_category)
+    if sheet is None:
+        return message
+    inst = make_inst(sheet, *sheet_table(sheet, _criteria_answers(hist, known_facts, criteria_answers)))
+    return gen(inst, hist, known_facts)
+
+
+
+async def answer_async(
+    hist, add_optional_questions=True, use_rag=False, known_facts=None, big_category=None, criteria_answers=None
+):
+    """answer の非同期版（応答を断片ごとに返す非同期ジェネレータ）"""
+    if use_rag and config.is_rag_enabled():
+        started = False
+        try:
+            incident_text = '\n'.join([h['content'] for h in pack_history(hist, "main") if h.get('role') == 'user'])
+
+            # Assistants APIは同期クライアントのため、ストリームをワーカースレッドで1断片ずつ進める
+            async for content in llm.iterate_in_thread(get_rag_manager().stream_crime_with_rag(incident_text)):
+                if not started:
+                    started = True
+                    yield "【罪名予測（RAG）】\n"
+                yield content
+            if started:
+                return
+
+        except Exception as e:
+            logging.error(f"RAG crime prediction failed: {e}")
+            # 途中まで返した場合はフォールバックしない
+            if started:
+                return
+
+    sheet, message = await route_async(hist, known_facts, big_category)
+    if sheet is None:
+        yield message
+        return
+
+    inst = make_inst(sheet, *sheet_table(sheet, _criteria_answers(hist, known_facts, criteria_answers)))
+    async for content in gen_async(inst, hist, known_facts):
+        yield content
 
 
 sample_t="""
@@ -0,0 +1,303 @@
+"""
+深掘り質問のローカル選択
+
+大分類（参照シート）が決まった後の深掘りラウンドでは、LLMに質問を選ばせず、
+罪名予測テーブルの◯行列と量刑予測ヒアリングシートの項目から質問を選ぶ。
+
+- 罪名: 残っている候補の罪名を最もよく分ける判断基準を、情報利得（候補を一様とみなした分割のエントロピー）の
+  大きい順に貪欲に選ぶ。複数の質問を同時に出すため、既に選んだ基準との組み合わせで増える利得を比較する
+- 量刑: ヒアリングシートの項目のうち、量刑への影響が大きい項目を重要度順に選ぶ（判明済み・質問済みは除く）
+
+質問文は RAGデータと同じ定型（question_templates）で作る。
+前回のラウンドで尋ねた判断基準への回答は、番号付きの回答から はい/いいえ を読み取って絞り込みに使う。
+相談文・判明事実で既に述べられている判断基準（「骨折させた」→ 怪我をさせたか など）は、尋ねずに回答済みとして扱う。
+"""
+
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from src.crime_table_index import BIG_CATEGORY, CrimeTable, get_crime_tables
+from src.dialogue_state import fact_key
+from src.question_templates import format_question_for_crime, format_question_for_sentencing
+
+
+# 候補の罪名がこの件数以下になれば罪名についての質問を終える（predict_crime_type.NARROW_MAX_CANDIDATES と同じ）
+TARGET_CANDIDATES = 3
+
+# 量刑予測ヒアリングシートの項目の重要度（深掘りの評価ルールの 5: 量刑に直結 / 4: 判断に大きく影響 に対応）
+# 重要度3以下（年齢・社会的影響など）は深掘りでは尋ねない
+SENTENCING_IMPORTANCE = [
+    (5, ("前科", "示談", "被害金額", "被害内容", "被害の程度", "治療期間")),
+    (4, ("被害感情", "態様", "動機", "経緯", "計画", "常習", "犯行後の情状")),
+]
+SENTENCING_SKIP_COLUMNS = ("ID（通し番号）", "罪名")
+# 罪名と量刑の両方を尋ねるラウンドで量刑の項目に残す質問数
+SENTENCING_RESERVED = 2
+
+# 相談文・判明事実の語から回答を補える判断基準（基準名に含まれる語, 該当を示す語）
+CRITERION_HINTS = [
+    (("怪我をさせたか", "負傷させたか"), ("怪我", "けが", "ケガ", "負傷", "骨折", "打撲", "出血", "捻挫", "全治", "傷害")),
+    (("死亡したか", "死亡させたか"), ("死亡", "亡くな", "死なせ", "死ん")),
+    (("有形力を行使したか",), ("殴", "蹴", "叩", "暴行", "突き飛ば", "押し倒")),
+    (("酒気を帯びていたか",), ("飲酒", "酒を飲", "お酒")),
+    (("無免許だったか",), ("無免許",)),
+    (("現場を離れたか",), ("ひき逃げ", "轢き逃げ", "当て逃げ", "立ち去")),
+    (("運転していたか",), ("運転",)),
+    (("人を騙したか",), ("騙", "だまし", "だまさ", "詐欺")),
+]
+# 語の直後にこれが続く場合は否定（「怪我はありません」など）として数えない
+NEGATION = re.compile(r"^.{0,4}(なし|無し|ない|ありません|していません|しておらず)")
+
+ANSWER_LINE = re.compile(r"^\s*(\d+)\s*(?:[.．)）:：、]|\s)\s*(.*)$")
+UNKNOWN_ANSWER = re.compile(r"わから|分から|不明|覚えて")
+# 回答の冒頭の はい/いいえ は本文より優先する（「はい、ありません」は はい）
+LEADING_YES = re.compile(r"^(はい|yes\b)")
+LEADING_NO = re.compile(r"^(いいえ|no\b)")
+# 謝罪・丁寧語の「ません」は否定として数えない
+POLITENESS = re.compile(r"すみません|すいません|申し訳(?:ありません|ございません|ない)")
+# 長い表現から先に一致させ、否定の部分を除いてから YES_ANSWER を探す（「していない」の「し」「い」を数えない）
+NO_ANSWER = re.compile(r"いいえ|ありません|ではない|じゃない|していない|ていない|ない|なし|無い|無し|ません|違う|\bno\b")
+YES_ANSWER = re.compile(r"はい|ある|あり|有り|した|ました|いた|です|そう|\byes\b")
+
+
+def _entropy(labels: np.ndarray) -> float:
+    """候補を一様とみなしたときの、ラベルによる分割のエントロピー（ビット）"""
+    _, counts = np.unique(labels, return_counts=True)
+    p = counts / counts.sum()
+    return float(-(p * np.log2(p)).sum())
+
+
+def information_gain(table: CrimeTable, rows: np.ndarray, criterion: str, chosen: Iterable[str] = ()) -> float:
+    """
+    既に選んだ基準（chosen）に criterion を加えたときに増える情報利得
+    回答は決定的なため、利得は回答の組み合わせによる候補の分割のエントロピーの増分になる
+    """
+    columns = [table.criterion_index[c] for c in chosen]
+    base = _signatures(table, rows, columns)
+    extended = _signatures(table, rows, columns + [table.criterion_index[criterion]])
+    return _entropy(extended) - _entropy(base)
+
+
+def _signatures(table: CrimeTable, rows: np.ndarray, columns: List[int]) -> np.ndarray:
+    """各候補の◯の有無の組み合わせを整数にする"""
+    if not columns:
+        return np.zeros(len(rows), dtype=np.int64)
+    bits = table.matrix[np.ix_(rows, columns)].astype(np.int64)
+    return bits @ (1 << np.arange(len(columns), dtype=np.int64))
+
+
+def mentioned(text: str, keyword: str) -> Optional[bool]:
+    """語が否定されずに現れればTrue、否定された形でのみ現れればFalse、現れなければNone"""
+    start = text.find(keyword)
+    if start == -1:
+        return None
+    while start != -1:
+        if not NEGATION.match(text[start + len(keyword):]):
+            return True
+        start = text.find(keyword, start + 1)
+    return False
+
+
+def infer_criteria_answers(criteria: Iterable[str], texts: Iterable[str]) -> Dict[str, bool]:
+    """
+    相談文・判明事実から読み取れる判断基準への はい/いいえ（CRITERION_HINTS の語による）
+    該当を示す語が1つでも否定されずに現れれば はい、否定された形でのみ現れれば いいえ とする
+    """
+    text = "\n".join(texts)
+    answers = {}
+    for criterion in criteria:
+        for names, keywords in CRITERION_HINTS:
+            if not any(name in criterion for name in names):
+                continue
+            found = [mentioned(text, keyword) for keyword in keywords]
+            if True in found:
+                answers[criterion] = True
+            elif False in found:
+                answers[criterion] = False
+            break
+    return answers
+
+
+def select_crime_criteria(
+    table: CrimeTable,
+    answers: Dict[str, bool],
+    asked: Iterable[str] = (),
+    limit: int = 5
+) -> Dict:
+    """
+    回答済みの判断基準で候補を絞り込み、次に尋ねる判断基準を情報利得の大きい順に選ぶ
+    同じ質問文になる基準は1つだけ選ぶ。候補が TARGET_CANDIDATES 件以下なら選ばない
+
+    Returns:
+        {"candidates": 残った罪名, "criteria": [(判断基準, 質問文), ...]}
+    """
+    narrowed = table.narrow(answers)
+    candidates = narrowed["candidates"]
+    if len(candidates) <= TARGET_CANDIDATES:
+        return {"candidates": candidates, "criteria": []}
+
+    rows = np.array([table.crime_index[crime] for crime in candidates])
+    asked = set(asked)
+    pool = [c for c in narrowed["discriminating"] if c not in asked]
+    selected = []
+    questions = set()
+    while pool and len(selected) < limit:
+        chosen = [c for c, _ in selected]
+        gains = [information_gain(table, rows, c, chosen) for c in pool]
+        best = int(np.argmax(gains))
+        if gains[best] <= 0:
+            break
+        criterion = pool.pop(best)
+        question = format_question_for_crime(criterion)
+        if question in questions:
+            continue
+        questions.add(question)
+        selected.append((criterion, question))
+    return {"candidates": candidates, "criteria": selected}
+
+
+def sentencing_importance(item: str) -> int:
+    for score, keywords in SENTENCING_IMPORTANCE:
+        if any(keyword in item for keyword in keywords):
+            return score
+    return 0
+
+
+def _known_in_facts(item: str, known_facts: Iterable[str]) -> bool:
+    """判明事実の台帳に、項目の重要語を項目名に含む事実があるか"""
+    keys = [fact_key(fact) for fact in known_facts]
+    for _, keywords in SENTENCING_IMPORTANCE:
+        for keyword in keywords:
+            if keyword in item and any(keyword in key for key in keys):
+                return True
+    return False
+
+
+def select_sentencing_items(
+    items: List[str],
+    known_facts: Iterable[str] = (),
+    asked: Iterable[str] = (),
+    limit: int = 5
+) -> List[tuple]:
+    """量刑予測ヒアリングシートの項目から、未確認の重要な項目を重要度順に選ぶ [(項目, 質問文), ...]"""
+    known_facts = list(known_facts)
+    asked = set(asked)
+    ranked = sorted(
+        (item for item in items if item not in SENTENCING_SKIP_COLUMNS and item not in asked),
+        key=lambda item: -sentencing_importance(item)
+    )
+    selected = []
+    questions = set()
+    for item in ranked:
+        if len(selected) >= limit or sentencing_importance(item) < 4:
+            break
+        if _known_in_facts(item, known_facts):
+            continue
+        # 定型は短い項目名（行為態様・被害内容など）を質問にしないが、重要な項目のため項目名のまま尋ねる
+        question = format_question_for_sentencing(item) or f"{item}について教えてください"
+        if question in questions:
+            continue
+        questions.add(question)
+        selected.append((item, question))
+    return selected
+
+
+def select_questions(
+    big_category: Optional[str],
+    response_type_value: str,
+    sentencing_features: Dict[str, List[str]],
+    answers: Dict[str, bool],
+    known_facts: Iterable[str] = (),
+    asked: Iterable[str] = (),
+    limit: int = 5,
+    texts: Iterable[str] = ()
+) -> Optional[Dict]:
+    """
+    次の深掘りラウンドの質問をローカルで選ぶ
+    answers（判断基準への回答）に加え、判明事実と texts（相談者の発話）から読み取れる判断基準も回答済みとして扱う
+    （明示的な回答を優先する）
+
+    Returns:
+        ローカルで選べない（大分類が未確定・該当するシートがない）場合はNone。
+        それ以外は {"candidates": 残った罪名, "criteria": [(判断基準, 質問文), ...], "items": [(量刑の項目, 質問文), ...]}。
+        criteria・items がともに空なら追加の質問は不要
+    """
+    if not big_category or big_category == BIG_CATEGORY:
+        return None
+    known_facts = list(known_facts)
+    asked = list(asked)
+    needs_crime = response_type_value in ('predict_crime_type', 'predict_crime_and_punishment')
+    needs_sentencing = response_type_value in ('predict_punishment', 'predict_crime_and_punishment')
+
+    table = get_crime_tables().get(big_category) if needs_crime else None
+    sentencing_items = sentencing_features.get(big_category) if needs_sentencing else None
+    if table is None and sentencing_items is None:
+        return None
+    if response_type_value == 'predict_crime_type' and table is None:
+        return None
+
+    result = {"candidates": [], "criteria": [], "items": []}
+    if table is not None:
+        # 罪名と量刑の両方を尋ねる場合は、量刑の重要項目（前科・示談など）の枠を残す
+        crime_limit = max(limit - SENTENCING_RESERVED, 1) if sentencing_items else limit
+        answers = {**infer_criteria_answers(table.criteria, known_facts + list(texts)), **answers}
+        result.update(select_crime_criteria(table, answers, asked, crime_limit))
+    if sentencing_items:
+        result["items"] = select_sentencing_items(
+            sentencing_items, known_facts, asked, limit - len(result["criteria"])
+        )
+    return result
+
+
+def _answer_lines(text: str, count: int) -> Dict[int, str]:
+    """番号付きの回答を質問番号（1始まり）ごとに分ける。番号がなく行数が質問数と同じなら順番に対応させる"""
+    lines = [line.strip() for line in unicodedata.normalize("NFKC", text).splitlines() if line.strip()]
+    numbered = {}
+    for line in lines:
+        match = ANSWER_LINE.match(line)
+        if match and 1 <= int(match.group(1)) <= count:
+            numbered[int(match.group(1))] = match.group(2)
+    if numbered:
+        return numbered
+    if count == 1 and lines:
+        return {1: " ".join(lines)}
+    if len(lines) == count:
+        return {i: line for i, line in enumerate(lines, start=1)}
+    return {}
+
+
+def parse_yes_no(text: str) -> Optional[bool]:
+    """
+    回答文を はい/いいえ に読み替える（わからない・読み取れない場合はNone）
+    冒頭の はい/いいえ があればそれに従い、なければ本文の肯定・否定の表現で判断する。
+    肯定と否定の両方を含む（「怪我はしていないと思ったが骨折していた」など）場合は決めない
+    """
+    text = POLITENESS.sub("", text.strip().lower()).strip(" 、。,.")
+    if LEADING_YES.match(text):
+        return True
+    if LEADING_NO.match(text):
+        return False
+    if UNKNOWN_ANSWER.search(text):
+        return None
+    negative = NO_ANSWER.search(text) is not None
+    positive = YES_ANSWER.search(NO_ANSWER.sub(" ", text)) is not None
+    if negative == positive:
+        return None
+    return positive
+
+
+def parse_criteria_answers(text: str, criteria: List[Optional[str]]) -> Dict[str, bool]:
+    """
+    前回のラウンドで尋ねた判断基準への はい/いいえ の回答を読み取る
+    criteria は質問の並び順の判断基準（判断基準でない質問はNone）
+    """
+    answers = {}
+    for number, line in _answer_lines(text, len(criteria)).items():
+        criterion = criteria[number - 1]
+        value = parse_yes_no(line)
+        if criterion and value is not None:
+            answers[criterion] = value
+    return answers
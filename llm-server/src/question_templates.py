@@ -0,0 +1,79 @@
+"""
+罪名予測テーブル・量刑予測ヒアリングシートの項目を相談者向けの質問文にする定型
+
+RAGデータの生成（rag_loader）と、深掘り質問のローカル選択（question_selector）で共用する。
+"""
+
+from typing import Optional
+
+
+def format_question_for_crime(question: str) -> str:
+    """
+    罪名予測用の質問を端的な形式にフォーマット
+    """
+    # 長い説明文を短い質問に変換
+    if "旨を告知して脅迫" in question:
+        return "脅迫行為の有無と内容を教えてください"
+    elif "義務のないことを行わせ" in question:
+        return "強要された行為の内容を教えてください"
+    elif "身体に対して直接的な拘束" in question:
+        return "身体の拘束や監禁の有無と状況を教えてください"
+    elif "負傷させた" in question:
+        return "被害者の負傷の有無と程度を教えてください"
+    elif "死亡させた" in question:
+        return "死亡者の有無を教えてください"
+    elif "財産上の利益" in question:
+        return "金銭や財産上の利益を得る目的はありましたか"
+    elif "わいせつ行為" in question:
+        return "わいせつ行為の有無と内容を教えてください"
+    elif "18歳未満" in question:
+        return "被害者の年齢（特に18歳未満かどうか）を教えてください"
+    elif "暴行" in question:
+        return "暴行の有無と内容を教えてください"
+    elif "凶器" in question:
+        return "凶器の使用有無と種類を教えてください"
+    elif "計画" in question or "準備" in question:
+        return "事前の計画や準備の有無を教えてください"
+    elif "常習" in question:
+        return "同様の行為を繰り返していたか教えてください"
+    else:
+        # その他の質問は簡潔に
+        return question[:50] + "について教えてください" if len(question) > 50 else question + "？"
+
+
+def format_question_for_sentencing(question: str) -> Optional[str]:
+    """
+    量刑予測用の質問を端的な形式にフォーマット
+    """
+    # ヘッダーの項目名を質問形式に変換
+    if "前科" in question:
+        return "前科・前歴の有無と内容を教えてください"
+    elif "示談" in question:
+        return "示談の成立状況と示談金額を教えてください"
+    elif "被害金額" in question:
+        return "被害金額を具体的に教えてください"
+    elif "治療期間" in question:
+        return "被害者の治療期間を教えてください"
+    elif "準備・計画性" in question:
+        return "犯行の計画性や準備状況を教えてください"
+    elif "常習性" in question:
+        return "同種犯罪の前歴や常習性について教えてください"
+    elif "動機" in question or "経緯" in question:
+        return "犯行の動機と経緯を詳しく教えてください"
+    elif "被害感情" in question:
+        return "被害者や遺族の処罰感情を教えてください"
+    elif "社会的影響" in question:
+        return "事件の社会的影響について教えてください"
+    elif "年齢" in question:
+        return "被告人の年齢を教えてください"
+    elif "犯行後の情状" in question:
+        return "犯行後の反省や被害者への対応を教えてください"
+    elif "凶器" in question:
+        return "使用した凶器の種類を教えてください"
+    elif "暴行" in question or "脅迫" in question:
+        return "暴行・脅迫の内容と程度を教えてください"
+    else:
+        # 短い項目名はそのまま返さない
+        if len(question) < 10:
+            return None
+        return question + "について教えてください"
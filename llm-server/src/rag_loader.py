@@ -1,11 +1,160 @@
 import os
-import csv
+import argparse
+import hashlib
 import json
-import pickle
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import List, Dict, Any
+import numpy as np
+import openai
+import src.config as config
 import src.embedding as emb
-import src.gen.rag as rag
+from src.history_packer import count_tokens
+from src.question_templates import format_question_for_crime, format_question_for_sentencing
+from src.table_registry import SENTENCING_PREFIX, current_tables
+from src.vector_index import VectorIndex, index_exists, publish_index
+
+
+# バッチごとのembeddingを追記するチェックポイント（中断後の再実行では保存済みのテキストを飛ばす）
+CHECKPOINT_FILE = "embedding_checkpoint.jsonl"
+# 待てば成功する可能性があるエラー（レート制限・一時的な障害）
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+MAX_BACKOFF_SECONDS = 60
+
+
+def make_batches(texts: List[str], max_inputs: int, max_tokens: int) -> List[List[str]]:
+    """
+    入力数・トークン数の上限を超えないようにテキストをバッチにまとめる
+    1件で上限を超えるテキストは単独のバッチにする
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for text in texts:
+        tokens = count_tokens(text)
+        if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _retry_after(error: Exception) -> float:
+    """レート制限の応答に Retry-After があればその秒数"""
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers.get('retry-after', 0)) if response is not None else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def embed_with_backoff(texts: List[str], max_retries: int) -> List[List[float]]:
+    """バッチをembeddingに変換する。レート制限・一時的な障害は指数バックオフ（ジッタ付き）で再試行する"""
+    delay = 1.0
+    for attempt in range(max_retries + 1):
+        try:
+            return emb.ada_batch(texts)
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            wait = max(_retry_after(e), delay * (1 + random.random()))
+            logging.warning(f"Embedding batch failed ({type(e).__name__}), retrying in {wait:.1f}s")
+            time.sleep(wait)
+            delay = min(delay * 2, MAX_BACKOFF_SECONDS)
+
+
+class EmbeddingCheckpoint:
+    """
+    バッチごとに テキスト → embedding を追記するファイル
+    モデルの異なる行と、書き込み途中で中断された最後の行は読み込み時に無視する
+    """
+
+    def __init__(self, path: Path, model: str):
+        self.path = path
+        self.model = model
+        self.done: Dict[str, List[float]] = {}
+        if path.exists():
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if row.get('model') == model:
+                        self.done[row['text']] = row['emb']
+
+    def append(self, texts: List[str], embeddings: List[List[float]]):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for text, embedding in zip(texts, embeddings):
+                f.write(json.dumps({'model': self.model, 'text': text, 'emb': embedding}, ensure_ascii=False) + "\n")
+                self.done[text] = embedding
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self):
+        if self.path.exists():
+            self.path.unlink()
+
+
+class EmbeddingProgress:
+    """embeddingの進捗とスループット（行/秒・トークン/秒）の表示"""
+
+    def __init__(self, total_rows: int, total_tokens: int, resumed_rows: int = 0):
+        self.total_rows = total_rows
+        self.total_tokens = total_tokens
+        self.rows = 0
+        self.tokens = 0
+        self.started = time.monotonic()
+        if resumed_rows:
+            print(f"Resuming from checkpoint: {resumed_rows} embeddings already done")
+
+    def update(self, rows: int, tokens: int):
+        self.rows += rows
+        self.tokens += tokens
+        print(f"Embedded {self.rows}/{self.total_rows} rows ({self.tokens}/{self.total_tokens} tokens) - {self.rate()}")
+
+    def rate(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return f"{self.rows / elapsed:.1f} rows/s, {self.tokens / elapsed:.0f} tokens/s"
+
+    def summary(self) -> Dict[str, float]:
+        elapsed = time.monotonic() - self.started
+        return {
+            'rows': self.rows,
+            'tokens': self.tokens,
+            'seconds': round(elapsed, 2),
+            'rows_per_second': round(self.rows / elapsed, 2) if elapsed else 0.0,
+            'tokens_per_second': round(self.tokens / elapsed, 1) if elapsed else 0.0
+        }
+
+
+# 質問に付けるハッシュ（インデックスのレコードには metadata の外に保存する）
+QUESTION_HASH_KEYS = ('row_hash', 'content_hash', 'embedding_text')
+
+
+def _sha256(payload) -> str:
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def question_hashes(question: Dict[str, Any], model: str) -> Dict[str, str]:
+    """
+    行のハッシュ（どのシートのどの項目か）と、質問のハッシュ（embeddingに使うテキストとモデル）
+    質問のハッシュが同じならembeddingを再利用できる
+    """
+    embedding_text = f"{question['formatted_question']} ({question['original_question']})"
+    return {
+        'row_hash': _sha256([question['type'], question['category'], question['original_question']]),
+        'content_hash': _sha256([model, embedding_text]),
+        'embedding_text': embedding_text
+    }
+
 
 class LegalRAGLoader:
     """
@@ -15,213 +164,200 @@ class LegalRAGLoader:
     def __init__(self, data_dir: str = "rag_data"):
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(exist_ok=True)
+        self.embedding_stats: Dict[str, float] = {}
         
-    def load_crime_prediction_table(self, file_path: Path) -> List[Dict[str, Any]]:
+    def crime_prediction_questions(self, category: str, criteria: List[str], source_file: str) -> List[Dict[str, Any]]:
         """
-        罪名予測テーブル（TSV/CSV）を読み込んで構造化
+        罪名予測テーブルの判断基準を構造化
         """
         questions = []
-        
-        # ファイル拡張子によって読み込み方法を変更
-        delimiter = '\t' if file_path.suffix == '.tsv' else ','
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            reader = csv.reader(f, delimiter=delimiter)
-            headers = next(reader)  # ヘッダー行を取得
-            
-            # 最初の列は罪名なので、それ以外を質問項目として取得
-            question_columns = headers[1:] if len(headers) > 1 else []
-            
-            # 各質問項目をRAG用データとして構造化
-            for idx, question in enumerate(question_columns):
-                if question and len(question.strip()) > 5:  # 有効な質問のみ
-                    # カテゴリ名をファイル名から抽出
-                    category = file_path.stem.replace('罪名予測テーブル - ', '').replace('罪名予測テーブル_', '')
-                    
-                    # 質問を端的な形式に変換
-                    formatted_question = self._format_question_for_crime(question)
-                    
+        for question in criteria:
+            if question and len(question.strip()) > 5:  # 有効な質問のみ
+                questions.append({
+                    'category': category,
+                    'type': 'crime_prediction',
+                    'original_question': question,
+                    'formatted_question': format_question_for_crime(question),
+                    'source_file': source_file
+                })
+        return questions
+
+    def sentencing_hearing_questions(self, category: str, items: List[str], source_file: str) -> List[Dict[str, Any]]:
+        """
+        量刑予測ヒアリングシートの確認項目（ID列・罪名列を除く）を構造化
+        """
+        questions = []
+        for question in items:
+            if question and len(question.strip()) > 3:  # 有効な質問のみ
+                formatted_question = format_question_for_sentencing(question)
+                if formatted_question:  # 有効な質問のみ追加
                     questions.append({
                         'category': category,
-                        'type': 'crime_prediction',
+                        'type': 'sentencing_prediction',
                         'original_question': question,
                         'formatted_question': formatted_question,
-                        'source_file': str(file_path)
+                        'source_file': source_file
                     })
-        
         return questions
-    
-    def load_sentencing_hearing_sheet(self, file_path: Path) -> List[Dict[str, Any]]:
+
+    def _checkpoint(self) -> EmbeddingCheckpoint:
+        return EmbeddingCheckpoint(self.data_dir / CHECKPOINT_FILE, config.get_model("embedding"))
+
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
         """
-        量刑予測ヒアリングシート（TSV）を読み込んで構造化
+        テキストをembeddingに変換する
+        入力数・トークン数の上限内のバッチにまとめ、RAG_EMBED_CONCURRENCY 個まで並行して送る。
+        完了したバッチはチェックポイントに追記し、中断後の再実行では保存済みのテキストを送らない
         """
-        questions = []
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            reader = csv.reader(f, delimiter='\t')
-            headers = next(reader)  # ヘッダー行を取得
-            
-            # ID列と罪名列を除いた実質的な質問項目を取得
-            question_columns = headers[2:] if len(headers) > 2 else []
-            
-            # 各質問項目をRAG用データとして構造化
-            for idx, question in enumerate(question_columns):
-                if question and len(question.strip()) > 3:  # 有効な質問のみ
-                    # カテゴリ名をファイル名から抽出
-                    category = file_path.stem.replace('量刑予測_ヒアリングシート - ', '')
-                    
-                    # 質問を端的な形式に変換
-                    formatted_question = self._format_question_for_sentencing(question)
-                    
-                    if formatted_question:  # 有効な質問のみ追加
-                        questions.append({
-                            'category': category,
-                            'type': 'sentencing_prediction',
-                            'original_question': question,
-                            'formatted_question': formatted_question,
-                            'source_file': str(file_path)
-                        })
-        
-        return questions
-    
-    def _format_question_for_crime(self, question: str) -> str:
+        checkpoint = self._checkpoint()
+        pending = [text for text in dict.fromkeys(texts) if text not in checkpoint.done]
+        batches = make_batches(pending, config.RAG_EMBED_BATCH_SIZE, config.RAG_EMBED_BATCH_TOKENS)
+        progress = EmbeddingProgress(
+            len(pending), sum(count_tokens(text) for text in pending), resumed_rows=len(checkpoint.done)
+        )
+
+        error = None
+        with ThreadPoolExecutor(max_workers=max(1, config.RAG_EMBED_CONCURRENCY)) as executor:
+            futures = {
+                executor.submit(embed_with_backoff, batch, config.RAG_EMBED_MAX_RETRIES): batch
+                for batch in batches
+            }
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    embeddings = future.result()
+                except Exception as e:
+                    # 失敗したら未着手のバッチは送らず、実行中のバッチの結果だけ保存する
+                    if error is None:
+                        error = e
+                        for other in futures:
+                            other.cancel()
+                    continue
+                checkpoint.append(batch, embeddings)
+                progress.update(len(batch), sum(count_tokens(text) for text in batch))
+
+        if error is not None:
+            print(f"Embedding stopped: {error}. Re-run to resume from {CHECKPOINT_FILE}.")
+            raise error
+        self.embedding_stats = progress.summary()
+        print(f"Embedding complete: {progress.rate()}")
+        return [checkpoint.done[text] for text in texts]
+
+    def collect_questions(self) -> List[Dict[str, Any]]:
         """
-        罪名予測用の質問を端的な形式にフォーマット
+        すべてのテーブルとシートから質問を集める
+        シートは table_registry が読み込んだもの（同名のシートはTSVを優先して1回だけ）を使う
         """
-        # 長い説明文を短い質問に変換
-        if "旨を告知して脅迫" in question:
-            return "脅迫行為の有無と内容を教えてください"
-        elif "義務のないことを行わせ" in question:
-            return "強要された行為の内容を教えてください"
-        elif "身体に対して直接的な拘束" in question:
-            return "身体の拘束や監禁の有無と状況を教えてください"
-        elif "負傷させた" in question:
-            return "被害者の負傷の有無と程度を教えてください"
-        elif "死亡させた" in question:
-            return "死亡者の有無を教えてください"
-        elif "財産上の利益" in question:
-            return "金銭や財産上の利益を得る目的はありましたか"
-        elif "わいせつ行為" in question:
-            return "わいせつ行為の有無と内容を教えてください"
-        elif "18歳未満" in question:
-            return "被害者の年齢（特に18歳未満かどうか）を教えてください"
-        elif "暴行" in question:
-            return "暴行の有無と内容を教えてください"
-        elif "凶器" in question:
-            return "凶器の使用有無と種類を教えてください"
-        elif "計画" in question or "準備" in question:
-            return "事前の計画や準備の有無を教えてください"
-        elif "常習" in question:
-            return "同様の行為を繰り返していたか教えてください"
-        else:
-            # その他の質問は簡潔に
-            return question[:50] + "について教えてください" if len(question) > 50 else question + "？"
-    
-    def _format_question_for_sentencing(self, question: str) -> str:
+        all_questions = []
+        tables = current_tables()
+
+        # 罪名予測テーブルの処理
+        for category, table in tables.crime_tables.items():
+            print(f"Loading: {tables.sources[category]}")
+            all_questions.extend(self.crime_prediction_questions(category, table.criteria, tables.sources[category]))
+
+        # 量刑予測ヒアリングシートの処理
+        for category, items in tables.sentencing_features.items():
+            source_file = tables.sources[f"{SENTENCING_PREFIX}{category}"]
+            print(f"Loading: {source_file}")
+            all_questions.extend(self.sentencing_hearing_questions(category, items, source_file))
+        return all_questions
+
+    def existing_index(self):
+        """保存済みのインデックスの 行のハッシュの集合 と 質問のハッシュ → embedding（インデックスがなければ空）"""
+        rows, embeddings = set(), {}
+        if not index_exists(self.data_dir):
+            return rows, embeddings
+        index = VectorIndex(self.data_dir)
+        for i in range(len(index)):
+            record = index.record(i)
+            rows.add(record.get('row_hash'))
+            if record.get('content_hash'):
+                embeddings[record['content_hash']] = np.array(index.vectors[i])
+        index.close()
+        return rows, embeddings
+
+    def plan_rebuild(self, all_questions: List[Dict[str, Any]]) -> Dict[str, Any]:
         """
-        量刑予測用の質問を端的な形式にフォーマット
+        保存済みのインデックスと比べて、再利用・新規embedding・削除の件数を求める
+        行のハッシュ（シート・種別・元の項目）が同じで質問のハッシュが違う行は変更として数える
         """
-        # ヘッダーの項目名を質問形式に変換
-        if "前科" in question:
-            return "前科・前歴の有無と内容を教えてください"
-        elif "示談" in question:
-            return "示談の成立状況と示談金額を教えてください"
-        elif "被害金額" in question:
-            return "被害金額を具体的に教えてください"
-        elif "治療期間" in question:
-            return "被害者の治療期間を教えてください"
-        elif "準備・計画性" in question:
-            return "犯行の計画性や準備状況を教えてください"
-        elif "常習性" in question:
-            return "同種犯罪の前歴や常習性について教えてください"
-        elif "動機" in question or "経緯" in question:
-            return "犯行の動機と経緯を詳しく教えてください"
-        elif "被害感情" in question:
-            return "被害者や遺族の処罰感情を教えてください"
-        elif "社会的影響" in question:
-            return "事件の社会的影響について教えてください"
-        elif "年齢" in question:
-            return "被告人の年齢を教えてください"
-        elif "犯行後の情状" in question:
-            return "犯行後の反省や被害者への対応を教えてください"
-        elif "凶器" in question:
-            return "使用した凶器の種類を教えてください"
-        elif "暴行" in question or "脅迫" in question:
-            return "暴行・脅迫の内容と程度を教えてください"
-        else:
-            # 短い項目名はそのまま返さない
-            if len(question) < 10:
-                return None
-            return question + "について教えてください"
-    
-    def create_rag_data(self):
+        existing_rows, existing = self.existing_index()
+
+        new_texts = {}
+        for question in all_questions:
+            if question['content_hash'] not in existing:
+                new_texts.setdefault(question['content_hash'], question['embedding_text'])
+        rows = {question['row_hash'] for question in all_questions}
+        return {
+            'total': len(all_questions),
+            'reused': sum(1 for q in all_questions if q['content_hash'] in existing),
+            'added': sum(1 for q in all_questions if q['row_hash'] not in existing_rows),
+            'changed': sum(
+                1 for q in all_questions if q['row_hash'] in existing_rows and q['content_hash'] not in existing
+            ),
+            'removed': len(existing_rows - rows),
+            'embeddings_to_create': len(new_texts),
+            'tokens_to_embed': sum(count_tokens(text) for text in new_texts.values()),
+            'existing': existing,
+            'new_texts': list(new_texts.values())
+        }
+
+    def create_rag_data(self, dry_run: bool = False):
         """
         すべてのテーブルとシートを読み込んでRAGデータを生成
+        保存済みのインデックスにある質問（質問のハッシュが同じもの）はembeddingを再利用し、
+        新しい・変わった質問だけをembeddingに変換する。シートからなくなった行はインデックスから除く。
+        dry_run の場合はembeddingを作らず、再生成にかかる件数・トークン数だけを返す
         """
-        all_questions = []
-        
-        # 罪名予測テーブルの処理
-        crime_table_paths = [
-            Path("罪名予測テーブル"),
-            Path("dataset/raw")
+        all_questions = self.collect_questions()
+        model = config.get_model("embedding")
+        for question in all_questions:
+            question.update(question_hashes(question, model))
+
+        plan = self.plan_rebuild(all_questions)
+        existing = plan.pop('existing')
+        new_texts = plan.pop('new_texts')
+        print(
+            f"\n{plan['total']} questions: {plan['reused']} reused, {plan['added']} added, "
+            f"{plan['changed']} changed, {plan['removed']} removed"
+        )
+        print(f"Embeddings to create: {plan['embeddings_to_create']} ({plan['tokens_to_embed']} tokens)")
+        if dry_run:
+            return plan
+
+        # 新しい・変わった質問だけembeddingを生成（フォーマット済みの質問と元の質問を組み合わせたテキスト）
+        created = dict(zip(new_texts, self.embed_texts(new_texts))) if new_texts else {}
+        embeddings = [
+            existing[q['content_hash']] if q['content_hash'] in existing else created[q['embedding_text']]
+            for q in all_questions
         ]
-        
-        for base_path in crime_table_paths:
-            if base_path.exists():
-                # TSVファイル
-                for tsv_file in base_path.glob("罪名予測テーブル*.tsv"):
-                    print(f"Loading: {tsv_file}")
-                    questions = self.load_crime_prediction_table(tsv_file)
-                    all_questions.extend(questions)
-                
-                # CSVファイル
-                for csv_file in base_path.glob("罪名予測テーブル*.csv"):
-                    print(f"Loading: {csv_file}")
-                    questions = self.load_crime_prediction_table(csv_file)
-                    all_questions.extend(questions)
-        
-        # 量刑予測ヒアリングシートの処理
-        hearing_sheet_path = Path("量刑予測ヒアリングシート")
-        if hearing_sheet_path.exists():
-            for tsv_file in hearing_sheet_path.glob("*.tsv"):
-                print(f"Loading: {tsv_file}")
-                questions = self.load_sentencing_hearing_sheet(tsv_file)
-                all_questions.extend(questions)
-        
-        # 各質問にembeddingを生成して保存
-        print(f"\nGenerating embeddings for {len(all_questions)} questions...")
-        for i, question_data in enumerate(all_questions):
-            # フォーマット済みの質問と元の質問を組み合わせてembedding生成
-            text_for_embedding = f"{question_data['formatted_question']} ({question_data['original_question']})"
-            
-            # RAGデータとして保存
-            ref_data = {
+        records = [
+            {
                 'text': question_data['formatted_question'],
-                'emb': emb.ada(text_for_embedding),
                 'tag': f"{question_data['type']}_{question_data['category']}",
-                'metadata': question_data
+                'row_hash': question_data['row_hash'],
+                'content_hash': question_data['content_hash'],
+                'metadata': {k: v for k, v in question_data.items() if k not in QUESTION_HASH_KEYS}
             }
-            
-            # pickleファイルとして保存
-            ref_path = self.data_dir / f"{question_data['type']}_{question_data['category']}_{i}.ref"
-            with open(ref_path, 'wb') as f:
-                pickle.dump(ref_data, f)
-            
-            if (i + 1) % 10 == 0:
-                print(f"Processed {i + 1}/{len(all_questions)} questions")
-        
+            for question_data in all_questions
+        ]
+
         print(f"\nRAG data generation complete. {len(all_questions)} questions processed.")
-        
+
         # メタデータを保存
         metadata = {
             'total_questions': len(all_questions),
             'crime_prediction_questions': len([q for q in all_questions if q['type'] == 'crime_prediction']),
             'sentencing_prediction_questions': len([q for q in all_questions if q['type'] == 'sentencing_prediction']),
-            'categories': list(set(q['category'] for q in all_questions))
+            'categories': list(set(q['category'] for q in all_questions)),
+            'rebuild': plan,
+            'embedding': self.embedding_stats
         }
-        
-        with open(self.data_dir / 'metadata.json', 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+        # インデックス（vectors.npy・records.jsonl）と metadata.json を新しい版に書いてから一度に差し替える
+        publish_index(self.data_dir, embeddings, records, metadata)
+        self._checkpoint().clear()
         
         return metadata
 
@@ -229,8 +365,13 @@ def main():
     """
     RAGデータを生成するメイン関数
     """
-    loader = LegalRAGLoader()
-    metadata = loader.create_rag_data()
+    parser = argparse.ArgumentParser(description="罪名予測テーブル・量刑予測ヒアリングシートからRAGデータを生成する")
+    parser.add_argument("--data-dir", default="rag_data", help="インデックスの保存先")
+    parser.add_argument("--dry-run", action="store_true", help="embeddingを作らず、再生成にかかる件数・トークン数だけを表示する")
+    args = parser.parse_args()
+
+    loader = LegalRAGLoader(args.data_dir)
+    metadata = loader.create_rag_data(dry_run=args.dry_run)
     print("\nMetadata:")
     print(json.dumps(metadata, ensure_ascii=False, indent=2))
 
@@ -1,17 +1,189 @@
 """
 RAGマネージャー
 OpenAI Assistants APIのFile Search機能を使用して判例検索を実装
+
+Assistantは (用途, RAG強制モード, モデル, ベクトルストア) ごとに1回だけ作成して使い回す。
+IDは指示文のハッシュと一緒にSQLiteへ保存し、再起動後は最初に使うときに存在と指示文を確認する
+（指示文が変わった・削除されていた場合だけ作り直す）。予測ごとに作るThreadの削除は応答の後にバックグラウンドで行う。
 """
 
+import hashlib
 import json
 import logging
+import queue
 import re
-from typing import List, Dict, Optional, Generator
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Dict, Optional, Generator, Tuple
 from functools import lru_cache
 
+import openai
+from openai.lib.streaming import AssistantEventHandler
+
 import src.config as config
 
 
+# Runが返答を完了せずに終わったことを示すイベント
+RUN_FAILURE_EVENTS = ("thread.run.failed", "thread.run.cancelled", "thread.run.expired", "thread.run.incomplete")
+
+
+class RAGRunError(RuntimeError):
+    """Assistantの返答が始まる前にRunが失敗した"""
+
+
+class RunEventHandler(AssistantEventHandler):
+    """ストリーミング実行のイベントハンドラ（返答は text_deltas で受け取り、Runの失敗を記録する）"""
+
+    def __init__(self):
+        super().__init__()
+        self.failure: Optional[str] = None
+
+    def on_event(self, event):
+        if event.event in RUN_FAILURE_EVENTS:
+            last_error = getattr(event.data, 'last_error', None)
+            self.failure = event.data.status + (f" ({last_error.message})" if last_error else "")
+
+
+# 統合予測の罪名予測の見出し（これだけを返した時点では予測はまだ始まっていない）
+CRIME_HEADING = "【罪名予測】\n"
+# 罪名予測の出力形式（1. 〇〇罪（刑法第XX条））で、この件数の罪名が揃えば量刑予測を始める
+EXPECTED_CRIME_NAMES = 3
+CRIME_NAME_LINE = re.compile(r"^\s*\d+\s*[.．)）]\s*([^（(\n]+?)\s*(?:[（(].*)?$")
+# 量刑予測の準備（Assistant取得・Thread作成）を罪名予測と並行して行うワーカー数
+PIPELINE_MAX_WORKERS = 4
+
+
+def parse_crime_names(text: str) -> List[str]:
+    """罪名予測の出力のうち、改行まで届いた番号付きの行から罪名を取り出す（途中の行は含めない）"""
+    names = []
+    for line in text.split("\n")[:-1]:
+        match = CRIME_NAME_LINE.match(line)
+        if match and match.group(1).strip():
+            names.append(match.group(1).strip())
+    return names
+
+
+class BackgroundStream:
+    """
+    ジェネレータをバックグラウンドのスレッドで先に進め、断片をキューにためる
+    反復すると、ためた断片から順に返す（ジェネレータの例外は反復側で送出する）
+    """
+
+    _DONE = object()
+
+    def __init__(self, factory: Callable[[], Iterable[str]]):
+        self._queue: "queue.Queue" = queue.Queue()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(factory,), name="rag-background-stream", daemon=True)
+        self._thread.start()
+
+    def _run(self, factory):
+        try:
+            stream = factory()
+            try:
+                for item in stream:
+                    if self._closed.is_set():
+                        break
+                    self._queue.put(item)
+            finally:
+                close = getattr(stream, 'close', None)
+                if close is not None:
+                    close()
+        except Exception as e:
+            self._queue.put(e)
+        finally:
+            self._queue.put(self._DONE)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """反復をやめた場合に、バックグラウンドの実行を次の断片で止める"""
+        self._closed.set()
+
+
+class AssistantStore:
+    """AssistantのID（キー → (ID, 指示文のハッシュ)）のSQLite保存"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rag_assistants "
+            "(key TEXT PRIMARY KEY, assistant_id TEXT, instructions_hash TEXT, created_at REAL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT assistant_id, instructions_hash FROM rag_assistants WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logging.error(f"RAG assistant store read failed: {e}")
+                return None
+        return (row[0], row[1]) if row else None
+
+    def set(self, key: str, assistant_id: str, instructions_hash: str):
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO rag_assistants (key, assistant_id, instructions_hash, created_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, assistant_id, instructions_hash, time.time())
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"RAG assistant store write failed: {e}")
+
+    def delete(self, key: str, assistant_id: str):
+        """キーがまだ assistant_id を指している場合だけ削除する（他のプロセスが作り直した分は残す）"""
+        with self._lock:
+            try:
+                self._conn.execute("DELETE FROM rag_assistants WHERE key = ? AND assistant_id = ?", (key, assistant_id))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"RAG assistant store delete failed: {e}")
+
+
+class BackgroundCleaner:
+    """Thread・古いAssistantの削除を応答の後に1本のバックグラウンドスレッドで行う"""
+
+    def __init__(self):
+        self._queue: "queue.Queue[Tuple[Callable, tuple]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, func: Callable, *args):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rag-cleaner", daemon=True)
+                self._thread.start()
+        self._queue.put((func, args))
+
+    def _run(self):
+        while True:
+            func, args = self._queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                logging.warning(f"Background cleanup failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+
 class RAGAssistantManager:
     """OpenAI Assistants APIを使用したRAG管理クラス"""
 
@@ -19,6 +191,11 @@ class RAGAssistantManager:
         self.client = config.get_openai_client()
         self.vector_store_id = config.get_vector_store_id()
         self.rag_only_mode = config.get_rag_only_mode()
+        self._assistants: Dict[str, Tuple[str, str]] = {}  # このプロセスで確認済みの キー → (ID, 指示文のハッシュ)
+        self._assistant_lock = threading.Lock()
+        self._store = AssistantStore(config.RAG_ASSISTANT_STORE_PATH) if config.RAG_ASSISTANT_STORE_PATH else None
+        self._cleaner = BackgroundCleaner()
+        self._executor = ThreadPoolExecutor(max_workers=PIPELINE_MAX_WORKERS, thread_name_prefix="rag-setup")
 
     def _format_sentencing_result(self, result_text: str) -> str:
         """量刑予測の結果を整形（新形式は自然な文章なのでそのまま返す）"""
@@ -75,8 +252,8 @@ class RAGAssistantManager:
         # 新形式（自然な文章）の場合はそのまま返す
         return result_text
 
-    def _create_crime_prediction_assistant(self, rag_only: bool = False):
-        """罪名予測用のAssistantを作成"""
+    def _crime_prediction_instructions(self, rag_only: bool = False) -> str:
+        """罪名予測用のAssistantの指示文"""
         rag_instruction = ""
         if rag_only:
             rag_instruction = "また、このアシスタントはアップロードされた資料に基づいて質問に答え、資料にない事柄に関しては回答しないでください。"
@@ -102,23 +279,10 @@ class RAGAssistantManager:
 - 根拠は1〜2行程度で簡潔に記載してください
 - 該当する構成要件や重要な事実関係を明記してください
 """
+        return instructions.strip()
 
-        # Create assistant with file_search tool and vector store (v2 API)
-        assistant = self.client.beta.assistants.create(
-            name="罪名予測アシスタント",
-            instructions=instructions.strip(),
-            model=config.get_model("main"),
-            tools=[{"type": "file_search"}],
-            tool_resources={
-                "file_search": {
-                    "vector_store_ids": [self.vector_store_id]
-                }
-            } if self.vector_store_id else None
-        )
-        return assistant
-
-    def _create_sentencing_prediction_assistant(self, rag_only: bool = False):
-        """量刑予測用のAssistantを作成"""
+    def _sentencing_prediction_instructions(self, rag_only: bool = False) -> str:
+        """量刑予測用のAssistantの指示文"""
         rag_instruction = ""
         if rag_only:
             rag_instruction = "また、このアシスタントはアップロードされた資料に基づいて質問に答え、資料にない事柄に関しては回答しないでください。"
@@ -154,68 +318,239 @@ class RAGAssistantManager:
 
 注意：複数の罪名が提示されている場合でも、量刑予測は1つにまとめてください。罪名ごとに別々の量刑を提示しないでください。
 """
+        return instructions.strip()
+
+    def _assistant_spec(self, kind: str, rag_only: bool) -> Tuple[str, str]:
+        """用途ごとの (Assistant名, 指示文)"""
+        if kind == "crime":
+            return "罪名予測アシスタント", self._crime_prediction_instructions(rag_only=rag_only)
+        return "量刑予測アシスタント", self._sentencing_prediction_instructions(rag_only=rag_only)
 
+    def _assistant_key(self, kind: str, rag_only: bool) -> str:
+        return f"{kind}:{int(bool(rag_only))}:{config.get_model('main')}:{self.vector_store_id}"
+
+    def _create_assistant(self, name: str, instructions: str, instructions_hash: str):
+        """file_searchツールとベクトルストアを持つAssistantを作成"""
         # Create assistant with file_search tool and vector store (v2 API)
-        assistant = self.client.beta.assistants.create(
-            name="量刑予測アシスタント",
-            instructions=instructions.strip(),
+        return self.client.beta.assistants.create(
+            name=name,
+            instructions=instructions,
             model=config.get_model("main"),
             tools=[{"type": "file_search"}],
             tool_resources={
                 "file_search": {
                     "vector_store_ids": [self.vector_store_id]
                 }
-            } if self.vector_store_id else None
+            } if self.vector_store_id else None,
+            metadata={"instructions_hash": instructions_hash}
         )
-        return assistant
 
-    def predict_crime_with_rag(self, incident_text: str, rag_only: Optional[bool] = None) -> str:
-        """RAGを使用した罪名予測"""
+    def _is_valid_assistant(self, assistant_id: str, instructions_hash: str) -> bool:
+        """保存済みのAssistantが存在し、同じ指示文・モデルで作られたものか"""
+        try:
+            assistant = self.client.beta.assistants.retrieve(assistant_id)
+        except openai.NotFoundError:
+            return False
+        metadata = getattr(assistant, 'metadata', None) or {}
+        return metadata.get('instructions_hash') == instructions_hash and assistant.model == config.get_model("main")
+
+    def _get_assistant_id(self, kind: str, rag_only: bool) -> str:
+        """
+        用途ごとのAssistantのIDを返す
+        このプロセスで確認済みならそのまま、保存済みなら最初の1回だけ存在を確認し、なければ作成して保存する
+        """
+        key = self._assistant_key(kind, rag_only)
+        name, instructions = self._assistant_spec(kind, rag_only)
+        instructions_hash = hashlib.sha256(instructions.encode("utf-8")).hexdigest()
+
+        cached = self._assistants.get(key)
+        if cached is not None and cached[1] == instructions_hash:
+            return cached[0]
+
+        with self._assistant_lock:
+            cached = self._assistants.get(key)
+            if cached is not None and cached[1] == instructions_hash:
+                return cached[0]
+
+            stored = self._store.get(key) if self._store is not None else None
+            if stored is not None and stored[1] == instructions_hash and self._is_valid_assistant(stored[0], instructions_hash):
+                assistant_id = stored[0]
+            else:
+                stale = stored[0] if stored is not None else (cached[0] if cached is not None else None)
+                if stale:
+                    self._cleaner.submit(self._cleanup_assistant, stale)
+                assistant_id = self._create_assistant(name, instructions, instructions_hash).id
+                logging.info(f"Created RAG assistant {assistant_id} for {key}")
+                if self._store is not None:
+                    self._store.set(key, assistant_id, instructions_hash)
+            self._assistants[key] = (assistant_id, instructions_hash)
+            return assistant_id
+
+    def _forget_assistant(self, kind: str, rag_only: bool, assistant_id: str):
+        """使えなくなったAssistant（外部で削除された等）を次回作り直すようにする"""
+        key = self._assistant_key(kind, rag_only)
+        with self._assistant_lock:
+            if self._assistants.get(key, (None,))[0] == assistant_id:
+                del self._assistants[key]
+            if self._store is not None:
+                self._store.delete(key, assistant_id)
+
+    def _prepare_run(self, kind: str, rag_only: bool) -> Tuple[str, str]:
+        """実行前の準備（Assistantの取得・空のThreadの作成）を行い (assistant_id, thread_id) を返す"""
+        assistant_id = self._get_assistant_id(kind, rag_only)
+        return assistant_id, self.client.beta.threads.create().id
+
+    def _stream_assistant(
+        self,
+        kind: str,
+        rag_only: bool,
+        content: str,
+        prepared: Optional[Tuple[str, str]] = None
+    ) -> Generator[str, None, None]:
+        """
+        用途のAssistantでThreadをストリーミング実行し、返答を断片ごとに返す
+        prepared（_prepare_run の結果）があればそのThreadにメッセージを追加して実行する
+        返答が始まる前にRunが失敗した場合は RAGRunError を送出する。Threadは応答の後にバックグラウンドで削除する
+        """
+        if prepared is not None:
+            assistant_id, thread_id = prepared
+            try:
+                self.client.beta.threads.messages.create(thread_id=thread_id, role="user", content=content)
+            except Exception:
+                self._cleanup_thread(thread_id)
+                raise
+        else:
+            assistant_id = self._get_assistant_id(kind, rag_only)
+            # Threadを作成（メッセージも同時に作成）
+            thread_id = self.client.beta.threads.create(
+                messages=[{"role": "user", "content": content}]
+            ).id
+        try:
+            for attempt in range(2):
+                handler = RunEventHandler()
+                started = False
+                try:
+                    with self.client.beta.threads.runs.stream(
+                        thread_id=thread_id,
+                        assistant_id=assistant_id,
+                        event_handler=handler
+                    ) as stream:
+                        for text in stream.text_deltas:
+                            started = True
+                            yield text
+                except openai.NotFoundError:
+                    if started or attempt:
+                        raise
+                    # Assistantが外部で削除されていた場合は作り直して1回だけ再実行する
+                    self._forget_assistant(kind, rag_only, assistant_id)
+                    assistant_id = self._get_assistant_id(kind, rag_only)
+                    continue
+
+                if handler.failure is not None:
+                    if not started:
+                        raise RAGRunError(f"RAG run {handler.failure}")
+                    logging.warning(f"RAG run ended with {handler.failure} after partial output")
+                return
+        finally:
+            self._cleanup_thread(thread_id)
+
+    def _sentencing_content(self, incident_text: str, crime_names: str) -> str:
+        # 事件内容と罪名を組み合わせて送信
+        return f"""
+{incident_text}
+
+### 罪名
+{crime_names}
+"""
+
+    def stream_crime_with_rag(self, incident_text: str, rag_only: Optional[bool] = None) -> Generator[str, None, None]:
+        """RAGを使用した罪名予測（断片ごとに返す。失敗時は例外を送出する）"""
+        if rag_only is None:
+            rag_only = self.rag_only_mode
+        yield from self._stream_assistant("crime", rag_only, incident_text)
+
+    def stream_sentencing_with_rag(
+        self,
+        incident_text: str,
+        crime_names: str,
+        rag_only: Optional[bool] = None
+    ) -> Generator[str, None, None]:
+        """
+        RAGを使用した量刑予測（断片ごとに返す。失敗時は例外を送出する）
+        指示文で自然な文章を指定しているため、旧形式（JSON）の整形は predict_sentencing_with_rag だけで行う
+        """
         if rag_only is None:
             rag_only = self.rag_only_mode
+        yield from self._stream_assistant("sentencing", rag_only, self._sentencing_content(incident_text, crime_names))
+
+    def stream_crime_and_sentencing_with_rag(
+        self,
+        incident_text: str,
+        rag_only: Optional[bool] = None
+    ) -> Generator[str, None, None]:
+        """
+        RAGを使用した罪名と量刑の統合予測（【罪名予測】【量刑予測】の見出し付きで断片ごとに返す）
+
+        量刑予測のAssistant・Threadの準備は罪名予測の実行と並行して行い、
+        罪名予測の出力から罪名が揃った時点で（揃わなければ罪名予測の完了時に）量刑予測の実行を始める。
+        量刑予測の出力は罪名予測を返し終えるまでバッファし、その後に続けて返す。
+        罪名予測が何も返さずに失敗した場合は見出しだけを返して例外を送出する。
+        """
+        if rag_only is None:
+            rag_only = self.rag_only_mode
+
+        setup = self._executor.submit(self._prepare_run, "sentencing", rag_only)
+        sentencing = None
+        crime_text = ""
+
+        def start_sentencing(crime_names):
+            logging.info(f"Starting RAG sentencing prediction for: {crime_names}")
+            return BackgroundStream(lambda: self._stream_assistant(
+                "sentencing", rag_only, self._sentencing_content(incident_text, crime_names), prepared=setup.result()
+            ))
 
         try:
-            # Assistantを作成
-            assistant = self._create_crime_prediction_assistant(rag_only=rag_only)
-
-            # Threadを作成
-            thread = self.client.beta.threads.create()
-
-            # メッセージを作成
-            self.client.beta.threads.messages.create(
-                thread_id=thread.id,
-                role="user",
-                content=incident_text
-            )
-
-            # Runを実行
-            run = self.client.beta.threads.runs.create_and_poll(
-                thread_id=thread.id,
-                assistant_id=assistant.id
-            )
-
-            # 結果を取得
-            if run.status == 'completed':
-                messages = self.client.beta.threads.messages.list(
-                    thread_id=thread.id
+            yield CRIME_HEADING
+            for text in self.stream_crime_with_rag(incident_text, rag_only=rag_only):
+                crime_text += text
+                yield text
+                if sentencing is None:
+                    names = parse_crime_names(crime_text)
+                    if len(names) >= EXPECTED_CRIME_NAMES:
+                        sentencing = start_sentencing('\n'.join(names))
+
+            if sentencing is None:
+                sentencing = start_sentencing('\n'.join(parse_crime_names(crime_text + "\n")) or crime_text)
+
+            yield "\n\n【量刑予測】\n"
+            try:
+                yield from sentencing
+            except Exception as e:
+                logging.error(f"RAG sentencing prediction error: {e}")
+                yield "量刑予測に失敗しました。"
+            yield "\n"
+        finally:
+            if sentencing is not None:
+                sentencing.close()
+            else:
+                # 量刑予測を始めなかった場合は準備したThreadを削除する
+                setup.add_done_callback(
+                    lambda f: f.exception() is None and self._cleanup_thread(f.result()[1])
                 )
-                # 最新のアシスタントメッセージを取得
-                for message in messages.data:
-                    if message.role == "assistant":
-                        # テキストコンテンツを抽出
-                        for content in message.content:
-                            if hasattr(content, 'text'):
-                                result = content.text.value
-                                # クリーンアップ
-                                self._cleanup_assistant(assistant.id)
-                                self._cleanup_thread(thread.id)
-                                return result
+
+    def predict_crime_with_rag(self, incident_text: str, rag_only: Optional[bool] = None) -> str:
+        """RAGを使用した罪名予測"""
+        try:
+            result = ''.join(self.stream_crime_with_rag(incident_text, rag_only=rag_only))
+            if result:
+                return result
 
             # エラー時のフォールバック
-            self._cleanup_assistant(assistant.id)
-            self._cleanup_thread(thread.id)
             return "罪名予測に失敗しました。"
 
+        except RAGRunError as e:
+            logging.error(f"RAG crime prediction failed: {e}")
+            return "罪名予測に失敗しました。"
         except Exception as e:
             logging.error(f"RAG crime prediction error: {e}")
             return f"エラーが発生しました: {str(e)}"
@@ -227,60 +562,18 @@ class RAGAssistantManager:
         rag_only: Optional[bool] = None
     ) -> str:
         """RAGを使用した量刑予測"""
-        if rag_only is None:
-            rag_only = self.rag_only_mode
-
         try:
-            # Assistantを作成
-            assistant = self._create_sentencing_prediction_assistant(rag_only=rag_only)
-
-            # Threadを作成
-            thread = self.client.beta.threads.create()
-
-            # 事件内容と罪名を組み合わせて送信
-            combined_content = f"""
-{incident_text}
-
-### 罪名
-{crime_names}
-"""
-
-            self.client.beta.threads.messages.create(
-                thread_id=thread.id,
-                role="user",
-                content=combined_content
-            )
-
-            # Runを実行
-            run = self.client.beta.threads.runs.create_and_poll(
-                thread_id=thread.id,
-                assistant_id=assistant.id
-            )
-
-            # 結果を取得
-            if run.status == 'completed':
-                messages = self.client.beta.threads.messages.list(
-                    thread_id=thread.id
-                )
-                # 最新のアシスタントメッセージを取得
-                for message in messages.data:
-                    if message.role == "assistant":
-                        # テキストコンテンツを抽出
-                        for content in message.content:
-                            if hasattr(content, 'text'):
-                                result = content.text.value
-                                # 結果を整形（新形式は自然な文章、旧形式はJSON）
-                                formatted_result = self._format_sentencing_result(result)
-                                # クリーンアップ
-                                self._cleanup_assistant(assistant.id)
-                                self._cleanup_thread(thread.id)
-                                return formatted_result
+            result = ''.join(self.stream_sentencing_with_rag(incident_text, crime_names, rag_only=rag_only))
+            if result:
+                # 結果を整形（新形式は自然な文章、旧形式はJSON）
+                return self._format_sentencing_result(result)
 
             # エラー時のフォールバック
-            self._cleanup_assistant(assistant.id)
-            self._cleanup_thread(thread.id)
             return "量刑予測に失敗しました。"
 
+        except RAGRunError as e:
+            logging.error(f"RAG sentencing prediction failed: {e}")
+            return "量刑予測に失敗しました。"
         except Exception as e:
             logging.error(f"RAG sentencing prediction error: {e}")
             return f"エラーが発生しました: {str(e)}"
@@ -309,13 +602,17 @@ class RAGAssistantManager:
         except Exception as e:
             logging.warning(f"Failed to delete assistant {assistant_id}: {e}")
 
-    def _cleanup_thread(self, thread_id: str):
+    def _delete_thread(self, thread_id: str):
         """Threadを削除してリソースを解放"""
         try:
             self.client.beta.threads.delete(thread_id)
         except Exception as e:
             logging.warning(f"Failed to delete thread {thread_id}: {e}")
 
+    def _cleanup_thread(self, thread_id: str):
+        """Threadの削除をバックグラウンドに回す（応答を待たせない）"""
+        self._cleaner.submit(self._delete_thread, thread_id)
+
 
 # シングルトンインスタンス
 @lru_cache(maxsize=1)
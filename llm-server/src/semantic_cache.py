@@ -0,0 +1,234 @@
+"""
+言い換えに近い相談への意味キャッシュ
+
+ユーザー側の発話（正規化済み）をembeddingにし、保存済みの相談とのコサイン類似度で検索します。
+しきい値以上で一致した場合は、保存しておいた法プロセスの回答、または深掘り質問の第1回をそのまま返します。
+個人を特定しうる具体的な情報（数字・氏名・地名など）を含む相談は対象外です。
+深掘り質問は【現在判明している情報】（保存した相談者の事実）を除いた質問の部分だけを保存します。
+"""
+
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import src.config as config
+import src.embedding as emb
+
+
+KIND_ANSWER = "answer"
+KIND_CLARIFICATION = "clarification"
+
+# 個別具体的な情報の目安（数字・日付・金額、連絡先、敬称付きの人名、地名）
+PERSONAL_SPECIFICS_PATTERNS = [
+    re.compile(r"[0-9０-９一二三四五六七八九十百千万]+\s*(歳|才|円|万|年|月|日|時|分|回|人|km|キロ|%|％)"),
+    re.compile(r"[0-9０-９]{2,}"),
+    re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+"),
+    re.compile(r"\S{1,6}(さん|様|氏|君|くん|ちゃん)"),
+    re.compile(r"[一-龥]{1,6}(都|道|府|県|市|区|町|村|駅)"),
+]
+# 深掘り質問の【現在判明している情報】のブロック（見出しと「・」で始まる行、続く空行）
+KNOWN_FACTS_BLOCK = re.compile(r"【現在判明している情報】\n(?:・[^\n]*\n)*\n?")
+PUNCTUATION = re.compile(r"[\s、。，．,.!！?？「」『』（）()・…ー〜~]+")
+
+
+def has_personal_specifics(text: str) -> bool:
+    text = unicodedata.normalize("NFKC", text)
+    return any(pattern.search(text) for pattern in PERSONAL_SPECIFICS_PATTERNS)
+
+
+def question_portion(response: str) -> str:
+    """深掘り質問から【現在判明している情報】を除く（他の相談者に元の相談者の事実を見せない）"""
+    return KNOWN_FACTS_BLOCK.sub("", response, count=1)
+
+
+def normalize_user_history(hist: List[Dict], genre_label: str = "") -> str:
+    """ユーザー発話のみを連結し、表記ゆれ（全角半角・句読点・空白）をならす"""
+    user_texts = [h["content"] for h in hist if h.get("role") == "user"]
+    text = unicodedata.normalize("NFKC", "\n".join(user_texts)).lower()
+    text = PUNCTUATION.sub(" ", text).strip()
+    return f"[{genre_label}] {text}" if genre_label else text
+
+
+class SemanticCache:
+    def __init__(self, path: str, max_entries: int, threshold: float):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._entries: List[Dict] = []
+        self._matrix = np.zeros((0, 0), dtype=np.float32)  # 正規化済みembedding（行ごと）
+        self._stats = {
+            "lookups": 0,
+            "hits": 0,
+            "stores": 0,
+            "saved_ms": 0.0,
+            "saved_chars": 0,
+            "hits_by_type": {}
+        }
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT, response_type TEXT, kind TEXT, "
+            "response TEXT, generation_ms REAL, embedding BLOB, created_at REAL)"
+        )
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        rows = self._conn.execute(
+            "SELECT id, text, response_type, kind, response, generation_ms, embedding "
+            "FROM semantic_cache ORDER BY id"
+        ).fetchall()
+        vectors = []
+        stripped = []
+        for row_id, text, response_type, kind, response, generation_ms, blob in rows:
+            if kind == KIND_CLARIFICATION and question_portion(response) != response:
+                # 判明事実を含めて保存されていた深掘り質問は質問の部分だけに書き換える
+                response = question_portion(response)
+                stripped.append((response, row_id))
+            self._entries.append({
+                "id": row_id,
+                "text": text,
+                "response_type": response_type,
+                "kind": kind,
+                "response": response,
+                "generation_ms": generation_ms
+            })
+            vectors.append(np.frombuffer(blob, dtype=np.float32))
+        if vectors:
+            self._matrix = np.vstack(vectors)
+        if stripped:
+            self._conn.executemany("UPDATE semantic_cache SET response = ? WHERE id = ?", stripped)
+            self._conn.commit()
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, vector, kinds: List[str]) -> Optional[Dict]:
+        """返してよい種類（kinds）の保存済み相談のうち最も類似したものを返す（しきい値未満ならNone）"""
+        query = self._normalize(vector)
+        with self._lock:
+            self._stats["lookups"] += 1
+            if not self._entries:
+                return None
+            # 返してよい種類の相談だけを候補にしてから最も類似したものを選ぶ
+            candidates = np.flatnonzero([entry["kind"] in kinds for entry in self._entries])
+            if not len(candidates):
+                return None
+            similarities = self._matrix[candidates] @ query
+            position = int(similarities.argmax())
+            if similarities[position] < self.threshold:
+                return None
+            best = int(candidates[position])
+            entry = self._entries[best]
+
+            self._stats["hits"] += 1
+            self._stats["saved_ms"] += entry["generation_ms"]
+            self._stats["saved_chars"] += len(entry["response"])
+            by_type = self._stats["hits_by_type"]
+            by_type[entry["response_type"]] = by_type.get(entry["response_type"], 0) + 1
+            return dict(entry, similarity=float(similarities[position]))
+
+    def add(self, vector, text: str, response_type: str, kind: str, response: str, generation_ms: float):
+        vector = self._normalize(vector)
+        if kind == KIND_CLARIFICATION:
+            response = question_portion(response)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO semantic_cache (text, response_type, kind, response, generation_ms, embedding, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (text, response_type, kind, response, generation_ms, vector.tobytes(), time.time())
+            )
+            self._entries.append({
+                "id": cursor.lastrowid,
+                "text": text,
+                "response_type": response_type,
+                "kind": kind,
+                "response": response,
+                "generation_ms": generation_ms
+            })
+            self._matrix = vector[None, :] if self._matrix.size == 0 else np.vstack([self._matrix, vector])
+            self._stats["stores"] += 1
+
+            # 上限を超えたら古い順に削除
+            overflow = len(self._entries) - self.max_entries
+            if overflow > 0:
+                removed = self._entries[:overflow]
+                self._entries = self._entries[overflow:]
+                self._matrix = self._matrix[overflow:]
+                self._conn.executemany("DELETE FROM semantic_cache WHERE id = ?", [(e["id"],) for e in removed])
+            self._conn.commit()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats, hits_by_type=dict(self._stats["hits_by_type"]))
+            stats["entries"] = len(self._entries)
+        stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
+
+
+class SemanticProbe:
+    """1ターン分の検索結果。ミスした場合は生成した応答をstoreで保存する"""
+
+    def __init__(self, cache: SemanticCache, text: str, vector, hit: Optional[Dict]):
+        self.cache = cache
+        self.text = text
+        self.vector = vector
+        self.hit = hit
+        self.started_at = time.monotonic()
+
+    def store(self, response_type: Optional[str], kind: str, response: str):
+        if not response or response_type not in config.SEMANTIC_CACHE_RESPONSE_TYPES:
+            return
+        generation_ms = (time.monotonic() - self.started_at) * 1000
+        try:
+            self.cache.add(self.vector, self.text, response_type, kind, response, generation_ms)
+        except sqlite3.Error as e:
+            logging.error(f"Semantic cache write failed: {e}")
+
+
+@lru_cache(maxsize=1)
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """意味キャッシュのシングルトン（無効化されている場合はNone）"""
+    if not config.SEMANTIC_CACHE_ENABLED:
+        return None
+    return SemanticCache(
+        config.SEMANTIC_CACHE_PATH,
+        max_entries=config.SEMANTIC_CACHE_MAX_ENTRIES,
+        threshold=config.SEMANTIC_CACHE_THRESHOLD
+    )
+
+
+def probe(hist: List[Dict], genre_label: str, kinds: List[str]) -> Optional[SemanticProbe]:
+    """
+    対象ターンならembeddingを作って検索する
+    キャッシュが無効・具体的な情報を含む・embedding取得に失敗した場合はNone
+    """
+    cache = get_semantic_cache()
+    if cache is None or not kinds:
+        return None
+    if any(has_personal_specifics(h["content"]) for h in hist if h.get("role") == "user"):
+        return None
+
+    text = normalize_user_history(hist, genre_label)
+    try:
+        vector = emb.ada(text)
+    except Exception as e:
+        logging.error(f"Semantic cache embedding failed: {e}")
+        return None
+    return SemanticProbe(cache, text, vector, cache.lookup(vector, kinds))
+
+
+def get_semantic_cache_stats() -> Dict:
+    cache = get_semantic_cache()
+    return cache.get_stats() if cache is not None else {}
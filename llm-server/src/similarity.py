@@ -0,0 +1,137 @@
+"""
+embeddingのコサイン類似度と上位k件の検索
+
+保存側のベクトルはL2正規化したfloat32行列として1回だけ作り、検索は内積（行列積）1回で類似度を求める。
+複数のクエリは (クエリ数 × 次元) の行列にして1回の行列積でまとめて計算し、上位k件は argpartition で取る（全件は並べ替えない）。
+tag（rag_loader の "種別_分類" など）による絞り込みは、該当する行だけを対象に計算する。
+同じリスト（gen/rag の refs など）に対して繰り返し検索する場合は cached_index で作ったインデックスを使い回す。
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Collection, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+
+TagFilter = Optional[Union[str, Collection[str]]]
+
+# cached_index で保持するインデックスの数
+INDEX_CACHE_SIZE = 8
+_index_cache: "OrderedDict[int, tuple]" = OrderedDict()  # id(items) -> (items, 件数, SimilarityIndex)
+_index_cache_lock = threading.Lock()
+
+
+def normalize_rows(vectors: Union[Sequence[Sequence[float]], np.ndarray]) -> np.ndarray:
+    """float32にしてL2正規化する（ゼロベクトルはそのまま）"""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[None, :]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコアの上位k件の位置（スコアの高い順）。全件は並べ替えない"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """(クエリ数 × 行数) のスコアの各行について上位k件の位置（スコアの高い順）"""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def cosine_similarity(a, b) -> float:
+    """2つのベクトルのコサイン類似度"""
+    return float(normalize_rows(a)[0] @ normalize_rows(b)[0])
+
+
+class SimilarityIndex:
+    """
+    正規化済みのembedding行列（と行ごとのtag）に対する類似検索
+    normalized=True の場合は vectors をそのまま使う（vector_index のmmapした行列など。コピーしない）
+    """
+
+    def __init__(self, vectors, tags: Optional[Sequence[str]] = None, normalized: bool = False):
+        if normalized:
+            self.matrix = vectors
+        elif len(vectors):
+            self.matrix = normalize_rows(vectors)
+        else:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.tags = list(tags) if tags is not None else None
+        self._tag_rows: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.matrix)
+
+    def rows_for(self, tag: TagFilter) -> Optional[np.ndarray]:
+        """tag に一致する行番号（tag がNoneなら全行 = None）"""
+        if tag is None:
+            return None
+        if self.tags is None:
+            raise ValueError("this index has no tags to filter on")
+        wanted = [tag] if isinstance(tag, str) else sorted(tag)
+        missing = [name for name in wanted if name not in self._tag_rows]
+        if missing:
+            tags = np.asarray(self.tags)
+            for name in missing:
+                self._tag_rows[name] = np.flatnonzero(tags == name)
+        if len(wanted) == 1:
+            return self._tag_rows[wanted[0]]
+        return np.sort(np.concatenate([self._tag_rows[name] for name in wanted]))
+
+    def search_batch(self, queries, k: int = 3, tag: TagFilter = None) -> List[List[Tuple[int, float]]]:
+        """複数のクエリをまとめて検索し、クエリごとに (行番号, 類似度) を類似度の高い順にk件返す"""
+        query_matrix = normalize_rows(queries)
+        rows = self.rows_for(tag)
+        if not len(self) or (rows is not None and not len(rows)):
+            return [[] for _ in range(len(query_matrix))]
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        scores = query_matrix @ matrix.T
+        results = []
+        for query_scores, positions in zip(scores, top_k_rows(scores, k)):
+            indices = positions if rows is None else rows[positions]
+            results.append([(int(i), float(s)) for i, s in zip(indices, query_scores[positions])])
+        return results
+
+    def search(self, query, k: int = 3, tag: TagFilter = None) -> List[Tuple[int, float]]:
+        """クエリとコサイン類似度の高い順に (行番号, 類似度) をk件返す"""
+        return self.search_batch(normalize_rows(query), k, tag)[0]
+
+
+def cached_index(items, build: Callable[[], SimilarityIndex]) -> SimilarityIndex:
+    """
+    items（refs・embeddingのリストなど）ごとに build() で作ったインデックスを再利用する
+    同じオブジェクトで件数も変わっていなければ作り直さない（要素をその場で書き換えた場合は検出しない）。
+    items への参照を保持するため、id が別のオブジェクトに再利用されることはない
+    """
+    key = id(items)
+    with _index_cache_lock:
+        entry = _index_cache.get(key)
+        if entry is not None and entry[0] is items and entry[1] == len(items):
+            _index_cache.move_to_end(key)
+            return entry[2]
+    index = build()
+    with _index_cache_lock:
+        _index_cache[key] = (items, len(items), index)
+        _index_cache.move_to_end(key)
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
@@ -0,0 +1,134 @@
+"""
+回答の投機的生成
+
+深掘り質問が必要かどうかの判定中に、最終回答のストリームを先行して開始し断片をバッファしておく。
+判定の結果、回答してよければバッファを流してそのまま続きを返し、深掘りする場合は上流を閉じて破棄する。
+無駄になった生成量は文字数（トークン数の目安）で数え、1ターンあたり・1時間あたりの上限で抑える。
+"""
+
+import asyncio
+import logging
+import time
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List, Optional
+
+import src.config as config
+
+
+WASTE_WINDOW_SECONDS = 3600
+
+_stats = {
+    "started": 0,
+    "committed": 0,
+    "cancelled": 0,
+    "over_budget": 0,
+    "wasted_chars": 0
+}
+_window_start = time.monotonic()
+_window_wasted_chars = 0
+
+
+def get_speculation_stats() -> Dict[str, int]:
+    return dict(_stats)
+
+
+def _record_waste(chars: int):
+    global _window_start, _window_wasted_chars
+    now = time.monotonic()
+    if now - _window_start >= WASTE_WINDOW_SECONDS:
+        _window_start = now
+        _window_wasted_chars = 0
+    _window_wasted_chars += chars
+    _stats["wasted_chars"] += chars
+
+
+def speculation_allowed() -> bool:
+    """投機的生成が有効で、直近1時間の無駄な生成量が上限内か"""
+    if not config.SPECULATIVE_ANSWER_ENABLED:
+        return False
+    if time.monotonic() - _window_start >= WASTE_WINDOW_SECONDS:
+        return True
+    return _window_wasted_chars < config.SPECULATIVE_WASTE_BUDGET_CHARS
+
+
+class SpeculativeAnswer:
+    """
+    回答ストリームをバックグラウンドで読み進め、断片をバッファする
+    確定前に上限文字数に達した場合は投機を打ち切り、確定時は通常どおり回答を生成し直す
+    """
+
+    def __init__(self, stream_factory: Callable[[], Awaitable[AsyncGenerator[str, None]]], label: str = ""):
+        self.label = label
+        self._chunks: List[str] = []
+        self._chars = 0
+        self._done = False
+        self._abandoned = False
+        self._committed = False
+        self._error: Optional[BaseException] = None
+        self._updated = asyncio.Event()
+        self._task = asyncio.create_task(self._run(stream_factory))
+        _stats["started"] += 1
+
+    async def _run(self, stream_factory):
+        stream = None
+        try:
+            stream = await stream_factory()
+            async for chunk in stream:
+                self._chunks.append(chunk)
+                self._chars += len(chunk)
+                self._updated.set()
+                if not self._committed and self._chars >= config.SPECULATIVE_MAX_CHARS:
+                    logging.info("Speculative answer %s exceeded %d chars", self.label, config.SPECULATIVE_MAX_CHARS)
+                    _stats["over_budget"] += 1
+                    self._abandon()
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._error = e
+            if not self._committed:
+                self._abandon()
+        finally:
+            if stream is not None:
+                await stream.aclose()
+            self._done = True
+            self._updated.set()
+
+    def _abandon(self):
+        if not self._abandoned:
+            self._abandoned = True
+            _record_waste(self._chars)
+
+    def commit(self) -> Optional[AsyncGenerator[str, None]]:
+        """
+        回答を確定し、バッファ済みの断片から順に返すジェネレータを返す
+        投機が打ち切られていた場合はNone（呼び出し側で通常の生成を行う）
+        """
+        if self._abandoned:
+            return None
+        self._committed = True
+        _stats["committed"] += 1
+        return self._replay()
+
+    async def _replay(self) -> AsyncGenerator[str, None]:
+        sent = 0
+        while True:
+            while sent < len(self._chunks):
+                yield self._chunks[sent]
+                sent += 1
+            if self._done:
+                break
+            self._updated.clear()
+            if sent < len(self._chunks) or self._done:
+                continue
+            await self._updated.wait()
+        if self._error is not None:
+            raise self._error
+
+    async def cancel(self):
+        """上流のストリームを閉じる（確定前なら投機分を破棄として記録する）"""
+        if not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if not self._committed and not self._abandoned:
+            _stats["cancelled"] += 1
+            self._abandon()
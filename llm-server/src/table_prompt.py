@@ -0,0 +1,124 @@
+"""
+罪名予測テーブル・ヒアリング項目のプロンプト向けのコンパクトな表現
+
+参照シートのCSVは空セルと◯が大半を占め、罪名予測の指示（make_inst）の入力トークンの大部分になる。
+◯の位置だけが情報なので、罪名ごとに◯がついている判断基準だけを1行に並べ、
+複数の罪名で使われる判断基準は冒頭の一覧に番号で1回だけ書く（番号にしても短くならない基準は行内にそのまま書く）。
+どの罪名にも◯がない判断基準は候補の特定に使われないため省く。
+
+量刑予測ヒアリングシート・詳細ヒアリング項目のカテゴリごとの項目一覧も、
+複数のカテゴリに共通する項目を同じく番号の一覧にまとめる。
+
+シート全体の表現はテーブルのスナップショット（table_registry）ごとにキャッシュし、CSVと比べて減ったトークン数を記録する。
+"""
+
+import logging
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from src.crime_table_index import CrimeTable
+from src.history_packer import count_tokens
+from src.table_registry import TableSnapshot, current_tables
+
+
+LEGEND_HEADER = "判断基準一覧（番号で参照）:"
+ROWS_HEADER = "罪名ごとの◯がついている判断基準:"
+FEATURE_LEGEND_HEADER = "共通項目一覧（番号で参照）:"
+NO_MARK = "（該当基準なし）"
+# 番号の一覧の1項目あたりの付加文字数（番号・区切り・改行）と、参照する番号の文字数の目安
+LEGEND_ENTRY_OVERHEAD = 4
+NUMBER_CHARS = 2
+# ヒアリングシートの列のうち、確認項目ではないもの
+NON_ITEM_COLUMNS = ("ID（通し番号）", "罪名")
+
+# シート名 → {"csv_tokens", "compact_tokens", "saved_tokens"}
+_token_report: Dict[str, Dict[str, int]] = {}
+
+
+def _worth_numbering(text: str, usage: int) -> bool:
+    """一覧に番号で書いた方が、使われる箇所ごとに文言を書くより短くなるか（文字数で概算）"""
+    return usage >= 2 and usage * len(text) > len(text) + LEGEND_ENTRY_OVERHEAD + usage * NUMBER_CHARS
+
+
+def compile_table(table: CrimeTable, crimes: Optional[Iterable[str]] = None) -> str:
+    """
+    罪名予測テーブルを、罪名ごとに◯のついた判断基準を並べる形式にする（crimes指定時はその行だけ）
+    表に行がない場合は空文字
+    """
+    if crimes is None:
+        rows = np.arange(len(table.crimes))
+    else:
+        rows = np.array(sorted({table.crime_index[c] for c in crimes if c in table.crime_index}), dtype=int)
+    if not len(rows):
+        return ""
+    matrix = table.matrix[rows]
+    usage = matrix.sum(axis=0)
+    shared = [j for j in range(len(table.criteria)) if _worth_numbering(table.criteria[j], int(usage[j]))]
+    numbers = {j: n for n, j in enumerate(shared, start=1)}
+
+    lines = []
+    if shared:
+        lines.append(LEGEND_HEADER)
+        lines.extend(f"{numbers[j]}. {table.criteria[j]}" for j in shared)
+        lines.append("")
+    lines.append(ROWS_HEADER)
+    for i, row in zip(rows, matrix):
+        marks = [str(numbers[j]) if j in numbers else table.criteria[j] for j in np.flatnonzero(row)]
+        lines.append(f"- {table.crimes[i]}: {', '.join(marks) if marks else NO_MARK}")
+    return "\n".join(lines)
+
+
+def compiled_sheet(sheet: str, snapshot: Optional[TableSnapshot] = None) -> Optional[str]:
+    """参照シート全体のコンパクト表現（スナップショットごとにキャッシュ。テーブルにない・空のシートはNone）"""
+    def compile_sheet(snapshot):
+        table = snapshot.crime_tables.get(sheet)
+        compact = compile_table(table) if table is not None else ""
+        return compact or None
+    return (snapshot or current_tables()).memo(("compiled_sheet", sheet), compile_sheet)
+
+
+def compile_feature_mapping(features: Dict[str, List[str]]) -> str:
+    """
+    カテゴリ → 項目のリストを、共通項目を番号の一覧にまとめた形式にする
+    カテゴリが1つなら項目をそのまま並べる
+    """
+    features = {
+        name: [item for item in items if item not in NON_ITEM_COLUMNS]
+        for name, items in sorted(features.items())
+    }
+    features = {name: items for name, items in features.items() if items}
+    counts: Dict[str, int] = {}
+    for items in features.values():
+        for item in set(items):
+            counts[item] = counts.get(item, 0) + 1
+    shared = [item for item in counts if _worth_numbering(item, counts[item])]
+    shared.sort(key=lambda item: (-counts[item], item))
+    numbers = {item: n for n, item in enumerate(shared, start=1)}
+
+    lines = []
+    if shared:
+        lines.append(FEATURE_LEGEND_HEADER)
+        lines.extend(f"{numbers[item]}. {item}" for item in shared)
+        lines.append("")
+    for name, items in features.items():
+        lines.append(f"- {name}: {', '.join(str(numbers[item]) if item in numbers else item for item in items)}")
+    return "\n".join(lines)
+
+
+def record_savings(name: str, original: str, compact: str) -> Dict[str, int]:
+    """元の表現（CSV・カンマ区切りの一覧）と比べて減ったトークン数を記録して返す"""
+    csv_tokens = count_tokens(original)
+    compact_tokens = count_tokens(compact)
+    _token_report[name] = {
+        "csv_tokens": csv_tokens,
+        "compact_tokens": compact_tokens,
+        "saved_tokens": csv_tokens - compact_tokens
+    }
+    logging.info("Compiled table prompt for %s: %d -> %d tokens", name, csv_tokens, compact_tokens)
+    return dict(_token_report[name])
+
+
+def get_token_report() -> Dict[str, Dict[str, int]]:
+    """これまでにコンパクト化したシート・項目一覧ごとのトークン数"""
+    return {name: dict(report) for name, report in _token_report.items()}
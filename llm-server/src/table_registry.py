@@ -0,0 +1,259 @@
+"""
+罪名予測テーブル・量刑予測ヒアリングシートのレジストリ
+
+各シートを1回だけ読み込んで型のある構造（CrimeTable・項目の一覧・プロンプト用のCSV）にし、
+罪名予測（predict_crime_type）・深掘り判定（chat）・質問選択・RAGデータ生成の全てに同じものを渡す。
+読み込んだ結果は読み取り専用のスナップショットとして保持し、ファイルの更新（mtime・サイズ）を
+バックグラウンドで確認して、変更があれば新しいスナップショットを作ってから参照を差し替える。
+差し替えは参照の代入1回のため、読み込み中・差し替え中のリクエストは古いスナップショットをそのまま使える。
+
+プロンプト用のコンパクト表現など、テーブルから作る値はスナップショットごとに memo でキャッシュする。
+on_reload で登録した関数は差し替え前に新しいスナップショットで呼ばれ、これらの値を事前に作っておける
+（更新後の最初のリクエストで作り直しを待たせない）。
+"""
+
+import logging
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+import src.config as config
+from src.crime_table_index import BIG_CATEGORY, TABLE_DIRS, CrimeTable, _normalize, read_rows, sheet_files
+
+
+SENTENCING_DIR = Path("量刑予測ヒアリングシート")
+SENTENCING_PREFIX = "量刑予測_ヒアリングシート - "
+# 量刑予測ヒアリングシートの先頭の列（ID（通し番号）・罪名）は確認項目ではない
+SENTENCING_ITEM_START = 2
+
+# 新しいスナップショットで呼ぶ関数（差し替え前の事前計算）
+_reload_hooks: List[Callable[["TableSnapshot"], Any]] = []
+
+
+def sentencing_files(directory: Path = SENTENCING_DIR) -> List[Tuple[str, Path]]:
+    """量刑予測ヒアリングシートを (カテゴリ名, パス) で返す"""
+    if not directory.exists():
+        return []
+    files = []
+    for path in sorted(directory.glob("*.tsv")):
+        name = _normalize(path.stem)
+        if name.startswith(SENTENCING_PREFIX):
+            files.append((name[len(SENTENCING_PREFIX):].strip(), path))
+    return files
+
+
+def source_files(
+    table_dirs: Iterable[Path] = TABLE_DIRS,
+    sentencing_dir: Path = SENTENCING_DIR
+) -> List[Path]:
+    """レジストリが読み込む全ファイル"""
+    return [path for _, path in sheet_files(table_dirs)] + [path for _, path in sentencing_files(sentencing_dir)]
+
+
+def file_signature(paths: Iterable[Path]) -> Dict[str, Tuple[int, int]]:
+    """ファイルごとの (mtime_ns, サイズ)。シートの追加・削除も差分になる"""
+    signature = {}
+    for path in paths:
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        signature[str(path)] = (stat.st_mtime_ns, stat.st_size)
+    return signature
+
+
+class TableSnapshot:
+    """ある時点のテーブル一式（読み取り専用。更新時は新しいスナップショットに差し替える）"""
+
+    def __init__(
+        self,
+        version: int,
+        signature: Dict[str, Tuple[int, int]],
+        crime_tables: Dict[str, CrimeTable],
+        crime_csv: Dict[str, str],
+        sentencing_features: Dict[str, List[str]],
+        sources: Dict[str, str]
+    ):
+        self.version = version
+        self.signature = signature
+        self.crime_tables = crime_tables  # シート名 → ◯行列
+        self.crime_csv = crime_csv  # シート名 → プロンプト用のCSV（大分類を含む）
+        self.sentencing_features = sentencing_features  # カテゴリ名 → 確認項目
+        self.sources = sources  # シート名・カテゴリ名 → 読み込んだファイル
+        self.loaded_at = time.time()
+        self._memo: Dict[Any, Any] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def topics_csv(self) -> str:
+        """大分類シートのCSV"""
+        return self.crime_csv.get(BIG_CATEGORY, "")
+
+    @property
+    def crime_sheets(self) -> Dict[str, str]:
+        """参照シート名 → CSV（大分類を除く）"""
+        return {name: text for name, text in self.crime_csv.items() if name != BIG_CATEGORY}
+
+    @property
+    def big_categories(self) -> List[Dict]:
+        """大分類ごとの {'name', 'features': ◯がついた判断基準}"""
+        table = self.crime_tables.get(BIG_CATEGORY)
+        if table is None:
+            return []
+        return [{'name': name, 'features': table.marked_criteria(name)} for name in table.crimes]
+
+    @property
+    def detail_features(self) -> Dict[str, List[str]]:
+        """参照シート名 → 判断基準（罪名予測の詳細ヒアリング項目）"""
+        return {
+            name: list(table.criteria)
+            for name, table in self.crime_tables.items() if name != BIG_CATEGORY
+        }
+
+    def memo(self, key: Any, factory: Callable[["TableSnapshot"], Any]) -> Any:
+        """このスナップショットから作る値のキャッシュ（factoryはスナップショットを受け取る）"""
+        with self._lock:
+            if key in self._memo:
+                return self._memo[key]
+        value = factory(self)
+        with self._lock:
+            return self._memo.setdefault(key, value)
+
+
+def build_snapshot(
+    version: int,
+    table_dirs: Iterable[Path] = TABLE_DIRS,
+    sentencing_dir: Path = SENTENCING_DIR
+) -> TableSnapshot:
+    """ファイルを読み込んでスナップショットを作る（読み込めないシートは飛ばす）"""
+    table_dirs = list(table_dirs)
+    signature = file_signature(source_files(table_dirs, sentencing_dir))
+    crime_tables = {}
+    crime_csv = {}
+    sentencing_features = {}
+    sources = {}
+
+    for name, path in sheet_files(table_dirs):
+        try:
+            rows = read_rows(path)
+        except (OSError, UnicodeDecodeError) as e:
+            logging.error("Failed to load crime table %s: %s", path, e)
+            continue
+        if not rows:
+            continue
+        crime_tables[name] = CrimeTable.from_rows(name, rows)
+        crime_csv[name] = '\n'.join(','.join(_normalize(cell) for cell in row) for row in rows)
+        sources[name] = str(path)
+
+    for name, path in sentencing_files(sentencing_dir):
+        try:
+            rows = read_rows(path)
+        except (OSError, UnicodeDecodeError) as e:
+            logging.error("Failed to load sentencing sheet %s: %s", path, e)
+            continue
+        if not rows:
+            continue
+        items = [_normalize(h) for h in rows[0][SENTENCING_ITEM_START:]]
+        sentencing_features[name] = [item for item in items if item]
+        sources[f"{SENTENCING_PREFIX}{name}"] = str(path)
+
+    return TableSnapshot(version, signature, crime_tables, crime_csv, sentencing_features, sources)
+
+
+def on_reload(hook: Callable[[TableSnapshot], Any]) -> Callable[[TableSnapshot], Any]:
+    """新しいスナップショットに差し替える前に呼ぶ関数を登録する（デコレータとしても使える）"""
+    _reload_hooks.append(hook)
+    return hook
+
+
+def warm(snapshot: TableSnapshot):
+    """登録された事前計算を実行する（失敗しても差し替えは止めない）"""
+    for hook in list(_reload_hooks):
+        try:
+            hook(snapshot)
+        except Exception as e:
+            logging.error("Table registry warm-up %s failed: %s", getattr(hook, '__name__', hook), e)
+
+
+class TableRegistry:
+    """現在のスナップショットを保持し、ファイルの更新時に作り直して差し替える"""
+
+    def __init__(
+        self,
+        table_dirs: Iterable[Path] = TABLE_DIRS,
+        sentencing_dir: Path = SENTENCING_DIR,
+        interval: float = 0
+    ):
+        self.table_dirs = list(table_dirs)
+        self.sentencing_dir = sentencing_dir
+        self.interval = interval
+        self._reload_lock = threading.Lock()
+        self._thread = None
+        self._snapshot = build_snapshot(1, self.table_dirs, self.sentencing_dir)
+
+    @property
+    def snapshot(self) -> TableSnapshot:
+        return self._snapshot
+
+    def changed(self) -> bool:
+        """読み込み後にファイルが更新・追加・削除されたか"""
+        return file_signature(source_files(self.table_dirs, self.sentencing_dir)) != self._snapshot.signature
+
+    def reload_if_changed(self) -> bool:
+        """
+        ファイルが変わっていればスナップショットを作り直し、事前計算してから差し替える
+        読み込みに失敗した場合は古いスナップショットを使い続ける
+        """
+        with self._reload_lock:
+            if not self.changed():
+                return False
+            current = self._snapshot
+            try:
+                snapshot = build_snapshot(current.version + 1, self.table_dirs, self.sentencing_dir)
+            except Exception as e:
+                logging.error("Failed to reload tables: %s", e)
+                return False
+            warm(snapshot)
+            self._snapshot = snapshot
+        logging.info("Reloaded tables (version %d, %d files)", snapshot.version, len(snapshot.signature))
+        return True
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                logging.error("Table watcher failed: %s", e)
+
+    def start(self):
+        """更新の確認をバックグラウンドで始める（interval が0以下なら何もしない）"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._watch, name="table-registry-watcher", daemon=True)
+        self._thread.start()
+
+    def stats(self) -> Dict:
+        snapshot = self._snapshot
+        return {
+            "version": snapshot.version,
+            "loaded_at": snapshot.loaded_at,
+            "crime_sheets": len(snapshot.crime_tables),
+            "sentencing_sheets": len(snapshot.sentencing_features),
+            "watching": self._thread is not None
+        }
+
+
+@lru_cache(maxsize=1)
+def get_table_registry() -> TableRegistry:
+    """テーブルレジストリのシングルトン（作成時に更新の確認を始める）"""
+    registry = TableRegistry(interval=config.TABLE_RELOAD_INTERVAL)
+    registry.start()
+    return registry
+
+
+def current_tables() -> TableSnapshot:
+    """現在のスナップショット。1つの処理の中では同じものを使い回すこと"""
+    return get_table_registry().snapshot
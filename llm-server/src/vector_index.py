@@ -0,0 +1,188 @@
+"""
+RAGデータ（rag_loader の出力）のベクトルインデックス
+
+質問ごとのpickle（.ref）の代わりに、次の3ファイルにまとめて保存する。
+  vectors.npy   : 全行のembeddingをL2正規化したfloat32行列（行数 × 次元）
+  records.jsonl : 行ごとの text・tag・metadata（1行1JSON）
+  offsets.npy   : records.jsonl の各行の開始バイト位置（行数 + 1 個のint64）
+
+読み込みは np.load(mmap_mode='r') と mmap で行うため、ファイルを開くだけでほぼ一瞬で終わり、
+複数のワーカープロセスが同じページキャッシュを共有する。
+検索は正規化済みの行列をそのまま similarity.SimilarityIndex に渡して行う（内積1回 = コサイン類似度、argpartition で上位k件）。
+
+再生成したインデックスは versions/<版>/ に書き込んでから CURRENT（現在の版の名前）を差し替えるため、
+読み手は常に書き込みの終わった版（metadata.json を含む）だけを開く。
+"""
+
+import json
+import mmap
+import os
+import shutil
+import time
+import uuid
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from src.similarity import SimilarityIndex, TagFilter, normalize_rows, top_k
+
+
+VECTORS_FILE = "vectors.npy"
+RECORDS_FILE = "records.jsonl"
+OFFSETS_FILE = "offsets.npy"
+METADATA_FILE = "metadata.json"
+CURRENT_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+# 公開後も残す版の数（現在の版と直前の版。差し替えの直前に直前の版を開きかけたプロセスが読めるようにする）
+KEEP_VERSIONS = 2
+
+
+def write_index(directory: Union[str, Path], embeddings, records: List[Dict]):
+    """
+    embedding（行数 × 次元）と行ごとのレコード（text・tag・metadata など）をインデックスとして保存する
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    if len(records) != len(embeddings):
+        raise ValueError(f"records ({len(records)}) and embeddings ({len(embeddings)}) differ in length")
+
+    offsets = [0]
+    with open(directory / RECORDS_FILE, "wb") as f:
+        for record in records:
+            line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+
+    vectors = normalize_rows(embeddings) if len(records) else np.zeros((0, 0), dtype=np.float32)
+    np.save(directory / VECTORS_FILE, vectors)
+    np.save(directory / OFFSETS_FILE, np.array(offsets, dtype=np.int64))
+
+
+def _write_atomic(path: Path, text: str):
+    """一時ファイルに書いてから置き換える"""
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def resolve_index_dir(directory: Union[str, Path]) -> Path:
+    """現在の版のディレクトリ（CURRENT がなければ directory 自体）"""
+    directory = Path(directory)
+    current = directory / CURRENT_FILE
+    if current.exists():
+        return directory / VERSIONS_DIR / current.read_text(encoding="utf-8").strip()
+    return directory
+
+
+def publish_index(directory: Union[str, Path], embeddings, records: List[Dict], metadata: Optional[Dict] = None) -> Path:
+    """
+    新しい版としてインデックスと metadata.json を書き込み、CURRENT を差し替えて公開する
+    公開後、KEEP_VERSIONS 個より古い版は削除する（開いているプロセスのmmapは削除後も有効）
+    """
+    directory = Path(directory)
+    created_ns = time.time_ns()
+    version = (
+        f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(created_ns // 10**9))}"
+        f"-{created_ns % 10**9:09d}-{uuid.uuid4().hex[:8]}"
+    )
+    target = directory / VERSIONS_DIR / version
+    write_index(target, embeddings, records)
+    metadata_text = json.dumps(metadata or {}, ensure_ascii=False, indent=2)
+    _write_atomic(target / METADATA_FILE, metadata_text)
+
+    _write_atomic(directory / CURRENT_FILE, version)
+    # 版の外を見る既存の利用者向けの metadata.json も置き換える
+    _write_atomic(directory / METADATA_FILE, metadata_text)
+
+    # 版の名前は作成時刻から始まるため、名前順が作成順になる
+    versions = sorted(p for p in (directory / VERSIONS_DIR).iterdir() if p.is_dir() and p.name != version)
+    for old in versions[:max(0, len(versions) - (KEEP_VERSIONS - 1))]:
+        shutil.rmtree(old, ignore_errors=True)
+    return target
+
+
+class VectorIndex:
+    """保存したインデックスを読み取り専用で開いたもの"""
+
+    def __init__(self, directory: Union[str, Path]):
+        self._similarity = None
+        try:
+            self._open(resolve_index_dir(directory))
+        except FileNotFoundError:
+            # 開いている間に版が差し替えられ、読もうとした版が削除された場合は CURRENT を読み直す
+            self._open(resolve_index_dir(directory))
+
+    def _open(self, version_dir: Path):
+        self.directory = version_dir
+        self.vectors = np.load(self.directory / VECTORS_FILE, mmap_mode="r")
+        self.offsets = np.load(self.directory / OFFSETS_FILE, mmap_mode="r")
+        self._records = None
+        if len(self.offsets) > 1 and self.offsets[-1] > 0:
+            with open(self.directory / RECORDS_FILE, "rb") as f:
+                self._records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def record(self, i: int) -> Dict:
+        """i行目のレコード"""
+        return json.loads(self._records[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def records(self, indices: Sequence[int]) -> List[Dict]:
+        return [self.record(i) for i in indices]
+
+    @property
+    def similarity(self) -> SimilarityIndex:
+        """行列をコピーせずに使う類似検索。tag で絞り込む場合だけ全レコードの tag を読む"""
+        if self._similarity is None:
+            self._similarity = SimilarityIndex(self.vectors, normalized=True)
+        return self._similarity
+
+    def _with_tags(self, tag: TagFilter) -> SimilarityIndex:
+        similarity = self.similarity
+        if tag is not None and similarity.tags is None:
+            similarity.tags = [self.record(i).get("tag") for i in range(len(self))]
+        return similarity
+
+    def search(self, query_embedding, k: int = 3, tag: TagFilter = None) -> List[Tuple[int, float]]:
+        """クエリのembeddingとコサイン類似度の高い順に (行番号, 類似度) をk件返す（tag を指定するとその行だけ）"""
+        if not len(self):
+            return []
+        return self._with_tags(tag).search(query_embedding, k, tag)
+
+    def search_batch(self, query_embeddings, k: int = 3, tag: TagFilter = None) -> List[List[Tuple[int, float]]]:
+        """複数のクエリをまとめて検索する（クエリごとに search と同じ結果）"""
+        if not len(self):
+            return [[] for _ in range(len(query_embeddings))]
+        return self._with_tags(tag).search_batch(query_embeddings, k, tag)
+
+    def close(self):
+        if self._records is not None:
+            self._records.close()
+            self._records = None
+
+
+def index_exists(directory: Union[str, Path]) -> bool:
+    directory = resolve_index_dir(directory)
+    return all((directory / name).exists() for name in (VECTORS_FILE, RECORDS_FILE, OFFSETS_FILE))
+
+
+@lru_cache(maxsize=8)
+def _open_index(path: str) -> VectorIndex:
+    return VectorIndex(path)
+
+
+def get_vector_index(directory: str = "rag_data") -> Optional[VectorIndex]:
+    """ディレクトリの現在の版のインデックス（版ごとにプロセス内で1回だけ開く。インデックスがなければNone）"""
+    if not index_exists(directory):
+        return None
+    try:
+        return _open_index(os.fspath(resolve_index_dir(directory)))
+    except FileNotFoundError:
+        # 解決した版が差し替えで削除された場合は CURRENT を読み直す
+        return _open_index(os.fspath(resolve_index_dir(directory)))
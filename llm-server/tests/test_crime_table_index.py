@@ -0,0 +1,57 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.crime_table_index import CrimeTable, load_crime_tables, sheet_name
+
+
+ROWS = [
+    ["罪名", "暴行したか", "怪我をさせたか", "死亡したか", "金品を奪ったか"],
+    ["暴行罪", "◯", "", "", ""],
+    ["傷害罪", "◯", "◯", "", ""],
+    ["傷害致死罪", "◯", "◯", "◯"],
+    ["強盗罪", "◯", "", "", "◯"],
+]
+
+
+class TestCrimeTable:
+    """罪名予測テーブルの◯行列インデックスのテスト"""
+
+    def test_from_rows_builds_boolean_matrix(self):
+        table = CrimeTable.from_rows("身体", ROWS)
+        assert table.matrix.shape == (4, 4)
+        assert table.marked_criteria("傷害致死罪") == ["暴行したか", "怪我をさせたか", "死亡したか"]
+
+    def test_narrow_with_answers(self):
+        table = CrimeTable.from_rows("身体", ROWS)
+        result = table.narrow({"怪我をさせたか": True})
+        assert result["candidates"] == ["傷害罪", "傷害致死罪"]
+        assert result["discriminating"] == ["死亡したか"]
+        assert result["mismatches"] == 0
+
+        result = table.narrow({"怪我をさせたか": False, "未知の基準": True})
+        assert result["candidates"] == ["暴行罪", "強盗罪"]
+        assert result["discriminating"] == ["金品を奪ったか"]
+
+    def test_contradictory_answers_keep_closest_rows(self):
+        table = CrimeTable.from_rows("身体", ROWS)
+        result = table.narrow({"死亡したか": True, "金品を奪ったか": True})
+        assert result["mismatches"] == 1
+        assert result["candidates"] == ["傷害致死罪", "強盗罪"]
+
+    def test_render_only_surviving_rows(self):
+        table = CrimeTable.from_rows("身体", ROWS)
+        assert table.render(["暴行罪", "傷害罪"]) == "罪名,暴行したか,怪我をさせたか\n暴行罪,◯,\n傷害罪,◯,◯"
+
+    def test_load_prefers_first_directory(self, tmp_path):
+        first, second = tmp_path / "tsv", tmp_path / "csv"
+        first.mkdir()
+        second.mkdir()
+        (first / "罪名予測テーブル - 身体.tsv").write_text("罪名\t暴行したか\n暴行罪\t◯\n", encoding="utf-8")
+        (second / "罪名予測テーブル_身体.csv").write_text("罪名,別の基準\n別の罪,◯\n", encoding="utf-8")
+        (second / "罪名予測テーブル_財産.csv").write_text("罪名,盗んだか\n窃盗罪,◯\n", encoding="utf-8")
+
+        tables = load_crime_tables([first, second])
+        assert sorted(tables) == ["財産", "身体"]
+        assert tables["身体"].crimes == ["暴行罪"]
+        assert sheet_name(second / "罪名予測テーブル_財産.csv") == "財産"
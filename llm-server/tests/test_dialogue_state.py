@@ -0,0 +1,36 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.dialogue_state import DialogueState
+
+
+class TestFactLedger:
+    """判明事実の台帳のテスト"""
+
+    def test_merge_replaces_same_item(self):
+        state = DialogueState(known_facts=["行為：暴行", "前科：不明"])
+        state.merge_facts(["前科：なし", "示談：未成立"], hist_length=3)
+        assert state.known_facts == ["行為：暴行", "前科：なし", "示談：未成立"]
+        assert state.facts_hist_length == 3
+
+    def test_pending_turns_since_last_merge(self):
+        hist = [
+            {"role": "user", "content": "殴ってしまいました"},
+            {"role": "assistant", "content": "【確認ステップ 第1回】"},
+            {"role": "user", "content": "前科はありません"}
+        ]
+        state = DialogueState()
+        assert state.pending_fact_turns(hist) == hist
+        state.merge_facts(["行為：暴行"], hist_length=1)
+        assert state.pending_fact_turns(hist) == hist[1:]
+        # 台帳が履歴より先に進んでいる（履歴の編集など）場合は全体から抽出する
+        assert state.pending_fact_turns(hist[:0]) == []
+        state.facts_hist_length = 10
+        assert state.pending_fact_turns(hist) == hist
+
+    def test_ledger_round_trips_through_metadata(self):
+        state = DialogueState(known_facts=["被害：骨折"], facts_hist_length=2)
+        restored = DialogueState.from_metadata({"dialogue_state": state.model_dump()})
+        assert restored.known_facts == ["被害：骨折"]
+        assert restored.facts_hist_length == 2
@@ -0,0 +1,67 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+from types import SimpleNamespace
+
+import src.config as config
+from src.embedding import EmbeddingService, make_key
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.calls = []
+
+    def create(self, model, input):
+        self.calls.append(list(input))
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(text)), 1.0]) for text in input])
+
+
+def make_service(tmp_path, monkeypatch, window=0.05):
+    embeddings = FakeEmbeddings()
+    monkeypatch.setattr(config, "get_openai_client", lambda: SimpleNamespace(embeddings=embeddings))
+    service = EmbeddingService(
+        path=str(tmp_path / "embedding_cache.sqlite3"),
+        max_memory_entries=100,
+        batch_window_seconds=window,
+        max_batch_size=16
+    )
+    return service, embeddings
+
+
+class TestEmbeddingService:
+    """embeddingサービス（キャッシュ・同時要求のまとめ送信）のテスト"""
+
+    def test_key_uses_normalised_text(self):
+        assert make_key("m", "  暴行　された\n ") == make_key("m", "暴行 された")
+        assert make_key("m", "暴行") != make_key("other", "暴行")
+
+    def test_cache_survives_restart(self, tmp_path, monkeypatch):
+        service, embeddings = make_service(tmp_path, monkeypatch)
+        assert service.embed_many(["質問1", "質問2", "質問1"]) == [[3.0, 1.0], [3.0, 1.0], [3.0, 1.0]]
+        assert embeddings.calls == [["質問1", "質問2"]]
+        assert service.embed(" 質問1 ") == [3.0, 1.0]
+
+        restarted, embeddings = make_service(tmp_path, monkeypatch)
+        assert restarted.embed_many(["質問2", "質問三つ"]) == [[3.0, 1.0], [4.0, 1.0]]
+        assert embeddings.calls == [["質問三つ"]]
+        assert restarted.get_stats()["hits"] == 1
+
+    def test_concurrent_requests_share_one_call(self, tmp_path, monkeypatch):
+        service, embeddings = make_service(tmp_path, monkeypatch, window=0.2)
+        texts = ["a", "bb", "ccc", "bb"]
+        results = [None] * len(texts)
+
+        def worker(i):
+            results[i] = service.embed(texts[i])
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(texts))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [[1.0, 1.0], [2.0, 1.0], [3.0, 1.0], [2.0, 1.0]]
+        assert len(embeddings.calls) == 1
+        assert sorted(embeddings.calls[0]) == ["a", "bb", "ccc"]
@@ -0,0 +1,94 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.history_packer import (
+    count_tokens,
+    pack_history,
+    strip_clarification_boilerplate,
+    strip_optional_follow_up
+)
+
+
+CLARIFICATION = "\n".join([
+    "【確認ステップ 第1回】",
+    "【現在判明している情報】",
+    "・駅で口論になった",
+    "",
+    "状況を把握するため、次の点を教えてください。",
+    "1. 相手に怪我はありましたか？",
+    "2. 警察から連絡はありましたか？",
+    "3. 前科はありますか？"
+])
+
+
+def total_tokens(messages):
+    return sum(count_tokens(m["content"]) + 4 for m in messages)
+
+
+class TestHistoryPacker:
+    """会話履歴の詰め込みのテスト"""
+
+    def test_clarification_keeps_header_and_questions(self):
+        stripped = strip_clarification_boilerplate(CLARIFICATION)
+        assert stripped.splitlines() == [
+            "【確認ステップ 第1回】",
+            "1. 相手に怪我はありましたか？",
+            "2. 警察から連絡はありましたか？",
+            "3. 前科はありますか？"
+        ]
+        assert strip_clarification_boilerplate("通常の回答です") == "通常の回答です"
+
+    def test_optional_follow_up_keeps_questions(self):
+        content = "回答本文\n\n=====\n\n【任意追加確認】\n以下の情報があれば\n\n1. 示談は？\n\n※任意です"
+        assert strip_optional_follow_up(content) == "回答本文\n【任意追加確認】\n1. 示談は？"
+
+    def test_short_history_is_unchanged_except_older_boilerplate(self):
+        hist = [
+            {"role": "user", "content": "人を殴ってしまいました"},
+            {"role": "assistant", "content": CLARIFICATION},
+            {"role": "user", "content": "怪我はありません"},
+            {"role": "assistant", "content": CLARIFICATION.replace("第1回", "第2回")},
+            {"role": "user", "content": "連絡はありません"}
+        ]
+        packed = pack_history(hist, budget=10000)
+        assert [m["role"] for m in packed] == [m["role"] for m in hist]
+        assert "現在判明している情報" not in packed[1]["content"]
+        # 最新の深掘り質問は原文のまま
+        assert packed[3]["content"] == hist[3]["content"]
+        # 元の履歴は変更しない
+        assert "現在判明している情報" in hist[1]["content"]
+
+    def test_long_history_fits_budget(self):
+        hist = []
+        for i in range(30):
+            hist.append({"role": "user", "content": f"ユーザー発話{i} " + "詳細な事情の説明。" * 40})
+            hist.append({"role": "assistant", "content": f"回答{i} " + "一般的な説明です。" * 60})
+        hist.append({"role": "user", "content": "最新の質問です"})
+
+        packed = pack_history(hist, budget=2000)
+        assert total_tokens(packed) <= 2000
+        assert packed[-1] == hist[-1]
+        assert packed[0]["content"].startswith("ユーザー発話0")
+
+    def test_oversized_latest_message_is_truncated(self):
+        hist = [{"role": "user", "content": "あ" * 5000 + "最後の一文"}]
+        packed = pack_history(hist, budget=500)
+        assert total_tokens(packed) <= 500
+        assert packed[0]["content"].endswith("最後の一文")
+
+    def test_known_facts_replace_older_turns(self):
+        hist = []
+        for i in range(20):
+            hist.append({"role": "user", "content": f"ユーザー発話{i} " + "詳細な事情の説明。" * 40})
+            hist.append({"role": "assistant", "content": f"回答{i} " + "一般的な説明です。" * 60})
+        hist.append({"role": "user", "content": "最新の質問です"})
+
+        packed = pack_history(hist, budget=2000, known_facts=["行為：暴行", "前科：なし"])
+        assert packed[0]["role"] == "system"
+        assert "・前科：なし" in packed[0]["content"]
+        assert total_tokens(packed) <= 2000
+        assert packed[1]["content"].startswith("ユーザー発話0")
+        # 古いターンは台帳で置き換えるため短縮版も含めない
+        assert not any(m["content"].startswith("ユーザー発話1 ") for m in packed)
+        assert packed[-1] == hist[-1]
@@ -0,0 +1,58 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.intent_classifier import IntentClassifier, featurize, load_log_exchanges
+
+
+TRAIN_DATA = [
+    ("友人を殴ってしまいました。どのような罪になり、どのくらいの刑になりますか", "predict_crime_and_punishment"),
+    ("夫が逮捕されました。今後どうなりますか、刑務所に入りますか", "predict_crime_and_punishment"),
+    ("万引きをしてしまいました。罪と刑の見通しを教えてください", "predict_crime_and_punishment"),
+    ("逮捕された後の手続きの流れを教えてください", "legal_process"),
+    ("保釈の手続きはどのように進みますか", "legal_process"),
+    ("起訴までの流れと期間を知りたいです", "legal_process"),
+    ("今日の天気はどうですか", "no_legal"),
+    ("おすすめのレストランを教えて", "no_legal"),
+    ("好きな映画は何ですか", "no_legal"),
+]
+
+
+class TestIntentClassifier:
+    """ローカル分類器のテスト"""
+
+    def test_featurize_is_normalized(self):
+        indices, values = featurize("ＡＢＣabc")
+        assert len(indices) == len(values) > 0
+        assert abs(float((values ** 2).sum()) - 1.0) < 1e-5
+        # NFKC正規化により全角・半角は同じ特徴になる
+        assert (featurize("ＡＢＣ")[0] == featurize("abc")[0]).all()
+
+    def test_train_and_predict(self):
+        texts, labels = zip(*TRAIN_DATA)
+        classifier = IntentClassifier.train(list(texts), list(labels), dim=2 ** 12)
+        for text, label in TRAIN_DATA:
+            assert classifier.predict(text)[0] == label
+        proba = classifier.predict_proba("保釈の流れを教えて")
+        assert abs(float(proba.sum()) - 1.0) < 1e-5
+
+    def test_save_and_load(self, tmp_path):
+        texts, labels = zip(*TRAIN_DATA)
+        classifier = IntentClassifier.train(list(texts), list(labels), dim=2 ** 12, epochs=5)
+        path = tmp_path / "response_type.npz"
+        classifier.save(path)
+        loaded = IntentClassifier.load(path)
+        assert loaded.labels == classifier.labels
+        assert loaded.predict(texts[0]) == classifier.predict(texts[0])
+
+    def test_load_log_exchanges(self, tmp_path):
+        log = tmp_path / "log.txt"
+        log.write_text(
+            "user: 質問です\nassistant: 回答1行目\n\n回答2行目\n\n" + "=" * 50 + "\n"
+            "user: 次の質問\n\nassistant: 次の回答\n\n" + "=" * 50 + "\n",
+            encoding="utf-8"
+        )
+        exchanges = load_log_exchanges(log)
+        assert len(exchanges) == 2
+        assert exchanges[0][1] == {"role": "assistant", "content": "回答1行目\n\n回答2行目"}
+        assert exchanges[1][0] == {"role": "user", "content": "次の質問"}
@@ -0,0 +1,54 @@
+import sys
+import os
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.llm_cache import LLMCache
+
+
+def make_cache(path, **kwargs):
+    options = {"max_memory_entries": 2, "max_disk_entries": 100, "ttl_seconds": 60}
+    options.update(kwargs)
+    return LLMCache(str(path), **options)
+
+
+class TestLLMCache:
+    """LLM応答キャッシュのテスト"""
+
+    def test_key_depends_on_request(self):
+        args = {"model": "gpt-4.1", "temperature": 0, "messages": [{"role": "user", "content": "a"}]}
+        key = LLMCache.make_key(args)
+        assert key == LLMCache.make_key(dict(args))
+        assert key != LLMCache.make_key(dict(args, stream=True))
+        assert key != LLMCache.make_key(dict(args, response_format={"type": "json_object"}))
+
+    def test_hit_miss_counted_per_purpose(self, tmp_path):
+        cache = make_cache(tmp_path / "cache.sqlite3")
+        assert cache.get("k", "classifier") is None
+        cache.set("k", "v")
+        assert cache.get("k", "classifier") == "v"
+        assert cache.get_stats()["classifier"] == {"hits": 1, "misses": 1}
+
+    def test_memory_lru_falls_back_to_disk(self, tmp_path):
+        path = tmp_path / "cache.sqlite3"
+        cache = make_cache(path)
+        for key in ["a", "b", "c"]:
+            cache.set(key, key.upper())
+        assert "a" not in cache._memory
+        assert cache.get("a", "main") == "A"
+        # 別プロセス相当（メモリが空）でもディスクから読める
+        assert make_cache(path).get("b", "main") == "B"
+
+    def test_ttl_expiry(self, tmp_path):
+        cache = make_cache(tmp_path / "cache.sqlite3", ttl_seconds=0.05)
+        cache.set("k", "v")
+        time.sleep(0.1)
+        assert cache.get("k", "main") is None
+
+    def test_disk_size_eviction(self, tmp_path):
+        cache = make_cache(tmp_path / "cache.sqlite3", max_disk_entries=10)
+        for i in range(100):
+            cache.set(f"k{i}", str(i))
+        count = cache._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        assert count == 10
+        assert cache._conn.execute("SELECT value FROM llm_cache WHERE key = 'k99'").fetchone() == ("99",)
@@ -0,0 +1,30 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.predict_crime_type as pct
+
+
+def pre_route(text):
+    return pct.pre_route([{"role": "user", "content": text}])
+
+
+class TestPreRoute:
+    """大分類シートの◯行列による参照シートの事前判定のテスト"""
+
+    def test_money_words_do_not_route(self):
+        # 示談金・離婚の話の「お金」で財産の判断基準に該当させない（ルーターに任せる）
+        assert pre_route("友人を殴って怪我をさせました。示談でお金を払いたいです") is None
+        assert pre_route("夫に殴られてけがをしました。離婚でお金の話もしたい") is None
+        assert pre_route("お金を借りたが返せない") is None
+        assert "他人の財産や利益か" not in pct.extract_criteria(["示談でお金を払いたい"])
+
+    def test_only_unambiguous_rows_are_routed(self):
+        # ◯のついた行が1つだけの判断基準なら決まる
+        assert pre_route("覚醒剤を持っていました") == "薬物犯罪"
+        # 該当する判断基準を持つ行が複数ある場合は決めない
+        assert pre_route("飲酒運転で人をはねて怪我をさせた") is None
+        assert pre_route("財布を盗まれた") is None
+
+    def test_big_category_from_analysis_wins(self):
+        assert pct.pre_route([{"role": "user", "content": "お金の相談です"}], big_category="財産に対する罪") == "財産に対する罪"
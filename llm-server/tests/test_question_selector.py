@@ -0,0 +1,98 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from src.crime_table_index import CrimeTable
+from src.question_selector import (
+    infer_criteria_answers,
+    information_gain,
+    parse_criteria_answers,
+    parse_yes_no,
+    select_crime_criteria,
+    select_sentencing_items
+)
+
+
+ROWS = [
+    ["罪名", "被害者に有形力を行使したか", "被害者に怪我をさせたか", "被害者が死亡したか", "金品を持ち出したか", "業務中だったか"],
+    ["暴行罪", "◯", "", "", "", ""],
+    ["傷害罪", "◯", "◯", "", "", ""],
+    ["傷害致死罪", "◯", "◯", "◯", "", ""],
+    ["強盗罪", "◯", "", "", "◯", ""],
+    ["強盗致傷罪", "◯", "◯", "", "◯", ""],
+    ["業務上過失致死罪", "", "", "◯", "", "◯"],
+]
+
+
+class TestQuestionSelector:
+    """深掘り質問のローカル選択のテスト"""
+
+    def test_information_gain_prefers_balanced_split(self):
+        table = CrimeTable.from_rows("身体", ROWS)
+        rows = np.arange(len(table.crimes))
+        # 全候補に共通する基準は候補を分けない
+        assert information_gain(table, rows, "業務中だったか") < information_gain(table, rows, "被害者に怪我をさせたか")
+        # 既に選んだ基準と同じ分け方になる基準は利得がない
+        assert information_gain(table, rows, "被害者に怪我をさせたか", ["被害者に怪我をさせたか"]) == 0
+
+    def test_select_crime_criteria_orders_by_gain(self):
+        table = CrimeTable.from_rows("身体", ROWS)
+        result = select_crime_criteria(table, {}, limit=3)
+        criteria = [c for c, _ in result["criteria"]]
+        assert criteria[0] == "被害者に怪我をさせたか"
+        assert len(criteria) == 3
+        assert result["criteria"][0][1] == "被害者に怪我をさせたか？"
+
+    def test_no_crime_questions_once_narrowed(self):
+        table = CrimeTable.from_rows("身体", ROWS)
+        result = select_crime_criteria(table, {"被害者に怪我をさせたか": True})
+        assert result["candidates"] == ["傷害罪", "傷害致死罪", "強盗致傷罪"]
+        assert result["criteria"] == []
+
+    def test_asked_criteria_are_not_repeated(self):
+        table = CrimeTable.from_rows("身体", ROWS)
+        result = select_crime_criteria(table, {}, asked=["被害者に怪我をさせたか"])
+        assert "被害者に怪我をさせたか" not in [c for c, _ in result["criteria"]]
+
+    def test_sentencing_items_by_importance(self):
+        items = ["ID（通し番号）", "罪名", "犯人の年齢", "行為態様", "示談の有無・示談金額", "前科の有無・内容"]
+        selected = select_sentencing_items(items, known_facts=["前科：なし"])
+        assert [item for item, _ in selected] == ["示談の有無・示談金額", "行為態様"]
+        assert selected[0][1] == "示談の成立状況と示談金額を教えてください"
+
+    def test_parse_criteria_answers(self):
+        criteria = ["被害者に怪我をさせたか", "被害者が死亡したか", "金品を持ち出したか", None]
+        text = "1. はい、軽い怪我です\n2) いいえ\n3. わからないです\n4. 30万円で示談しました"
+        assert parse_criteria_answers(text, criteria) == {"被害者に怪我をさせたか": True, "被害者が死亡したか": False}
+        # 番号がなくても行数が質問数と同じなら順に対応させる
+        assert parse_criteria_answers("ありません\nはい", criteria[:2]) == {
+            "被害者に怪我をさせたか": False,
+            "被害者が死亡したか": True
+        }
+
+    def test_parse_yes_no_mixed_answers(self):
+        # 冒頭の はい/いいえ を優先する
+        assert parse_yes_no("はい、ありません") is True
+        assert parse_yes_no("いいえ、殴りました") is False
+        # 謝罪の「すみません」は否定として数えない
+        assert parse_yes_no("すみません、殴りました") is True
+        # 肯定と否定の両方を含む回答は記録しない
+        assert parse_yes_no("怪我はしていないと思ったが骨折していた") is None
+        assert parse_yes_no("ありません") is False
+        assert parse_yes_no("していません") is False
+        assert parse_yes_no("骨折していました") is True
+
+    def test_criteria_stated_in_conversation_are_not_asked(self):
+        table = CrimeTable.from_rows("身体", ROWS)
+        texts = ["行為：暴行", "被害：骨折", "殴って骨折させてしまいました"]
+        answers = infer_criteria_answers(table.criteria, texts)
+        assert answers == {"被害者に有形力を行使したか": True, "被害者に怪我をさせたか": True}
+        result = select_crime_criteria(table, answers)
+        assert result["candidates"] == ["傷害罪", "傷害致死罪", "強盗致傷罪"]
+        # 否定された語のみなら いいえ、肯定の語が1つでもあれば はい
+        assert infer_criteria_answers(table.criteria, ["怪我はありません"]) == {"被害者に怪我をさせたか": False}
+        assert infer_criteria_answers(
+            table.criteria, ["怪我はしていないと思ったが骨折していた"]
+        ) == {"被害者に怪我をさせたか": True}
@@ -0,0 +1,88 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import src.config as config
+import src.rag_loader as rag_loader
+from src.rag_loader import CHECKPOINT_FILE, LegalRAGLoader, make_batches
+from src.vector_index import CURRENT_FILE, VERSIONS_DIR, VectorIndex
+
+
+class TestEmbeddingGeneration:
+    """RAGデータ生成のembedding（バッチ化・チェックポイントからの再開）のテスト"""
+
+    def test_make_batches_respects_limits(self):
+        texts = ["あ" * 10, "い" * 10, "う" * 10, "え" * 50, "お"]
+        batches = make_batches(texts, max_inputs=2, max_tokens=25)
+        assert batches == [["あ" * 10, "い" * 10], ["う" * 10], ["え" * 50], ["お"]]
+
+    def test_resume_from_checkpoint(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(config, "RAG_EMBED_BATCH_SIZE", 2)
+        monkeypatch.setattr(config, "RAG_EMBED_CONCURRENCY", 1)
+        sent = []
+
+        def failing_batch(texts):
+            if "質問3" in texts:
+                raise RuntimeError("network down")
+            sent.append(list(texts))
+            return [[float(len(text)), 1.0] for text in texts]
+
+        texts = [f"質問{i}" for i in range(6)]
+        loader = LegalRAGLoader(str(tmp_path))
+        monkeypatch.setattr(rag_loader.emb, "ada_batch", failing_batch)
+        with pytest.raises(RuntimeError):
+            loader.embed_texts(texts)
+        assert (tmp_path / CHECKPOINT_FILE).exists()
+        saved = [text for batch in sent for text in batch]
+        assert saved[:2] == ["質問0", "質問1"] and "質問3" not in saved
+
+        sent.clear()
+        monkeypatch.setattr(rag_loader.emb, "ada_batch", lambda batch: sent.append(list(batch)) or [[2.0, 0.0]] * len(batch))
+        embeddings = loader.embed_texts(texts + ["質問0"])
+        # 保存済みのテキストは送らない
+        resent = [text for batch in sent for text in batch]
+        assert sorted(resent) == sorted(set(texts) - set(saved))
+        assert embeddings[0] == [3.0, 1.0] and embeddings[3] == [2.0, 0.0] and embeddings[-1] == embeddings[0]
+        assert loader.embedding_stats["rows"] == len(resent)
+
+
+class TestIncrementalRebuild:
+    """行のハッシュによるRAGインデックスの差分再生成のテスト"""
+
+    def make_loader(self, tmp_path, monkeypatch, criteria):
+        loader = LegalRAGLoader(str(tmp_path))
+        monkeypatch.setattr(
+            loader, "collect_questions",
+            lambda: loader.crime_prediction_questions("身体に対する罪", list(criteria), "罪名予測テーブル - 身体に対する罪.tsv")
+        )
+        return loader
+
+    def test_only_new_rows_are_embedded(self, tmp_path, monkeypatch):
+        sent = []
+        monkeypatch.setattr(
+            rag_loader.emb, "ada_batch", lambda batch: sent.extend(batch) or [[float(len(t)), 1.0] for t in batch]
+        )
+        first = self.make_loader(tmp_path, monkeypatch, ["被害者に怪我をさせたか", "凶器を使ったか"]).create_rag_data()
+        assert first["rebuild"]["embeddings_to_create"] == 2 and len(sent) == 2
+
+        sent.clear()
+        loader = self.make_loader(tmp_path, monkeypatch, ["被害者に怪我をさせたか", "被害者が亡くなったか"])
+        plan = loader.create_rag_data(dry_run=True)
+        assert sent == []
+        assert {k: plan[k] for k in ("total", "reused", "added", "removed", "embeddings_to_create")} == {
+            "total": 2, "reused": 1, "added": 1, "removed": 1, "embeddings_to_create": 1
+        }
+        assert plan["tokens_to_embed"] > 0
+
+        metadata = loader.create_rag_data()
+        assert len(sent) == 1 and "被害者が亡くなったか" in sent[0]
+        assert metadata["total_questions"] == 2
+        index = VectorIndex(tmp_path)
+        assert [r["metadata"]["original_question"] for r in index.records(range(len(index)))] == [
+            "被害者に怪我をさせたか", "被害者が亡くなったか"
+        ]
+        # CURRENT は最新の版を指し、直前の版だけが残る
+        versions = sorted(p.name for p in (tmp_path / VERSIONS_DIR).iterdir())
+        assert len(versions) == 2 and versions[-1] == (tmp_path / CURRENT_FILE).read_text()
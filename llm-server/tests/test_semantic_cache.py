@@ -0,0 +1,74 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.semantic_cache import (
+    SemanticCache,
+    KIND_ANSWER,
+    KIND_CLARIFICATION,
+    has_personal_specifics,
+    normalize_user_history,
+)
+
+
+class TestSemanticCache:
+    """意味キャッシュのテスト"""
+
+    def test_personal_specifics(self):
+        assert not has_personal_specifics("飲酒運転で捕まった、罰金はいくら？")
+        assert not has_personal_specifics("保釈の手続きの流れを教えてください")
+        assert has_personal_specifics("罰金は30万円くらいですか")
+        assert has_personal_specifics("田中さんに殴られました")
+        assert has_personal_specifics("連絡先は test@example.com です")
+
+    def test_normalize_user_history(self):
+        hist = [
+            {"role": "assistant", "content": "こんにちは"},
+            {"role": "user", "content": "飲酒運転で捕まった、罰金はいくら？"},
+        ]
+        paraphrase = [{"role": "user", "content": "飲酒運転で捕まった　罰金はいくら?"}]
+        assert normalize_user_history(hist) == normalize_user_history(paraphrase)
+        assert normalize_user_history(hist, "交通事故・違反").startswith("[交通事故・違反]")
+
+    def test_lookup_threshold_and_kind(self, tmp_path):
+        cache = SemanticCache(str(tmp_path / "cache.sqlite3"), max_entries=10, threshold=0.9)
+        cache.add([1.0, 0.0, 0.0], "a", "legal_process", KIND_ANSWER, "回答", 1200.0)
+
+        hit = cache.lookup([0.99, 0.1, 0.0], [KIND_ANSWER])
+        assert hit["response"] == "回答"
+        assert cache.lookup([0.99, 0.1, 0.0], [KIND_CLARIFICATION]) is None
+        assert cache.lookup([0.0, 1.0, 0.0], [KIND_ANSWER]) is None
+
+        stats = cache.get_stats()
+        assert stats["hits"] == 1 and stats["lookups"] == 3
+        assert stats["saved_ms"] == 1200.0
+
+    def test_persistence_and_eviction(self, tmp_path):
+        path = str(tmp_path / "cache.sqlite3")
+        cache = SemanticCache(path, max_entries=2, threshold=0.9)
+        for i, vector in enumerate([[1, 0, 0], [0, 1, 0], [0, 0, 1]]):
+            cache.add(vector, str(i), "legal_process", KIND_ANSWER, f"回答{i}", 0.0)
+
+        reloaded = SemanticCache(path, max_entries=2, threshold=0.9)
+        assert reloaded.get_stats()["entries"] == 2
+        assert reloaded.lookup([1, 0, 0], [KIND_ANSWER]) is None  # 最も古いものは削除済み
+        assert reloaded.lookup([0, 0, 1], [KIND_ANSWER])["response"] == "回答2"
+
+    def test_lookup_skips_disallowed_kinds(self, tmp_path):
+        cache = SemanticCache(str(tmp_path / "cache.sqlite3"), max_entries=10, threshold=0.9)
+        cache.add([1.0, 0.0, 0.0], "a", "predict_crime_type", KIND_CLARIFICATION, "【確認ステップ 第1回】\n質問", 0.0)
+        cache.add([0.98, 0.2, 0.0], "b", "legal_process", KIND_ANSWER, "回答", 0.0)
+        # 最も近いのは深掘り質問だが、回答だけを許す場合はその次の回答を返す
+        assert cache.lookup([1.0, 0.0, 0.0], [KIND_ANSWER])["response"] == "回答"
+
+    def test_clarification_is_stored_without_known_facts(self, tmp_path):
+        path = str(tmp_path / "cache.sqlite3")
+        cache = SemanticCache(path, max_entries=10, threshold=0.9)
+        response = (
+            "【確認ステップ 第1回】\n【現在判明している情報】\n・行為：暴行\n・被害者：元交際相手\n\n"
+            "状況を把握するため、次の点を教えてください。\n1. 怪我の程度は？"
+        )
+        cache.add([1.0, 0.0, 0.0], "a", "predict_crime_type", KIND_CLARIFICATION, response, 0.0)
+        expected = "【確認ステップ 第1回】\n状況を把握するため、次の点を教えてください。\n1. 怪我の程度は？"
+        assert cache.lookup([1.0, 0.0, 0.0], [KIND_CLARIFICATION])["response"] == expected
+        assert SemanticCache(path, max_entries=10, threshold=0.9).lookup([1.0, 0.0, 0.0], [KIND_CLARIFICATION])["response"] == expected
@@ -0,0 +1,70 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from src.similarity import SimilarityIndex, cached_index, cosine_similarity, top_k_rows
+from src.vector_index import VectorIndex, write_index
+
+
+def brute_force(vectors, query, k):
+    """変更前の1件ずつのコサイン類似度と全件の並べ替え"""
+    scores = [(i, cosine_similarity(v, query)) for i, v in enumerate(vectors)]
+    return [i for i, _ in sorted(scores, key=lambda x: x[1], reverse=True)[:k]]
+
+
+class TestSimilarityIndex:
+    """コサイン類似度・上位k件検索のテスト"""
+
+    def test_batch_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(200, 16))
+        queries = rng.normal(size=(5, 16))
+        index = SimilarityIndex(vectors)
+        assert index.matrix.dtype == np.float32
+
+        results = index.search_batch(queries, k=4)
+        for query, result in zip(queries, results):
+            assert [i for i, _ in result] == brute_force(vectors, query, 4)
+            single = index.search(query, k=4)
+            assert [i for i, _ in single] == [i for i, _ in result]
+            np.testing.assert_allclose([s for _, s in single], [s for _, s in result], rtol=1e-5)
+        assert abs(results[0][0][1] - cosine_similarity(vectors[results[0][0][0]], queries[0])) < 1e-5
+
+    def test_tag_filter_returns_original_rows(self):
+        vectors = [[1.0, 0.0], [0.9, 0.1], [0.0, 1.0], [0.8, 0.2]]
+        tags = ["crime_prediction_身体に対する罪", "sentencing_prediction_身体に対する罪"] * 2
+        index = SimilarityIndex(vectors, tags=tags)
+        assert [i for i, _ in index.search([1.0, 0.0], k=5, tag="crime_prediction_身体に対する罪")] == [0, 2]
+        assert [i for i, _ in index.search([1.0, 0.0], k=2, tag=set(tags))] == [0, 1]
+        assert index.search([1.0, 0.0], tag="交通") == []
+
+    def test_top_k_rows_and_vector_index_filter(self, tmp_path):
+        scores = np.array([[0.1, 0.9, 0.5], [0.7, 0.2, 0.3]])
+        assert top_k_rows(scores, 2).tolist() == [[1, 2], [0, 2]]
+        assert top_k_rows(scores, 5).tolist() == [[1, 2, 0], [0, 2, 1]]
+
+        records = [{"text": f"質問{i}", "tag": "a" if i % 2 else "b", "metadata": {}} for i in range(6)]
+        write_index(tmp_path, np.eye(6).tolist(), records)
+        index = VectorIndex(tmp_path)
+        assert index.search(np.eye(6)[4], k=1, tag="a")[0][0] in (1, 3, 5)
+        assert index.search(np.eye(6)[4], k=1)[0][0] == 4
+        assert [r[0][0] for r in index.search_batch(np.eye(6)[[0, 3]], k=1)] == [0, 3]
+
+    def test_cached_index_is_reused_per_list(self):
+        refs = [[1.0, 0.0], [0.0, 1.0]]
+        built = []
+
+        def build():
+            built.append(1)
+            return SimilarityIndex(refs)
+
+        first = cached_index(refs, build)
+        assert cached_index(refs, build) is first
+        assert len(built) == 1
+        # 件数が変わったリスト・別のリストは作り直す
+        refs.append([1.0, 1.0])
+        assert len(cached_index(refs, build)) == 3
+        assert cached_index([[1.0, 0.0]], lambda: SimilarityIndex([[1.0, 0.0]])) is not first
+        assert len(built) == 2
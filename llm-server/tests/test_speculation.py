@@ -0,0 +1,68 @@
+import sys
+import os
+import asyncio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.config as config
+import src.speculation as speculation
+
+
+def make_factory(chunks, closed, delay=0.01):
+    async def factory():
+        async def stream():
+            try:
+                for chunk in chunks:
+                    await asyncio.sleep(delay)
+                    yield chunk
+            finally:
+                closed.append(True)
+        return stream()
+    return factory
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+class TestSpeculativeAnswer:
+    """回答の投機的生成のテスト"""
+
+    def test_commit_replays_buffered_and_live_chunks(self):
+        async def scenario():
+            closed = []
+            answer = speculation.SpeculativeAnswer(make_factory(["a", "b", "c"], closed))
+            await asyncio.sleep(0.015)  # 一部だけバッファされた状態で確定する
+            chunks = await collect(answer.commit())
+            await answer.cancel()
+            return chunks, closed
+
+        chunks, closed = asyncio.run(scenario())
+        assert chunks == ["a", "b", "c"]
+        assert closed == [True]
+
+    def test_cancel_closes_upstream(self):
+        async def scenario():
+            closed = []
+            answer = speculation.SpeculativeAnswer(make_factory(["a"] * 100, closed))
+            await asyncio.sleep(0.03)
+            await answer.cancel()
+            return closed
+
+        before = speculation.get_speculation_stats()["cancelled"]
+        assert asyncio.run(scenario()) == [True]
+        assert speculation.get_speculation_stats()["cancelled"] == before + 1
+
+    def test_over_budget_is_abandoned(self, monkeypatch):
+        monkeypatch.setattr(config, "SPECULATIVE_MAX_CHARS", 3)
+
+        async def scenario():
+            closed = []
+            answer = speculation.SpeculativeAnswer(make_factory(["ab", "cd", "ef"], closed, delay=0))
+            await asyncio.sleep(0.01)
+            stream = answer.commit()
+            await answer.cancel()
+            return stream, closed
+
+        stream, closed = asyncio.run(scenario())
+        assert stream is None  # 呼び出し側で通常どおり生成し直す
+        assert closed == [True]
@@ -0,0 +1,68 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.crime_table_index import CrimeTable
+from src.table_prompt import LEGEND_HEADER, ROWS_HEADER, compile_feature_mapping, compile_table
+
+
+ROWS = [
+    ["罪名", "被害者に有形力を行使したか", "被害者に怪我をさせたか", "被害者が死亡したか", "金品を持ち出したか", "未使用の基準"],
+    ["暴行罪", "◯", "", "", "", ""],
+    ["傷害罪", "◯", "◯", "", "", ""],
+    ["傷害致死罪", "◯", "◯", "◯", "", ""],
+    ["強盗罪", "◯", "", "", "◯", ""],
+    ["不明罪", "", "", "", "", ""],
+]
+
+
+def decode(text):
+    """コンパクト表現を 罪名 → ◯のついた判断基準の集合 に戻す"""
+    legend = {}
+    marks = {}
+    section = None
+    for line in text.splitlines():
+        if line in (LEGEND_HEADER, ROWS_HEADER):
+            section = line
+        elif section == LEGEND_HEADER and line:
+            number, criterion = line.split(". ", 1)
+            legend[number] = criterion
+        elif section == ROWS_HEADER:
+            crime, items = line[2:].split(": ", 1)
+            marks[crime] = {legend.get(item, item) for item in items.split(", ")} - {"（該当基準なし）"}
+    return marks
+
+
+class TestTablePrompt:
+    """罪名予測テーブル・ヒアリング項目のコンパクト表現のテスト"""
+
+    def test_compile_table_is_lossless(self):
+        table = CrimeTable.from_rows("身体", ROWS)
+        text = compile_table(table)
+        assert decode(text) == {crime: set(table.marked_criteria(crime)) for crime in table.crimes}
+        # 共通の基準は一覧に1回だけ書き、どの罪名にも◯がない基準は含めない
+        assert text.count("被害者に有形力を行使したか") == 1
+        assert "未使用の基準" not in text
+        # 1つの罪名でしか使われない基準は行内にそのまま書く
+        assert "- 強盗罪: 1, 金品を持ち出したか" in text
+
+    def test_compile_table_only_given_crimes(self):
+        table = CrimeTable.from_rows("身体", ROWS)
+        text = compile_table(table, ["傷害罪", "暴行罪"])
+        assert decode(text) == {"暴行罪": {"被害者に有形力を行使したか"}, "傷害罪": {"被害者に有形力を行使したか", "被害者に怪我をさせたか"}}
+        assert compile_table(table, ["存在しない罪"]) == ""
+
+    def test_compile_feature_mapping_numbers_shared_items(self):
+        features = {
+            "身体に対する罪": ["罪名", "前科の有無・内容", "示談の有無・示談金額", "治療期間"],
+            "財産に対する罪": ["罪名", "前科の有無・内容", "示談の有無・示談金額", "被害金額"],
+            "交通に対する罪": ["罪名", "前科の有無・内容", "過失の内容"],
+        }
+        text = compile_feature_mapping(features)
+        assert text.splitlines()[:3] == ["共通項目一覧（番号で参照）:", "1. 前科の有無・内容", "2. 示談の有無・示談金額"]
+        assert "- 身体に対する罪: 1, 2, 治療期間" in text
+        assert "- 交通に対する罪: 1, 過失の内容" in text
+        # 確認項目ではない列（罪名）は含めない
+        assert "罪名" not in text
+        # カテゴリが1つなら項目をそのまま並べる
+        assert compile_feature_mapping({"財産に対する罪": ["被害金額", "前科"]}) == "- 財産に対する罪: 被害金額, 前科"
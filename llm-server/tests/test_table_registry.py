@@ -0,0 +1,73 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.table_registry import TableRegistry, _reload_hooks, on_reload
+
+
+BIG = "参照シート名\t身体や生命に関わるか\t運転していたか\n身体に対する罪\t◯\t\n交通に対する罪\t\t◯\n"
+BODY = "罪名\t被害者に怪我をさせたか\n暴行罪\t\n傷害罪\t◯\n"
+SENTENCING = "ID（通し番号）\t罪名\t前科の有無・内容\t示談の有無・示談金額\n\t\t\t\n1\t暴行罪\t\t\n"
+
+
+def write(path, text, mtime=None):
+    path.write_text(text, encoding="utf-8")
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+
+
+def make_registry(tmp_path):
+    tables = tmp_path / "tables"
+    sentencing = tmp_path / "sentencing"
+    tables.mkdir()
+    sentencing.mkdir()
+    write(tables / "罪名予測テーブル - 大分類.tsv", BIG)
+    write(tables / "罪名予測テーブル - 身体に対する罪.tsv", BODY, mtime=1_000_000_000)
+    write(sentencing / "量刑予測_ヒアリングシート - 身体に対する罪.tsv", SENTENCING)
+    return TableRegistry([tables], sentencing), tables
+
+
+class TestTableRegistry:
+    """罪名予測テーブル・量刑予測ヒアリングシートのレジストリのテスト"""
+
+    def test_snapshot_serves_all_views(self, tmp_path):
+        registry, _ = make_registry(tmp_path)
+        snapshot = registry.snapshot
+        assert snapshot.crime_tables["身体に対する罪"].crimes == ["暴行罪", "傷害罪"]
+        assert snapshot.topics_csv.splitlines()[0] == "参照シート名,身体や生命に関わるか,運転していたか"
+        assert list(snapshot.crime_sheets) == ["身体に対する罪"]
+        assert snapshot.big_categories[1] == {"name": "交通に対する罪", "features": ["運転していたか"]}
+        assert snapshot.detail_features == {"身体に対する罪": ["被害者に怪我をさせたか"]}
+        # ID列・罪名列は確認項目に含めない
+        assert snapshot.sentencing_features == {"身体に対する罪": ["前科の有無・内容", "示談の有無・示談金額"]}
+        assert registry.reload_if_changed() is False
+
+    def test_reload_swaps_snapshot_on_change(self, tmp_path):
+        registry, tables = make_registry(tmp_path)
+        old = registry.snapshot
+        assert old.memo("crimes", lambda s: s.crime_tables["身体に対する罪"].crimes) == ["暴行罪", "傷害罪"]
+
+        warmed = []
+        hook = on_reload(lambda snapshot: warmed.append(snapshot.version))
+        try:
+            write(tables / "罪名予測テーブル - 身体に対する罪.tsv", BODY + "傷害致死罪\t◯\n", mtime=2_000_000_000)
+            assert registry.reload_if_changed() is True
+        finally:
+            _reload_hooks.remove(hook)
+
+        new = registry.snapshot
+        assert new.version == old.version + 1
+        assert warmed == [new.version]
+        # 派生値のキャッシュはスナップショットごと。古いスナップショットは読み込み時の内容のまま
+        assert new.memo("crimes", lambda s: s.crime_tables["身体に対する罪"].crimes) == ["暴行罪", "傷害罪", "傷害致死罪"]
+        assert old.crime_tables["身体に対する罪"].crimes == ["暴行罪", "傷害罪"]
+
+    def test_added_and_removed_sheets_are_detected(self, tmp_path):
+        registry, tables = make_registry(tmp_path)
+        write(tables / "罪名予測テーブル - 交通に対する罪.tsv", "罪名\t飲酒していたか\n酒気帯び運転\t◯\n")
+        assert registry.reload_if_changed() is True
+        assert "交通に対する罪" in registry.snapshot.crime_sheets
+
+        (tables / "罪名予測テーブル - 交通に対する罪.tsv").unlink()
+        assert registry.reload_if_changed() is True
+        assert "交通に対する罪" not in registry.snapshot.crime_sheets
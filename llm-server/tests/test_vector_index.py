@@ -0,0 +1,54 @@
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from src.vector_index import KEEP_VERSIONS, VERSIONS_DIR, VectorIndex, index_exists, publish_index, resolve_index_dir, top_k, write_index
+
+
+def make_index(tmp_path, n=50, dim=8):
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(n, dim))
+    records = [{"text": f"質問{i}", "tag": "crime_prediction_身体に対する罪", "metadata": {"row": i}} for i in range(n)]
+    write_index(tmp_path, embeddings.tolist(), records)
+    return embeddings, records
+
+
+class TestVectorIndex:
+    """RAGデータのベクトルインデックスのテスト"""
+
+    def test_search_matches_brute_force(self, tmp_path):
+        embeddings, _ = make_index(tmp_path)
+        index = VectorIndex(tmp_path)
+        assert isinstance(index.vectors, np.memmap)
+        assert index.vectors.dtype == np.float32
+        np.testing.assert_allclose(np.linalg.norm(index.vectors, axis=1), 1.0, rtol=1e-5)
+
+        query = embeddings[7] + 0.1
+        cosine = embeddings @ query / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query))
+        expected = list(np.argsort(-cosine)[:5])
+        results = index.search(query, k=5)
+        assert [i for i, _ in results] == expected
+        assert abs(results[0][1] - cosine[expected[0]]) < 1e-5
+
+    def test_records_are_read_by_offset(self, tmp_path):
+        _, records = make_index(tmp_path)
+        index = VectorIndex(tmp_path)
+        assert len(index) == len(records)
+        assert index.record(0) == records[0]
+        assert index.records([49, 3]) == [records[49], records[3]]
+
+    def test_empty_index_and_top_k(self, tmp_path):
+        write_index(tmp_path, [], [])
+        assert index_exists(tmp_path)
+        assert VectorIndex(tmp_path).search([1.0, 0.0], k=3) == []
+        assert list(top_k(np.array([0.1, 0.9, 0.5]), 5)) == [1, 2, 0]
+
+    def test_publish_keeps_previous_version(self, tmp_path):
+        records = [{"text": "質問", "tag": "t", "metadata": {}}]
+        published = [publish_index(tmp_path, [[1.0, float(i)]], records, {"round": i}) for i in range(3)]
+        assert resolve_index_dir(tmp_path) == published[-1]
+        # 直前の版は残り（差し替え直前にそれを解決したプロセスが開ける）、それより古い版は削除される
+        assert sorted(p.name for p in (tmp_path / VERSIONS_DIR).iterdir()) == [p.name for p in published[-KEEP_VERSIONS:]]
+        assert len(VectorIndex(published[-2])) == 1